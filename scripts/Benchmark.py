@@ -0,0 +1,390 @@
+################################################################################
+# Benchmark.py
+# @author: Ryan Herrin
+#
+# Reproducible benchmarks for the parse, combine and weather convert stages.
+# Feeds are made up with a seeded generator so every run sees the same data,
+# and results can be checked against a saved baseline so slow downs get
+# caught before they make it onto the Pi.
+################################################################################
+
+'''
+Usage:
+------------------
+python Benchmark.py                          # 10k and 100k messages
+python Benchmark.py --sizes 10000 1000000    # pick the sizes
+python Benchmark.py --save-baseline          # store this run as the baseline
+python Benchmark.py --threshold 0.25         # fail if >25% slower than baseline
+python Benchmark.py --frame-day 20000        # row lists vs FlightFrame for a day
+
+Exits with 1 if any stage is slower than the baseline by more than the
+threshold.
+'''
+
+import os
+import sys
+import csv
+import json
+import random
+import argparse
+import datetime
+import tempfile
+import tracemalloc
+
+from Metrics import Metrics
+from TenNinty import TenNinty_Parser
+import CombineFltWthr
+
+
+# Message types and how often they show up in a real feed
+_MSG_MIX = [(3, 30), (4, 25), (5, 15), (7, 15), (8, 5), (1, 5), (6, 5)]
+_AIRLINES = ["AAL", "SWA", "ENY", "SKW", "UAL", "ASH", "DAL", "NKS", "FDX", "UPS"]
+_PUTTY_HEADER = ("=~=~=~=~=~=~=~=~=~=~=~= PuTTY log {} =~=~=~=~=~=~=~=~=~=~=~=")
+_WIND = ["N", "NNE", "NE", "ENE", "E", "ESE", "SE", "SSE", "S", "SSW", "SW",
+		 "WSW", "W", "WNW", "NW", "NNW", "CALM", "VAR"]
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+								'data', 'metrics', 'bench_baseline.json')
+
+
+def _make_aircraft(rnd):
+	'''Make up one aircraft with its own hex, flight number and squawk'''
+	kind = rnd.random()
+	if kind < 0.6:
+		flight = "{}{} ".format(rnd.choice(_AIRLINES), rnd.randint(1, 9999))
+	elif kind < 0.85:
+		flight = "N{}{} ".format(rnd.randint(100, 999),
+								 ''.join(rnd.choice("ABCDEFGHJKLMNPRSTUVWXYZ")
+										 for x in range(2)))
+	else:
+		flight = ''
+	return({
+		'hex': "{:06X}".format(rnd.randint(0xA00001, 0xADFFFF)),
+		'flight': flight,
+		'alt': rnd.randrange(500, 41000, 25),
+		'gs': rnd.randint(90, 520),
+		'squawk': "{:04o}".format(rnd.randint(0, 0o7777)),
+		})
+
+
+def generate_sbs_feed(out_path, n_messages, n_aircraft=200, seed=1090,
+					  start=datetime.datetime(2022, 6, 22, 0, 0, 0),
+					  missing_rate=0.05, gap_rate=0.001, header_every=50000):
+	'''Write a made up SBS-1 feed. Aircraft come and go from an active set,
+	the clock jumps forward now and then (gaps), some fields are left empty and
+	putty header lines are mixed in. The same seed always gives the same file.'''
+	rnd = random.Random(seed)
+	active = [_make_aircraft(rnd) for x in range(n_aircraft)]
+	msg_types = [m_type for m_type, weight in _MSG_MIX for x in range(weight)]
+	curr_time = start
+
+	with open(out_path, 'w', newline='') as feed_out:
+		for msg_num in range(n_messages):
+			if header_every and msg_num % header_every == 0:
+				feed_out.write(_PUTTY_HEADER.format(
+					curr_time.strftime("%Y.%m.%d %H:%M:%S")) + '\r\n')
+
+			# Swap an aircraft out every so often so new hex codes show up
+			if rnd.random() < 0.002:
+				active[rnd.randrange(n_aircraft)] = _make_aircraft(rnd)
+
+			# Step the clock, with the odd gap in coverage
+			if rnd.random() < gap_rate:
+				curr_time += datetime.timedelta(minutes=rnd.randint(1, 30))
+			else:
+				curr_time += datetime.timedelta(milliseconds=rnd.randint(1, 40))
+
+			plane = rnd.choice(active)
+			m_type = rnd.choice(msg_types)
+			flight = alt = gs = squawk = ''
+			if m_type == 1:
+				flight = plane['flight']
+			elif m_type in (3, 5, 7):
+				alt = str(plane['alt'])
+			elif m_type == 4:
+				gs = str(plane['gs'])
+			elif m_type == 6:
+				squawk = plane['squawk']
+			if rnd.random() < missing_rate:
+				flight = alt = gs = squawk = ''
+
+			msg_date = curr_time.strftime("%Y/%m/%d")
+			msg_time = curr_time.strftime("%H:%M:%S.") + \
+				"{:03d}".format(curr_time.microsecond // 1000)
+			feed_out.write(','.join([
+				'MSG', str(m_type), '111', '11111', plane['hex'], '111111',
+				msg_date, msg_time, msg_date, msg_time, flight, alt, gs, '',
+				'', '', '', squawk, '', '', '', '0']) + '\r\n')
+
+	return(out_path)
+
+
+def generate_weather_rows(day):
+	'''24 hourly weather rows for a "YYYY-MM-DD" day, laid out like the
+	processed weather CSVs'''
+	rnd = random.Random(day)
+	weekday = datetime.datetime.strptime(day, "%Y-%m-%d").strftime("%A")
+	return([[day, "{:02d}:00:00".format(hour), weekday,
+			 round(rnd.uniform(29.0, 30.5), 2), rnd.randint(60, 105),
+			 rnd.randint(0, 25), rnd.choice(_WIND[:8]), rnd.choice(["Yes", "No"])]
+			for hour in range(24)])
+
+
+def generate_wunder_csv(out_path, seed=1090):
+	'''Write a made up wunderground hourly CSV (the copy and paste layout
+	wunderground_convert expects)'''
+	rnd = random.Random(seed)
+	with open(out_path, 'w', newline='') as wunder_out:
+		wunder_writer = csv.writer(wunder_out, delimiter=',')
+		for hour in range(24):
+			clock = "{}:53 {}".format(hour % 12 or 12, "AM" if hour < 12 else "PM")
+			wunder_writer.writerow([
+				clock, "{} F".format(rnd.randint(60, 105)),
+				"{} F".format(rnd.randint(40, 75)), "{} %".format(rnd.randint(20, 90)),
+				rnd.choice(_WIND), "{} mph".format(rnd.randint(0, 25)),
+				"0 mph", "{:.2f} in".format(rnd.uniform(29.0, 30.5)),
+				"{:.1f} in".format(rnd.choice([0.0, 0.0, 0.0, 0.1])), "Fair"])
+	return(out_path)
+
+
+def _measure(stage_fn, with_memory):
+	'''Run a stage once for time and, if asked, once more for peak memory'''
+	metrics = Metrics('bench')
+	with metrics.stage('run'):
+		stage_fn()
+	result = {'seconds': round(metrics.stages['run'][0], 6)}
+
+	if with_memory:
+		tracemalloc.start()
+		stage_fn()
+		result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+		tracemalloc.stop()
+
+	return(result)
+
+
+def run_benchmarks(sizes, work_dir, with_memory=True, n_aircraft=200, seed=1090):
+	'''Run every stage at every size. Returns {stage: {size: result}}'''
+	results = dict()
+
+	for size in sizes:
+		feed_path = os.path.join(work_dir, "live_raw_2022_06_22_000000")
+		generate_sbs_feed(feed_path, size, n_aircraft=n_aircraft, seed=seed)
+
+		def parse_stage():
+			TenNinty_Parser(feed_path).parse_file()
+		results.setdefault('parse', dict())[str(size)] = _measure(parse_stage, with_memory)
+
+		# Combine the parsed rows with a day of weather, the same way the
+		# combine script does
+		parser = TenNinty_Parser(feed_path)
+		parser.parse_file()
+		flt_rows = [[str(val) for val in row] for row in parser.dump_data]
+		wthr_rows = [[str(val) for val in row] for row in
+					 generate_weather_rows("2022-06-22")]
+
+		def combine_stage():
+			CombineFltWthr.combine_flt_and_wthr(flt_rows, wthr_rows)
+		results.setdefault('combine', dict())[str(size)] = _measure(combine_stage,
+																	with_memory)
+
+	# The weather convert stage works on files of 24 rows, so it is sized by
+	# number of files instead of messages
+	try:
+		from Weather import Weather
+	except ImportError as err:
+		print("Skipping weather convert stage: {}".format(err))
+		return(results)
+
+	wunder_files = []
+	for day_num in range(min(max(sizes) // 1000, 365)):
+		day = datetime.date(2022, 1, 1) + datetime.timedelta(days=day_num)
+		wunder_files.append(generate_wunder_csv(
+			os.path.join(work_dir, "{}.csv".format(day.isoformat())), seed + day_num))
+
+	wthr_out_dir = os.path.join(work_dir, "weather_data") + '/'
+	os.makedirs(wthr_out_dir, exist_ok=True)
+
+	# Same as the bulk wunderground update: convert each file and write it out
+	def weather_stage():
+		for wunder_file in wunder_files:
+			wunder_data = Weather().wunderground_convert(wunder_file)
+			Weather().write_daily_to_csv(wunder_data, wthr_out_dir)
+	results['weather_convert'] = {str(len(wunder_files)): _measure(weather_stage,
+																	with_memory)}
+
+	return(results)
+
+
+def run_wunder_year(work_dir, workers=None, seed=1090):
+	'''Files per second converting a made up year of wunderground CSVs, one
+	file at a time the old way and with the batch converter'''
+	from Weather import Weather, wunderground_convert_dir
+
+	wunder_dir = os.path.join(work_dir, "wunder_year")
+	os.makedirs(wunder_dir, exist_ok=True)
+	for day_num in range(365):
+		day = datetime.date(2022, 1, 1) + datetime.timedelta(days=day_num)
+		generate_wunder_csv(os.path.join(wunder_dir, "{}.csv".format(day.isoformat())),
+							seed + day_num)
+
+	out_dir = os.path.join(work_dir, "wunder_year_out") + '/'
+	os.makedirs(out_dir, exist_ok=True)
+
+	def one_at_a_time():
+		for file_name in sorted(os.listdir(wunder_dir)):
+			wunder_data = Weather().wunderground_convert(os.path.join(wunder_dir, file_name))
+			Weather().write_daily_to_csv(wunder_data, out_dir)
+
+	results = {'per_file': 365 / _measure(one_at_a_time, False)['seconds']}
+	for n_workers in sorted(set([1, workers or os.cpu_count() or 1])):
+		seconds = _measure(lambda: wunderground_convert_dir(wunder_dir, out_dir, n_workers),
+						   False)['seconds']
+		results['batch_{}_workers'.format(n_workers)] = 365 / seconds
+	return(results)
+
+
+def _rows_post_process(hex_state, csv_path):
+	'''The parser's post-processing the way it was done on lists of rows,
+	kept here to compare the frame against'''
+	from CallsignResolver import get_resolver
+	resolver = get_resolver()
+	rows = []
+	for hex_code, (head, fills, last) in hex_state.items():
+		entry = [hex_code, head[0].replace('/', '-'), head[1].split('.')[0],
+				 head[2] if head[2] != '' else 'NA', head[3], head[4], head[5]]
+		for pos, empty in enumerate(['', '', 'NA', '', '', '']):
+			if fills[pos] != '' and entry[pos + 1] == empty:
+				entry[pos + 1] = fills[pos].strip() if pos == 2 else fills[pos]
+		rows.append(entry)
+	for row in rows:
+		row.append(resolver.airline_code(str(row[3])))
+	for row in rows:
+		row.append(str(row[2].split(":")[0]) + ":00:00")
+	with open(csv_path, 'w', newline='') as csv_out:
+		data_writer = csv.writer(csv_out, delimiter=',')
+		for row in rows:
+			data_writer.writerow(row)
+	return(rows)
+
+
+def run_frame_day(work_dir, n_aircraft=20000, seed=1090):
+	'''Post-processing a day's worth of parsed aircraft as lists of rows and as
+	a FlightFrame: seconds and the memory the result holds on to'''
+	from TenNinty import _partial_hex_state
+
+	feed_path = os.path.join(work_dir, "live_raw_2022_06_22_000000")
+	generate_sbs_feed(feed_path, n_aircraft * 20, n_aircraft=n_aircraft, seed=seed)
+	with open(feed_path, newline='') as feed_in:
+		hex_state = _partial_hex_state(csv.reader(feed_in, delimiter=','))
+	out_path = os.path.join(work_dir, "frame_day.csv")
+
+	def frame_post_process():
+		parser = TenNinty_Parser(feed_path, load_raw=False)
+		parser._apply_hex_state(hex_state)
+		parser.frame.write_csv(out_path)
+		return(parser.frame)
+
+	results = {'aircraft': len(hex_state)}
+	for name, stage_fn in [('rows', lambda: _rows_post_process(hex_state, out_path)),
+						   ('frame', frame_post_process)]:
+		# Once first so the callsign cache is warm for both
+		stage_fn()
+		result = _measure(stage_fn, False)
+		tracemalloc.start()
+		kept = stage_fn()
+		result['kept_bytes'] = tracemalloc.get_traced_memory()[0]
+		tracemalloc.stop()
+		del kept
+		results[name] = result
+	return(results)
+
+
+def print_table(results):
+	'''Print the results as a table'''
+	print("{:<16}{:>12}{:>14}{:>16}".format("stage", "size", "seconds", "peak MB"))
+	for stage, by_size in results.items():
+		for size, result in by_size.items():
+			peak = result.get('peak_bytes')
+			print("{:<16}{:>12}{:>14.4f}{:>16}".format(
+				stage, size, result['seconds'],
+				'-' if peak is None else "{:.2f}".format(peak / 1048576.0)))
+
+
+def compare_to_baseline(results, baseline, threshold):
+	'''Return a list of regressions, one string per slow stage and size'''
+	regressions = []
+	for stage, by_size in results.items():
+		for size, result in by_size.items():
+			base = baseline.get(stage, dict()).get(size)
+			if base is None:
+				continue
+			limit = base['seconds'] * (1 + threshold)
+			if result['seconds'] > limit:
+				regressions.append("{} @ {}: {:.4f}s > {:.4f}s (baseline {:.4f}s)".format(
+					stage, size, result['seconds'], limit, base['seconds']))
+	return(regressions)
+
+
+######## Entry #########
+if __name__ == "__main__":
+	arg_parser = argparse.ArgumentParser(description="ADSB pipeline benchmarks")
+	arg_parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000],
+							help="Messages per run, e.g. 10000 100000 1000000 10000000")
+	arg_parser.add_argument('--aircraft', type=int, default=200)
+	arg_parser.add_argument('--seed', type=int, default=1090)
+	arg_parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+	arg_parser.add_argument('--save-baseline', action='store_true')
+	arg_parser.add_argument('--threshold', type=float, default=0.25,
+							help="Allowed slow down compared to the baseline")
+	arg_parser.add_argument('--no-memory', action='store_true',
+							help="Skip the tracemalloc pass")
+	arg_parser.add_argument('--wunder-year', action='store_true',
+							help="Also time converting a year of wunderground files")
+	arg_parser.add_argument('--frame-day', type=int, default=None, metavar='AIRCRAFT',
+							help="Also compare row lists and FlightFrame for a day of "
+							"this many aircraft")
+	arg_parser.add_argument('--output', default=None,
+							help="Also write the results to this JSON file")
+	args = arg_parser.parse_args()
+
+	with tempfile.TemporaryDirectory() as bench_dir:
+		bench_results = run_benchmarks(args.sizes, bench_dir, not args.no_memory,
+									   args.aircraft, args.seed)
+		if args.wunder_year:
+			year_results = run_wunder_year(bench_dir, seed=args.seed)
+		if args.frame_day:
+			frame_results = run_frame_day(bench_dir, args.frame_day, args.seed)
+	print_table(bench_results)
+
+	if args.frame_day:
+		print("\nPost-processing {} aircraft".format(frame_results['aircraft']))
+		for method in ['rows', 'frame']:
+			print("{:<20}{:>12.4f} s{:>12.2f} MB kept".format(
+				method, frame_results[method]['seconds'],
+				frame_results[method]['kept_bytes'] / 1048576.0))
+
+	if args.wunder_year:
+		print("\nWunderground year (365 files)")
+		for method, files_per_sec in year_results.items():
+			print("{:<20}{:>12.0f} files/sec".format(method, files_per_sec))
+
+	if args.output:
+		with open(args.output, 'w') as json_out:
+			json.dump(bench_results, json_out, indent=2)
+
+	if args.save_baseline:
+		os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+		with open(args.baseline, 'w') as json_out:
+			json.dump(bench_results, json_out, indent=2)
+		print("Saved baseline to {}".format(args.baseline))
+
+	elif os.path.exists(args.baseline):
+		with open(args.baseline, 'r') as json_in:
+			found = compare_to_baseline(bench_results, json.load(json_in), args.threshold)
+		if found:
+			print("Performance regressions:")
+			for regression in found:
+				print("  " + regression)
+			sys.exit(1)
+		print("No regressions against {}".format(args.baseline))
@@ -0,0 +1,120 @@
+################################################################################
+# CallsignCatalog.py
+# @author: Ryan Herrin
+#
+# Deduplicated list of every callsign (Airline column) we've seen with how many
+# times, and the first and last day it was seen. It is updated as each
+# processed file is written so nothing has to rescan the processed data to get
+# the distinct list or the most popular callsigns.
+################################################################################
+
+'''
+Files:
+------------------
+callsign_catalog.csv        : Callsign, Count, FirstSeen, LastSeen. Sorted by
+                              count so the top-N is the first N rows
+callsign_catalog_files.json : Counts each processed file added, so writing a
+                              file again (bulk update) replaces its counts
+                              instead of adding them twice
+
+Build it from scratch: python CallsignCatalog.py <processed dir> <catalog csv>
+'''
+
+import os
+import csv
+import sys
+import json
+
+
+CATALOG_HEADER = ["Callsign", "Count", "FirstSeen", "LastSeen"]
+
+
+class CallsignCatalog:
+	"""Callsign counts and first/last seen dates, kept up to date one processed
+	file at a time"""
+	def __init__(self, catalog_path):
+		self.catalog_path = catalog_path
+		self.files_path = os.path.splitext(catalog_path)[0] + '_files.json'
+		self.callsigns = dict() # callsign -> [count, first seen, last seen]
+		self.file_counts = dict() # processed file -> {callsign: count}
+		self._load()
+
+	def _load(self):
+		if os.path.exists(self.catalog_path):
+			with open(self.catalog_path, newline='') as csvfile:
+				catalog_reader = csv.reader(csvfile, delimiter=',')
+				catalog_reader.__next__() # Skip the header
+				for row in catalog_reader:
+					self.callsigns[row[0]] = [int(row[1]), row[2], row[3]]
+
+		if os.path.exists(self.files_path):
+			with open(self.files_path, 'r') as json_in:
+				self.file_counts = json.load(json_in)
+
+	def update_from_rows(self, file_name, rows):
+		"""Add the Airline (col 7) counts of one processed file. If the file was
+		added before, its old counts are taken back out first."""
+		new_counts = dict()
+		for row in rows:
+			# Skip the header if it's there
+			if row[0] == 'HexCode':
+				continue
+			callsign = row[7]
+			new_counts[callsign] = new_counts.get(callsign, 0) + 1
+
+			seen_date = row[1]
+			entry = self.callsigns.get(callsign)
+			if entry is None:
+				self.callsigns[callsign] = [0, seen_date, seen_date]
+			else:
+				if seen_date and (entry[1] == '' or seen_date < entry[1]):
+					entry[1] = seen_date
+				if seen_date > entry[2]:
+					entry[2] = seen_date
+
+		for callsign, count in self.file_counts.get(file_name, dict()).items():
+			if callsign in self.callsigns:
+				self.callsigns[callsign][0] -= count
+
+		for callsign, count in new_counts.items():
+			self.callsigns[callsign][0] += count
+
+		self.file_counts[file_name] = new_counts
+
+	def save(self):
+		"""Write the catalog and the per-file counts back out"""
+		with open(self.catalog_path, 'w', newline='') as csv_out:
+			data_writer = csv.writer(csv_out, delimiter=',')
+			data_writer.writerow(CATALOG_HEADER)
+			for callsign, entry in self._sorted():
+				data_writer.writerow([callsign] + entry)
+
+		with open(self.files_path, 'w') as json_out:
+			json.dump(self.file_counts, json_out)
+
+	def _sorted(self):
+		return(sorted(self.callsigns.items(), key=lambda item: (-item[1][0], item[0])))
+
+	def get_callsigns(self):
+		"""Distinct callsigns"""
+		return([callsign for callsign, entry in self.callsigns.items() if entry[0] > 0])
+
+	def top(self, n):
+		"""The n most seen callsigns as (callsign, count)"""
+		return([(callsign, entry[0]) for callsign, entry in self._sorted()[:n]])
+
+
+def build_catalog(processed_dir, catalog_path):
+	"""Build the catalog from every processed file in a directory"""
+	catalog = CallsignCatalog(catalog_path)
+	for file_name in sorted(os.listdir(processed_dir)):
+		if not file_name.endswith('.csv'):
+			continue
+		with open(os.path.join(processed_dir, file_name), newline='') as csvfile:
+			catalog.update_from_rows(file_name, csv.reader(csvfile, delimiter=','))
+	catalog.save()
+	return(catalog)
+
+
+if __name__ == "__main__":
+	build_catalog(sys.argv[1], sys.argv[2])
@@ -0,0 +1,168 @@
+################################################################################
+# CallsignResolver.py
+# @author: Ryan Herrin
+#
+# Turns a flight number (FDX1359, N616MR, TORO84...) into the airline code we
+# store in the Airline column, plus the airline name and what kind of flight
+# it is. The airline list in etc/ is loaded once into a prefix index and every
+# distinct flight number is only worked out once.
+################################################################################
+
+'''
+Categories:
+------------------
+airline      : Prefix is an ICAO designator from etc/AirlineCallsigns.csv
+private      : US N-number (N616MR)
+military     : Known military callsign (RCH, TORO, SPAR...). See
+               etc/MilitaryCallsignList-APR09.pdf for the full list
+registration : Flying on a foreign registration (CGZPU, XAMYM, VPCKL)
+other        : Has a letter prefix we don't know about
+unknown      : Empty or NA
+
+The airline code follows the same rules _add_callsign always used so the
+processed files and the DB don't change: the leading letters if there are at
+least two, "Private" for N-numbers, otherwise "NA".
+'''
+
+import os
+import csv
+
+
+AIRLINE_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'etc',
+						   'AirlineCallsigns.csv')
+
+# Military callsigns seen over the area, from the military callsign list
+MILITARY_CALLSIGNS = [
+	"RCH", "CNV", "PAT", "SAM", "SPAR", "EVAC", "TORO", "RANGR", "SHOOT", "COOL",
+	"CARBN", "SPIKR", "ROPER", "RONIN", "RANDY", "BARKY", "HMRHD", "SNTRY",
+	"VADER", "REBEL", "GRZLY", "WARHMR", "BOXER", "COBRA", "GHOST", "SKULL",
+	"HAGAR", "MADCAT", "VANDY", "CARNL", "DICEY", "SHARK", "RAIDR", "TUNDRA",
+	"OUTLW", "EMBER", "CHAOS", "TRICK", "ARCAT", "IRON", "KING", "BLUES",
+	]
+
+# Nationality marks for aircraft flying on their registration instead of a
+# flight number
+REGISTRATION_PREFIXES = [
+	"C", "XA", "XB", "XC", "VP", "VQ", "G", "D", "F", "HP", "HK", "TG", "YV",
+	]
+
+
+class _PrefixTrie:
+	'''Small character trie that finds the longest stored prefix of a string'''
+	def __init__(self):
+		self.root = dict()
+
+	def insert(self, key, value):
+		node = self.root
+		for char in key:
+			node = node.setdefault(char, dict())
+		node[None] = value
+
+	def longest_prefix(self, text):
+		'''Returns (prefix, value) for the longest stored prefix of text, or
+		(None, None) if there isn't one'''
+		node = self.root
+		found = (None, None)
+		for pos, char in enumerate(text):
+			node = node.get(char)
+			if node is None:
+				break
+			if None in node:
+				found = (text[:pos + 1], node[None])
+		return(found)
+
+
+class CallsignResolver:
+	'''Looks up airline codes, names and categories for flight numbers'''
+	def __init__(self, airline_csv=AIRLINE_CSV):
+		self.airlines = dict() # ICAO designator -> airline name
+		self.airline_trie = _PrefixTrie()
+		self.military = set(MILITARY_CALLSIGNS)
+		self.registration_trie = _PrefixTrie()
+		self._cache = dict() # flight number -> (code, name, category)
+
+		self._load_airlines(airline_csv)
+		for reg_prefix in REGISTRATION_PREFIXES:
+			self.registration_trie.insert(reg_prefix, reg_prefix)
+
+	def _load_airlines(self, airline_csv):
+		try:
+			with open(airline_csv, newline='') as csvfile:
+				airline_reader = csv.reader(csvfile, delimiter=',')
+				airline_reader.__next__() # Skip the header
+				for row in airline_reader:
+					if len(row) < 2:
+						continue
+					designator = row[0].strip().upper()
+					self.airlines[designator] = row[1].strip()
+					self.airline_trie.insert(designator, designator)
+
+		except Exception as err:
+			print("Could not open airline callsign file: ")
+			print(str(err))
+
+	def resolve(self, flight_num):
+		'''Returns (airline code, airline name, category) for a flight number.
+		The airline name is '' when we don't know it.'''
+		resolved = self._cache.get(flight_num)
+		if resolved is None:
+			resolved = self._resolve(str(flight_num))
+			self._cache[flight_num] = resolved
+		return(resolved)
+
+	def airline_code(self, flight_num):
+		'''Just the value for the Airline column'''
+		return(self.resolve(flight_num)[0])
+
+	def airline_name(self, airline_code):
+		return(self.airlines.get(airline_code, ''))
+
+	def _resolve(self, flight_num):
+		if flight_num == '' or flight_num == 'NA':
+			return(('NA', '', 'unknown'))
+
+		# Leading letters, e.g. FDX out of FDX1359
+		prefix = ''
+		if len(flight_num) > 1:
+			for letter in flight_num:
+				if letter.isalpha():
+					prefix = prefix + letter
+				else:
+					break
+
+		if len(prefix) > 1:
+			code = prefix
+		elif flight_num[0] == "N":
+			return(('Private', '', 'private'))
+		else:
+			return(('NA', '', 'other'))
+
+		# Exact designator first, then the longest known prefix
+		if code in self.airlines:
+			return((code, self.airlines[code], 'airline'))
+		if code in self.military:
+			return((code, '', 'military'))
+
+		stripped = flight_num.strip()
+		reg_prefix, found = self.registration_trie.longest_prefix(stripped)
+		if reg_prefix is not None and stripped.isalpha() and len(stripped) == 5:
+			return((code, '', 'registration'))
+
+		designator, found = self.airline_trie.longest_prefix(code)
+		if designator is not None and len(designator) == 3 and len(code) > 3:
+			# Extra letters after a designator, e.g. a letter suffix
+			return((code, self.airlines[designator], 'airline'))
+
+		return((code, '', 'other'))
+
+
+_shared_resolver = None
+
+
+def get_resolver():
+	'''Resolver shared by the parser and the query code, so the airline list
+	is only loaded once per process'''
+	global _shared_resolver
+	if _shared_resolver is None:
+		_shared_resolver = CallsignResolver()
+	return(_shared_resolver)
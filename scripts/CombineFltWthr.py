@@ -10,6 +10,30 @@
 
 import os
 import csv
+import heapq
+import bisect
+import argparse
+import datetime
+import Partitions
+from Metrics import Metrics
+from FlightKeys import flight_key
+
+
+# Stage timers and counters (read, join, write) for the run
+combine_metrics = Metrics('combine')
+
+FULL_HEADER = [
+	"HexCode", "Date", "Time", "FlightNumber", "Alt", "GroundSpeed",
+	"Squawk", "Airline", "Weekday", "BarometricPressure", "Temp", 
+	"WindSpeed", "WindDirection", "Raining", "FlightKey"
+	]
+
+# Ways flights can be matched to weather. "hour" is the original join on
+# NearestHour, the others match on the full timestamp (see asof_index)
+JOIN_MODES = ['hour', 'nearest', 'backward']
+
+# Weather column with the time the observation was taken (Weather.WEATHER_HEADER)
+_OBS_TIME = 8
 
 
 def get_p_flt_data_by_day(flt_data_loc, day):
@@ -17,12 +41,8 @@ def get_p_flt_data_by_day(flt_data_loc, day):
 	will be returned. (Flight Data)
 	"""
 	# Find all csv files for the specified day
-	file_lst = os.listdir(flt_data_loc)
-	csv_lst = []
-	
-	for file in file_lst:
-		if day in file:
-			csv_lst.append(file)
+	day = _normalize_day(day)
+	csv_lst = _day_files(flt_data_loc, day, day).get(day, [])
 			
 	# Extracted data
 	p_flt_data = []
@@ -30,7 +50,8 @@ def get_p_flt_data_by_day(flt_data_loc, day):
 	# Read in the chosen csv files and create one large list for the day
 	for csv_file in csv_lst:
 		try:
-			with open(flt_data_loc + '/' + csv_file, newline='') as csvfile:
+			with combine_metrics.stage('read'), \
+					open(csv_file, newline='') as csvfile:
 				# CSV reader that seperated by commas
 				flt_reader = csv.reader(csvfile, delimiter=',')
 				flt_reader.__next__() # Skip the header 
@@ -44,6 +65,7 @@ def get_p_flt_data_by_day(flt_data_loc, day):
 			print("Could not open CSV file: ")
 			print(str(err))	
 	
+	combine_metrics.count('flight_rows', len(p_flt_data))
 	return(p_flt_data)
 
 def get_weather_data_by_day(wthr_data_loc, day):
@@ -68,7 +90,8 @@ def get_weather_data_by_day(wthr_data_loc, day):
 	# Read in the chosen csv files and create one large list for the day
 	for csv_file in csv_lst:
 		try:
-			with open(wthr_data_loc + '/' + csv_file, newline='') as csvfile:
+			with combine_metrics.stage('read'), \
+					open(wthr_data_loc + '/' + csv_file, newline='') as csvfile:
 				# CSV reader that seperated by commas
 				day_reader = csv.reader(csvfile, delimiter=',')
 				day_reader.__next__() # Skip the header 
@@ -86,6 +109,8 @@ def get_weather_data_by_day(wthr_data_loc, day):
 	
 def get_active_days(flt_data_path):
 	"""Parse through the directory and find all days that have data"""
+	if Partitions.is_partitioned(flt_data_path):
+		return(Partitions.active_days(flt_data_path))
 	file_lst = os.listdir(flt_data_path)
 	# Create a set of dates to store dates and eliminate duplicates 
 	date_set = set()
@@ -98,49 +123,299 @@ def get_active_days(flt_data_path):
 		
 	return(date_set)
 	
-def combine_flt_and_wthr(flt_data, wthr_data):
+def combine_flt_and_wthr(flt_data, wthr_data, mode='hour', tolerance_minutes=60):
 	"""Combine the flight data and weather data to create one large all inclusive 
 	dataset (terms and conditions may apply).
 	This function is going to take us for a ride so hold on. 
+	mode is one of JOIN_MODES. For nearest / backward a flight with no
+	observation within tolerance_minutes is left out.
 	"""
 	# Okay lets do this....
 	combined_list = []
+	flt_data = list(_unique_flights(flt_data))
 	
 	# For structual integrity make sure the num of rows read in from the flight data
 	# is the same number of rows created and returned
 	flt_data_len = len(flt_data)
 
-	# Iterate through each row of the flight data 
-	for flight_row in flt_data:
-		# Iterate through each row of weather
-		for weather_row in wthr_data:
-			if flight_row[8] == weather_row[1]:
-				tmp_lst = [
-					flight_row[0], 	# HexCode
-					flight_row[1], 	# Date 
-					flight_row[2], 	# Time
-					flight_row[3], 	# FlightNumber
-					flight_row[4], 	# Alt
-					flight_row[5],	# GroundSpeed
-					flight_row[6],	# Squawk
-					flight_row[7], 	# Airline
-					weather_row[2], # Weekday
-					weather_row[3], # BarometricPressure
-					weather_row[4], # Temp
-					weather_row[5], # WindSpeed
-					weather_row[6], # WindDirection
-					weather_row[7], # Raining
-					]
-				combined_list.append(tmp_lst)
+	with combine_metrics.stage('join'):
+		if mode == 'hour':
+			_join_on_hour(flt_data, wthr_data, combined_list)
+		else:
+			_join_as_of(flt_data, wthr_data, combined_list, mode, tolerance_minutes)
+	combine_metrics.count('joined_rows', len(combined_list))
 				
-	# Check to make sure the same number that went in is the same going out
+	# Check to make sure the same number that went in is the same going out.
+	# The timestamp joins leave out flights with no weather close enough.
+	if mode != 'hour':
+		combine_metrics.count('unmatched_rows', flt_data_len - len(combined_list))
+		return(combined_list)
 	if len(combined_list) == flt_data_len:
 		return(combined_list)
 	else:
 		print("Integrity Error. List Mismatch detected...")
+
+def _join_on_hour(flt_data, wthr_data, combined_list):
+	"""Does the joining for combine_flt_and_wthr"""
+	# Iterate through each row of the flight data 
+	for flight_row in flt_data:
+		# Iterate through each row of weather
+		for weather_row in wthr_data:
+			if flight_row[8] == weather_row[1]:
+				combined_list.append(_combined_row(flight_row, weather_row))
+
+def _row_seconds(date, time, day_starts):
+	"""Seconds since 0001-01-01 for a "YYYY-MM-DD" date and "HH:MM:SS" time.
+	day_starts caches the start of each date since there are only a few."""
+	day_start = day_starts.get(date)
+	if day_start is None:
+		day_start = datetime.date(int(date[:4]), int(date[5:7]),
+								  int(date[8:10])).toordinal() * 86400
+		day_starts[date] = day_start
+	return(day_start + int(time[:2]) * 3600 + int(time[3:5]) * 60 + int(time[6:8]))
+
+def _obs_time(weather_row):
+	"""When a weather row was observed. Files written before there was an
+	ObsTime column only have the hour."""
+	if len(weather_row) > _OBS_TIME and weather_row[_OBS_TIME] != '':
+		return(weather_row[_OBS_TIME])
+	return(weather_row[1])
+
+def asof_index(wthr_data, day_starts=None):
+	"""Sort the weather rows by the date and time they were observed for
+	asof_match. Returns (times, rows)."""
+	day_starts = dict() if day_starts is None else day_starts
+	timed = sorted(((_row_seconds(row[0], _obs_time(row), day_starts), row)
+					for row in wthr_data), key=lambda timed_row: timed_row[0])
+	return([when for when, row in timed], [row for when, row in timed])
+
+def asof_match(times, rows, when, tolerance, mode='nearest'):
+	"""The weather row for a flight at when (seconds): the closest one for
+	nearest, the latest one at or before it for backward. None if there isn't
+	one within tolerance seconds. Ties go to the earlier observation."""
+	pos = bisect.bisect_right(times, when)
+	best = None
+	if pos > 0 and when - times[pos - 1] <= tolerance:
+		best = pos - 1
+	if mode == 'nearest' and pos < len(times) and times[pos] - when <= tolerance:
+		if best is None or times[pos] - when < when - times[best]:
+			best = pos
+	return(None if best is None else rows[best])
+
+def _join_as_of(flt_data, wthr_data, combined_list, mode, tolerance_minutes):
+	"""Does the timestamp joining for combine_flt_and_wthr. Sorting the
+	weather is O(W log W) and each flight is one bisect, O(F log W)."""
+	day_starts = dict()
+	times, rows = asof_index(wthr_data, day_starts)
+	tolerance = tolerance_minutes * 60
+	for flight_row in flt_data:
+		weather_row = asof_match(times, rows, _row_seconds(flight_row[1], flight_row[2],
+														   day_starts), tolerance, mode)
+		if weather_row is not None:
+			combined_list.append(_combined_row(flight_row, weather_row))
+
+def _combined_row(flight_row, weather_row):
+	"""Build one row of the combined data"""
+	return([
+		flight_row[0], 	# HexCode
+		flight_row[1], 	# Date 
+		flight_row[2], 	# Time
+		flight_row[3], 	# FlightNumber
+		flight_row[4], 	# Alt
+		flight_row[5],	# GroundSpeed
+		flight_row[6],	# Squawk
+		flight_row[7], 	# Airline
+		weather_row[2], # Weekday
+		weather_row[3], # BarometricPressure
+		weather_row[4], # Temp
+		weather_row[5], # WindSpeed
+		weather_row[6], # WindDirection
+		weather_row[7], # Raining
+		_flight_key(flight_row), # FlightKey
+		])
+
+def _flight_key(flight_row):
+	"""FlightKey of a processed row. Files processed before there were keys
+	get one from the hex and the time."""
+	if len(flight_row) > 9:
+		return(flight_row[9])
+	return(flight_key(flight_row[0], flight_row[1] + ' ' + flight_row[2]))
+
+def _unique_flights(flt_rows):
+	"""Leave out any row whose flight (FlightKey) was already seen, so a
+	flight is never counted twice"""
+	seen = set()
+	for flight_row in flt_rows:
+		key = _flight_key(flight_row)
+		if key in seen:
+			combine_metrics.count('duplicate_rows')
+			continue
+		seen.add(key)
+		yield flight_row
+
+def _finish_file(csv_path):
+	"""Put a file written to <csv_path>.tmp in place, unless it came out the
+	same as before, so unchanged days keep their time and aren't loaded again"""
+	if not Partitions.replace_if_changed(csv_path + '.tmp', csv_path):
+		combine_metrics.count('unchanged_files')
+
+def _iter_csv_rows(csv_path):
+	"""Yield the rows of a csv file one at a time, skipping the header"""
+	with open(csv_path, newline='') as csvfile:
+		csv_reader = csv.reader(csvfile, delimiter=',')
+		csv_reader.__next__() # Skip the header 
+		for row in csv_reader:
+			yield row
+
+def _normalize_day(day):
+	"""Accept YYYY-MM-DD or YYYY_MM_DD and return YYYY_MM_DD"""
+	return(day.replace('-', '_'))
+
+def _day_files(flt_data_loc, start=None, end=None):
+	"""{day: [processed files]} for the days between start and end (YYYY_MM_DD).
+	Works on the flat directory or the year=/month=/day=/hour= layout, where
+	only the partitions in range are listed."""
+	day_files = dict()
+	if Partitions.is_partitioned(flt_data_loc):
+		for hour_start, hour_dir in Partitions.iter_partitions(flt_data_loc, start, end):
+			day = hour_start.strftime("%Y_%m_%d")
+			day_files.setdefault(day, []).extend(
+				hour_dir + '/' + file for file in sorted(os.listdir(hour_dir))
+				if file.endswith('.csv'))
+		return(day_files)
+
+	# Processed file names start with the day, so sorting them sorts by time
+	for file in sorted(os.listdir(flt_data_loc)):
+		if not file.endswith('.csv'):
+			continue
+		day = file[:10]
+		if start is not None and day < start:
+			continue
+		if end is not None and day > end:
+			continue
+		day_files.setdefault(day, []).append(flt_data_loc + '/' + file)
+	return(day_files)
+
+def iter_flt_days(flt_data_loc, start=None, end=None):
+	"""Yield (day, rows) for every day with flight data between start and end 
+	(inclusive). rows is an iterator over that day's processed files merged in 
+	time order, so only one row per file is held in memory at a time."""
+	start = None if start is None else _normalize_day(start)
+	end = None if end is None else _normalize_day(end)
+
+	day_files = _day_files(flt_data_loc, start, end)
+
+	for day in sorted(day_files):
+		streams = [_iter_csv_rows(path) for path in day_files[day]]
+		yield(day, heapq.merge(*streams, key=lambda row: (row[1], row[2])))
+
+def _neighbour_days(day):
+	"""The days either side of a YYYY_MM_DD day"""
+	date = datetime.datetime.strptime(day, "%Y_%m_%d")
+	return([(date + datetime.timedelta(days=offset)).strftime("%Y_%m_%d")
+			for offset in (-1, 1)])
+
+def stream_combine(flt_data_loc, wthr_data_loc, output_loc, header, start=None,
+				   end=None, output_file=None, partitioned=False, mode='hour',
+				   tolerance_minutes=60):
+	"""Out-of-core version of the combine step. Flight rows are streamed day by
+	day in time order and joined against that day's weather (at most a day of
+	weather rows in memory), and every row is written out as soon as it's 
+	joined. Writes one <day>_full.csv per day, or everything into output_file 
+	if it is set. With partitioned each day's file is split into the hour
+	partitions under output_loc. mode and tolerance_minutes are the same as
+	for combine_flt_and_wthr. Returns (flight rows read, rows written)."""
+	day_starts = dict()
+	tolerance = tolerance_minutes * 60
+	rows_in = 0
+	rows_out = 0
+	single_out = None
+	single_writer = None
+
+	if output_file is not None:
+		single_out = open(output_file, 'w', newline='')
+		single_writer = csv.writer(single_out, delimiter=',')
+		single_writer.writerow(header)
+
+	try:
+		for day, flt_rows in iter_flt_days(flt_data_loc, start, end):
+			# Weather for the day keyed by the hour it was taken
+			wthr_by_hour = dict()
+			if mode == 'hour':
+				for weather_row in get_weather_data_by_day(wthr_data_loc, day):
+					wthr_by_hour.setdefault(weather_row[1], []).append(weather_row)
+			else:
+				# Flights near midnight can be closest to the next or last day's weather
+				day_weather = get_weather_data_by_day(wthr_data_loc, day)
+				for other_day in _neighbour_days(day):
+					day_weather += get_weather_data_by_day(wthr_data_loc, other_day)
+				times, rows = asof_index(day_weather, day_starts)
+
+			day_out = None
+			day_path = None
+			data_writer = single_writer
+			curr_hour = None
+			if single_writer is None and not partitioned:
+				day_path = output_loc + '/' + day + '_full.csv'
+				print("Creating CSV file: {}".format(day_path))
+				day_out = open(day_path + '.tmp', 'w', newline='')
+				data_writer = csv.writer(day_out, delimiter=',')
+				data_writer.writerow(header)
+
+			try:
+				day_in = 0
+				day_written = 0
+				with combine_metrics.stage('join'):
+					for flight_row in _unique_flights(flt_rows):
+						day_in += 1
+						if partitioned and single_writer is None:
+							# Rows come in time order, so each hour's file is
+							# finished before the next one is started
+							row_hour = Partitions.row_hour(flight_row)
+							if day_out is None or row_hour != curr_hour:
+								if day_out is not None:
+									day_out.close()
+									_finish_file(day_path)
+								curr_hour = row_hour
+								day_path = Partitions.hour_dir(output_loc, row_hour) + \
+									'/' + day + '_full.csv'
+								day_out = open(day_path + '.tmp', 'w', newline='')
+								data_writer = csv.writer(day_out, delimiter=',')
+								data_writer.writerow(header)
+						if mode != 'hour':
+							weather_row = asof_match(times, rows, _row_seconds(
+								flight_row[1], flight_row[2], day_starts), tolerance, mode)
+							if weather_row is not None:
+								data_writer.writerow(_combined_row(flight_row, weather_row))
+								day_written += 1
+							continue
+						for weather_row in wthr_by_hour.get(flight_row[8], ()):
+							data_writer.writerow(_combined_row(flight_row, weather_row))
+							day_written += 1
+			finally:
+				if day_out is not None:
+					day_out.close()
+					_finish_file(day_path)
+
+			if mode != 'hour':
+				combine_metrics.count('unmatched_rows', day_in - day_written)
+			elif day_written != day_in:
+				print("Integrity Error. {} flight rows, {} combined rows on {}".format(
+					day_in, day_written, day))
+			rows_in += day_in
+			rows_out += day_written
+
+	finally:
+		if single_out is not None:
+			single_out.close()
+
+	combine_metrics.count('flight_rows', rows_in)
+	combine_metrics.count('written_rows', rows_out)
+	return(rows_in, rows_out)
 		
-def write_combined_to_csv(comb_data, write_to_location, day, header):
-	"""Write the combined data to a csv file"""
+def write_combined_to_csv(comb_data, write_to_location, day, header, partitioned=False):
+	"""Write the combined data to a csv file. With partitioned the rows are
+	split into the hour partitions under write_to_location."""
 	# Create file name 
 	csv_file_name = write_to_location + '/' + day + '_full.csv'
 	
@@ -148,13 +423,23 @@ def write_combined_to_csv(comb_data, write_to_location, day, header):
 	
 	# Write out the data to a csv 
 	try:
-		with open(csv_file_name, 'w', newline='') as csv_outfile:
-			data_writer = csv.writer(csv_outfile, delimiter=',')
-			# write the header to the file 
-			data_writer.writerow(header)
-			# Now write out the combined data
-			for row in comb_data:
-				data_writer.writerow(row)
+		if partitioned:
+			with combine_metrics.stage('write'):
+				Partitions.write_partitioned(write_to_location, day + '_full.csv',
+											 comb_data, header)
+			combine_metrics.count('written_rows', len(comb_data))
+			return
+
+		with combine_metrics.stage('write'):
+			with open(csv_file_name + '.tmp', 'w', newline='') as csv_outfile:
+				data_writer = csv.writer(csv_outfile, delimiter=',')
+				# write the header to the file 
+				data_writer.writerow(header)
+				# Now write out the combined data
+				for row in comb_data:
+					data_writer.writerow(row)
+			_finish_file(csv_file_name)
+		combine_metrics.count('written_rows', len(comb_data))
 				
 		print("CSV Created...")
 			
@@ -163,18 +448,57 @@ def write_combined_to_csv(comb_data, write_to_location, day, header):
 	
 ######## Entry #########
 if __name__ == "__main__":
-	flt_data_loc = "Z:/Projects/ADSB-Flight-Freq-Tracker/data/adsb_processed_data"
-	wthr_data_loc = "Z:/Projects/ADSB-Flight-Freq-Tracker/data/weather_data"
-	output_loc = "Z:/Projects/ADSB-Flight-Freq-Tracker/data/combined_data"
+	arg_parser = argparse.ArgumentParser(description="Combine flight and weather data")
+	arg_parser.add_argument('--flights', default=
+		"Z:/Projects/ADSB-Flight-Freq-Tracker/data/adsb_processed_data")
+	arg_parser.add_argument('--weather', default=
+		"Z:/Projects/ADSB-Flight-Freq-Tracker/data/weather_data")
+	arg_parser.add_argument('--output', default=
+		"Z:/Projects/ADSB-Flight-Freq-Tracker/data/combined_data")
+	arg_parser.add_argument('--metrics', default=
+		"Z:/Projects/ADSB-Flight-Freq-Tracker/data/metrics")
+	arg_parser.add_argument('--start', default=None, help="First day, YYYY-MM-DD")
+	arg_parser.add_argument('--end', default=None, help="Last day, YYYY-MM-DD")
+	arg_parser.add_argument('--stream', action='store_true',
+							help="Stream the join so memory stays flat for any range")
+	arg_parser.add_argument('--partitioned', action='store_true',
+							help="Write year=/month=/day=/hour= partitions")
+	arg_parser.add_argument('--join', choices=JOIN_MODES, default='hour',
+							help="hour: match on NearestHour, nearest / backward: "
+							"closest or latest earlier observation by timestamp")
+	arg_parser.add_argument('--tolerance', type=int, default=60,
+							help="Minutes a nearest / backward match can be off by")
+	arg_parser.add_argument('--output-file', default=None,
+							help="With --stream, write the whole range to one file")
+	arg_parser.add_argument('--profile', action='store_true',
+							help="cProfile the run, saved as a .prof in --metrics")
+	arg_parser.add_argument('--trace-memory', action='store_true',
+							help="Record peak memory with tracemalloc")
+	args = arg_parser.parse_args()
+
+	combine_metrics = Metrics('combine', profile=args.profile, trace_memory=args.trace_memory)
+	combine_metrics.start_capture()
+
+	flt_data_loc = args.flights
+	wthr_data_loc = args.weather
+	output_loc = args.output
+	metrics_loc = args.metrics
 	
-	full_header = [
-		"HexCode", "Date", "Time", "FlightNumber", "Alt", "GroundSpeed",
-		"Squawk", "Airline", "Weekday", "BarometricPressure", "Temp", 
-		"WindSpeed", "WindDirection", "Raining"
-		]
+	full_header = FULL_HEADER
 	
+	if args.stream:
+		stream_combine(flt_data_loc, wthr_data_loc, output_loc, full_header,
+					   args.start, args.end, args.output_file, args.partitioned,
+					   args.join, args.tolerance)
+		combine_metrics.write_json(metrics_loc)
+		raise SystemExit(0)
+
 	# Get a list of active days 
 	active_days = get_active_days(flt_data_loc) 
+	if args.start is not None:
+		active_days = [day for day in active_days if day >= _normalize_day(args.start)]
+	if args.end is not None:
+		active_days = [day for day in active_days if day <= _normalize_day(args.end)]
 	
 	for s_date in range(len(active_days)):
 		# Grab the a day from the active days list and create a combined list of that 
@@ -183,10 +507,18 @@ if __name__ == "__main__":
 		# Now grab the weather from that day 
 		wthr_day_data = get_weather_data_by_day(wthr_data_loc, active_days[s_date])
 		# Let's combine the weather and flight data now
-		combined_data = combine_flt_and_wthr(flt_day_data, wthr_day_data)
+		if args.join != 'hour':
+			for other_day in _neighbour_days(active_days[s_date]):
+				wthr_day_data += get_weather_data_by_day(wthr_data_loc, other_day)
+		combined_data = combine_flt_and_wthr(flt_day_data, wthr_day_data, args.join,
+											 args.tolerance)
 
 		try:
 			# Write it out to a csv file 
-			write_combined_to_csv(combined_data, output_loc, active_days[s_date], full_header)
+			write_combined_to_csv(combined_data, output_loc, active_days[s_date], full_header,
+								  args.partitioned)
 		except Exception as err:
 			print("Could not write to CSV...\n"+str(err))
+
+	# Save the timings for this run
+	combine_metrics.write_json(metrics_loc)
@@ -6,21 +6,63 @@
 # Used for creating functions that interacts with the Data Stax Astra DB
 ################################################################################
 
+'''
+Usage:
+------------------
+python DStaxAstraControl.py migrate --creds FILE --zip FILE --from f_data --to f_data_v2
+
+bulk_load_csv needs a table keyed by flight, with every CSV column as text:
+
+    CREATE TABLE flights.f_data_v2 ("HexCode" text, ..., "FlightKey" text,
+                                    PRIMARY KEY ("FlightKey"))
+
+It checks the table first (check_load_table) and stops with what is wrong
+before sending anything. A table from before FlightKey existed (keyed some
+other way, or with int / float columns) is moved over once with migrate:
+it creates the new table from the combined header and copies every old row
+that has a FlightKey, as text. Rows without one are loaded again from the
+combined CSVs with "python Tracker.py load --table f_data_v2".
+'''
+
 import os
+import csv
+import sys
 import json
-#import cassandra
+import argparse
+import threading
+from collections import OrderedDict
 from json import JSONDecodeError
-from cassandra.cluster import Cluster
-from cassandra.auth import PlainTextAuthProvider
+from Metrics import Metrics
+
+
+# Murmur3 tokens (the partitioner Astra uses) run from -2**63 to 2**63 - 1
+MIN_TOKEN = -2 ** 63
+MAX_TOKEN = 2 ** 63 - 1
+
+# Column types bulk_load_csv can bind its CSV strings to
+TEXT_TYPES = ('text', 'varchar', 'ascii')
+
+
+def token_ranges(splits):
+	"""Split the whole token ring into splits (start, end] ranges. The first
+	one starts at MIN_TOKEN itself, see _range_query."""
+	step = (MAX_TOKEN - MIN_TOKEN) // splits
+	bounds = [MIN_TOKEN + step * pos for pos in range(splits)] + [MAX_TOKEN]
+	return([(bounds[pos], bounds[pos + 1]) for pos in range(splits)])
 
 
 class DataStaxAstra:
-	""" Class that connects to a Astra DB and can run commands"""
-	def __init__(self):
+	""" Class that connects to a Astra DB and can run commands. Pass a
+	QueryCache as cache to reuse the pre-defined query results between runs."""
+	def __init__(self, metrics=None, cache=None):
 		self.keyspace = str()
 		self.zip_location = str()
 		self.client_id = str()
 		self.client_secret = str()
+		# Query timer and counter
+		self.metrics = metrics if metrics is not None else Metrics('astra')
+		self.cache = cache
+		self._checked_tables = set()
 
 	def set_secure_zip_location(self, zip_location):
 		"""Set path for the secure zip file"""
@@ -68,6 +110,10 @@ class DataStaxAstra:
 			print("Error: Keyspace has not been set...")
 			return(0)
 
+		# The driver takes a while to import, so only load it when connecting
+		from cassandra.cluster import Cluster
+		from cassandra.auth import PlainTextAuthProvider
+
 		# Create cloud configuration
 		cloud_config = {'secure_connect_bundle':self.zip_location}
 		# Set credintials
@@ -93,10 +139,298 @@ class DataStaxAstra:
 		"""Execute the query on our own terms. Takes in a session, and query, and
 		returns the results. This allows us to also format if wanted"""
 		try:
-			return(session.execute(query))
+			self.metrics.count('queries')
+			with self.metrics.stage('query'):
+				return(session.execute(query))
 		except Exception as err:
 			print(str(err))
 		
+	def bulk_load_csv(self, session, table, csv_path, concurrency=32, ledger=None):
+		"""Insert every row of a combined CSV into a table. The CSV header gives
+		the column names. The table has to have "FlightKey" as its primary key,
+		so an INSERT of a flight that is already there replaces it, and text
+		columns (see check_load_table). With a FlightKeys.LoadLedger only rows
+		that are new or changed since they were last loaded are sent. Returns
+		the number of rows written."""
+		rows_loaded = 0
+		rows_skipped = 0
+		with open(csv_path, newline='') as csvfile:
+			csv_reader = csv.reader(csvfile, delimiter=',')
+			header = csv_reader.__next__()
+			self.check_load_table(session, table, header)
+			from cassandra.concurrent import execute_concurrent_with_args
+			insert = session.prepare(self._insert_query(table, header))
+			key_col = header.index('FlightKey')
+
+			def send(chunk):
+				if ledger is not None:
+					changed = ledger.changed(self._table_name(table), chunk, key_col)
+					skipped = len(chunk) - len(changed)
+					chunk = changed
+				else:
+					skipped = 0
+				if chunk:
+					execute_concurrent_with_args(session, insert, chunk,
+												 concurrency=concurrency)
+					if ledger is not None:
+						ledger.mark(self._table_name(table), chunk, key_col)
+				return(len(chunk), skipped)
+
+			# Send the rows in chunks so the whole file is never in memory
+			chunk = []
+			with self.metrics.stage('load'):
+				for row in csv_reader:
+					chunk.append(row)
+					if len(chunk) >= 1000:
+						sent, skipped = send(chunk)
+						rows_loaded += sent
+						rows_skipped += skipped
+						chunk = []
+				if chunk:
+					sent, skipped = send(chunk)
+					rows_loaded += sent
+					rows_skipped += skipped
+
+		self.metrics.count('rows_loaded', rows_loaded)
+		self.metrics.count('rows_unchanged', rows_skipped)
+		# Anything cached for this table is out of date now
+		if self.cache is not None and rows_loaded:
+			self.cache.invalidate(self._table_name(table))
+		return(rows_loaded)
+
+	def _table_name(self, table):
+		return("{}.{}".format(self.keyspace, table))
+
+	def _insert_query(self, table, header):
+		return("INSERT INTO {}.{} ({}) VALUES ({})".format(
+			self.keyspace, table, ', '.join('"{}"'.format(col) for col in header),
+			', '.join(['?'] * len(header))))
+
+	def _table_meta(self, session, table):
+		"""Cluster metadata of a table, None if it doesn't exist"""
+		keyspace_meta = session.cluster.metadata.keyspaces.get(self.keyspace)
+		if keyspace_meta is None:
+			return(None)
+		return(keyspace_meta.tables.get(table))
+
+	def check_load_table(self, session, table, header):
+		"""Make sure bulk_load_csv can write these CSV columns to the table:
+		"FlightKey" is its whole primary key and every column is there as text.
+		Raises ValueError saying what is wrong otherwise."""
+		if (table, tuple(header)) in self._checked_tables:
+			return
+		table_name = self._table_name(table)
+		if 'FlightKey' not in header:
+			raise ValueError("Can't load into {}: the CSV has no FlightKey column".format(
+				table_name))
+		table_meta = self._table_meta(session, table)
+		if table_meta is None:
+			raise ValueError("Can't load into {}: there is no such table".format(table_name))
+
+		problems = []
+		primary_key = [col.name for col in table_meta.primary_key]
+		if primary_key != ['FlightKey']:
+			problems.append("its primary key is ({}), not (FlightKey)".format(
+				', '.join(primary_key)))
+		missing = [col for col in header if col not in table_meta.columns]
+		if missing:
+			problems.append("it has no {} column(s)".format(', '.join(missing)))
+		not_text = ["{} {}".format(col, table_meta.columns[col].cql_type) for col in header
+					if col in table_meta.columns and
+					table_meta.columns[col].cql_type not in TEXT_TYPES]
+		if not_text:
+			problems.append("the CSV's text can't go in {}".format(', '.join(not_text)))
+		if problems:
+			raise ValueError("Can't load into {}: {}. See migrate in DStaxAstraControl.py "
+							 "to move it to a FlightKey table.".format(table_name,
+																	  '; '.join(problems)))
+		self._checked_tables.add((table, tuple(header)))
+
+	def create_load_table(self, session, table, header):
+		"""Create a table bulk_load_csv can load these CSV columns into"""
+		session.execute("CREATE TABLE IF NOT EXISTS {}.{} ({}, PRIMARY KEY (\"FlightKey\"))".format(
+			self.keyspace, table, ', '.join('"{}" text'.format(col) for col in header)))
+
+	def migrate_load_table(self, session, old_table, new_table, header=None):
+		"""One-off move of a table from before FlightKey existed. Creates
+		new_table keyed by FlightKey with the combined header's columns as text
+		and copies every row of old_table that has a FlightKey into it. Columns
+		the old table doesn't have are left empty. Returns (rows copied, rows
+		without a FlightKey)."""
+		if header is None:
+			from CombineFltWthr import FULL_HEADER
+			header = FULL_HEADER
+		if self._table_meta(session, old_table) is None:
+			raise ValueError("There is no table {} to migrate".format(
+				self._table_name(old_table)))
+		self.create_load_table(session, new_table, header)
+		self.check_load_table(session, new_table, header)
+		insert = session.prepare(self._insert_query(new_table, header))
+
+		copied = 0
+		skipped = 0
+		# The driver pages through the old table as it is read
+		results = session.execute("SELECT * FROM {}.{}".format(self.keyspace, old_table))
+		old_cols = dict((col, pos) for pos, col in enumerate(results.column_names))
+		for row in results:
+			values = ['' if col not in old_cols or row[old_cols[col]] is None
+					  else str(row[old_cols[col]]) for col in header]
+			if not values[header.index('FlightKey')]:
+				skipped += 1
+				continue
+			session.execute(insert.bind(values))
+			copied += 1
+		self.metrics.count('rows_migrated', copied)
+		if self.cache is not None:
+			self.cache.invalidate(self._table_name(new_table))
+		return(copied, skipped)
+
+	def _count(self, session, table, query):
+		"""Run a COUNT(*) query, or take it from the cache if the table hasn't
+		been loaded since it was last run"""
+		run = lambda: self.execute_qry(session, query).all()[0][0]
+		if self.cache is None:
+			return(run())
+		value = self.cache.get(self._table_name(table), query)
+		if value is not None:
+			self.metrics.count('cache_hits')
+			return(value)
+		self.metrics.count('cache_misses')
+		value = run()
+		self.cache.put(self._table_name(table), query, value)
+		return(value)
+
+	############ Export ###########
+	def _partition_key(self, session, table):
+		"""Quoted partition key columns of a table, from the cluster metadata"""
+		table_meta = session.cluster.metadata.keyspaces[self.keyspace].tables[table]
+		return(', '.join('"{}"'.format(col.name) for col in table_meta.partition_key))
+
+	def _range_query(self, table, partition_key, first):
+		return("SELECT * FROM {}.{} WHERE token({}) {} ? AND token({}) <= ?".format(
+			self.keyspace, table, partition_key, '>=' if first else '>', partition_key))
+
+	def _export_range(self, session, statement, range_id, start, end, output_dir,
+					  partitioned, fetch_size, max_open=32):
+		"""Stream one token range to its own CSV (or partition files) as the
+		driver pages through it. Files are written as .tmp and only renamed
+		once the whole range is in, so a failed range leaves nothing behind.
+		Returns the number of rows."""
+		import Partitions
+
+		file_name = 'range_{:05d}.csv'.format(range_id)
+		bound = statement.bind((start, end))
+		bound.fetch_size = fetch_size
+		results = session.execute(bound)
+		header = list(results.column_names)
+
+		# Rows are spread over the ring by hex, so a range can touch every hour
+		# partition. Only max_open files stay open, the rest are reopened to append.
+		open_files = OrderedDict()
+		tmp_paths = dict()
+		rows = 0
+		try:
+			for row in results:
+				row = list(row)
+				out_dir = output_dir
+				if partitioned:
+					out_dir = Partitions.hour_dir(output_dir, Partitions.row_hour(
+						row, header.index('Date'), header.index('Time')))
+				if out_dir in open_files:
+					open_files.move_to_end(out_dir)
+				else:
+					if len(open_files) >= max_open:
+						open_files.popitem(last=False)[1][0].close()
+					started = out_dir in tmp_paths
+					tmp_paths[out_dir] = os.path.join(out_dir, file_name + '.tmp')
+					csv_out = open(tmp_paths[out_dir], 'a' if started else 'w', newline='')
+					data_writer = csv.writer(csv_out, delimiter=',')
+					if not started:
+						data_writer.writerow(header)
+					open_files[out_dir] = (csv_out, data_writer)
+				open_files[out_dir][1].writerow(row)
+				rows += 1
+		except Exception:
+			for csv_out, data_writer in open_files.values():
+				csv_out.close()
+			open_files = dict()
+			for tmp_path in tmp_paths.values():
+				if os.path.exists(tmp_path):
+					os.remove(tmp_path)
+			raise
+		finally:
+			for csv_out, data_writer in open_files.values():
+				csv_out.close()
+
+		for out_dir, tmp_path in tmp_paths.items():
+			os.replace(tmp_path, os.path.join(out_dir, file_name))
+		return(rows)
+
+	def export_table(self, session, table, output_dir, splits=256, workers=8,
+					 partitioned=False, fetch_size=5000, retries=2, partition_key=None):
+		"""Export a whole table by scanning splits token ranges at most workers
+		at a time, each streamed to its own CSV in output_dir (or the
+		year=/month=/day=/hour= partitions with partitioned). Finished ranges are
+		kept in output_dir/export_state.json, so running it again only redoes the
+		ranges that failed. Returns (rows exported, failed range ids).
+		ExportCheck.py checks both against a fake session."""
+		from concurrent.futures import ThreadPoolExecutor
+
+		os.makedirs(output_dir, exist_ok=True)
+		state_path = os.path.join(output_dir, 'export_state.json')
+		state = {'splits': splits, 'done': dict()}
+		if os.path.exists(state_path):
+			with open(state_path, 'r') as json_in:
+				state = json.load(json_in)
+			if state.get('splits') != splits:
+				print("Export state is for {} ranges, not {}. Starting over.".format(
+					state.get('splits'), splits))
+				state = {'splits': splits, 'done': dict()}
+
+		if partition_key is None:
+			partition_key = self._partition_key(session, table)
+		first_query = session.prepare(self._range_query(table, partition_key, True))
+		query = session.prepare(self._range_query(table, partition_key, False))
+		state_lock = threading.Lock()
+
+		def export_one(range_id, start, end):
+			for attempt in range(retries + 1):
+				try:
+					with self.metrics.stage('export_range'):
+						rows = self._export_range(session, first_query if range_id == 0 else query,
+												  range_id, start, end, output_dir, partitioned,
+												  fetch_size)
+					break
+				except Exception as err:
+					print("Range {} failed (attempt {}): {}".format(range_id, attempt + 1, err))
+					self.metrics.count('range_errors')
+			else:
+				return(None)
+			with state_lock:
+				state['done'][str(range_id)] = rows
+				with open(state_path + '.tmp', 'w') as json_out:
+					json.dump(state, json_out)
+				os.replace(state_path + '.tmp', state_path)
+			return(rows)
+
+		todo = [(range_id, start, end) for range_id, (start, end) in
+				enumerate(token_ranges(splits)) if str(range_id) not in state['done']]
+		failed = []
+		with ThreadPoolExecutor(max_workers=workers) as pool:
+			futures = [(range_id, pool.submit(export_one, range_id, start, end))
+					   for range_id, start, end in todo]
+			for range_id, future in futures:
+				if future.result() is None:
+					failed.append(range_id)
+
+		exported = sum(state['done'].values())
+		self.metrics.count('rows_exported', exported)
+		print("Exported {} rows from {} of {} ranges".format(exported, len(state['done']),
+															  splits))
+		if failed:
+			print("{} range(s) failed, run the export again to retry them".format(len(failed)))
+		return(exported, failed)
+
 	############ Pre-Defined Queries ###########
 	# These are predifined queries that can be run once a session has been created.
 	# You will need to pass in the session and table name
@@ -107,8 +441,7 @@ class DataStaxAstra:
 
 	def run_qry_total_rows(self, session, table):
 		query = ("SELECT COUNT(*) FROM {}.{}".format(self.keyspace, table))
-		results = self.execute_qry(session, query)
-		return(results.all()[0][0])
+		return(self._count(session, table, query))
 	
 	def run_qry_flight_per_weekday(self, session, table):
 		days = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday",
@@ -118,7 +451,7 @@ class DataStaxAstra:
 			query_day = ("SELECT COUNT(*) FROM {}.{} ".format(self.keyspace, table) +
 			            "WHERE \"Weekday\" in ('{}') ".format(day) +
 				        "ALLOW FILTERING;")
-			result_dict[day] = self.execute_qry(session, query_day).all()[0][0]
+			result_dict[day] = self._count(session, table, query_day)
 		return(result_dict)
 	
 	def run_qry_flights_by_wind_direction(self, session, table):
@@ -130,7 +463,7 @@ class DataStaxAstra:
 				"WHERE \"WindDirection\" in ('{}') ".format(drctn) +
 				"ALLOW FILTERING;"
 				)
-			result_dict[drctn] = self.execute_qry(session, query).all()[0][0]
+			result_dict[drctn] = self._count(session, table, query)
 		return(result_dict)
 	
 	def run_qry_popular_callsign(self, session, table, callsigns):
@@ -142,22 +475,38 @@ class DataStaxAstra:
 				"WHERE \"Airline\" in ('{}') ".format(cs) +
 				"ALLOW FILTERING;"
 				)
-			result_dict[cs] = self.execute_qry(session, query).all()[0][0]
+			result_dict[cs] = self._count(session, table, query)
 		return(result_dict)
 	############################################
 
 
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+######## Entry #########
+if __name__ == "__main__":
+	arg_parser = argparse.ArgumentParser(description="DataStax Astra tables")
+	sub = arg_parser.add_subparsers(dest='command', required=True)
+	migrate = sub.add_parser('migrate', help="Copy a table into one keyed by FlightKey")
+	migrate.add_argument('--creds', required=True, help="Astra token JSON")
+	migrate.add_argument('--zip', required=True, help="Secure connect bundle")
+	migrate.add_argument('--keyspace', default='flights')
+	migrate.add_argument('--from', dest='old_table', required=True)
+	migrate.add_argument('--to', dest='new_table', required=True)
+	args = arg_parser.parse_args()
+
+	db_conn = DataStaxAstra()
+	db_conn.set_secure_zip_location(args.zip)
+	db_conn.set_json_credintials(args.creds)
+	db_conn.set_keyspace(args.keyspace)
+	db_session = db_conn.create_session()
+	if not db_session:
+		sys.exit(1)
+	try:
+		copied, skipped = db_conn.migrate_load_table(db_session, args.old_table, args.new_table)
+	except ValueError as err:
+		print(str(err))
+		sys.exit(1)
+	finally:
+		db_session.shutdown()
+	print("Copied {} rows to {}.{}".format(copied, args.keyspace, args.new_table))
+	if skipped:
+		print("{} rows had no FlightKey, load them again from the combined CSVs with "
+			  "Tracker.py load --table {}".format(skipped, args.new_table))
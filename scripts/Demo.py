@@ -6,9 +6,9 @@
 # Used to showcase the DB projects
 ################################################################################
 
-import matplotlib.pyplot as plt
 from TenNinty import Callsigns
 from DStaxAstraControl import DataStaxAstra
+from QueryCache import QueryCache
 
 
 # User defined locations and data
@@ -23,21 +23,10 @@ KEYSPACE_NAME = 'n_full'
 TABLE = "f_data"
 '''
 
-# Grab full list of callsigns 
-callsigns = Callsigns().get_callsigns('../data/callsign_data.csv')
 
-# Create DB object and set credintials
-db_conn = DataStaxAstra()
-db_conn.set_secure_zip_location(SECURE_ZIP_LOCATION)
-db_conn.set_json_credintials(CREDINTIAL_LOCATION)
-db_conn.set_keyspace(KEYSPACE_NAME)
-
-# Create session and run queries
-try:
-	# Initialize the session
-	db_session = db_conn.create_session()
-
-	##### All further session calls go under here #####
+def run_queries(db_conn, db_session, callsigns):
+	"""Run the dashboard's queries. Returns (total rows, flights per weekday,
+	flights per wind direction, flights per airline)."""
 	# Grab the total number of rows
 	total_rows = db_conn.run_qry_total_rows(db_session, TABLE)
 	
@@ -50,19 +39,41 @@ try:
 	# Find the most popular airline 
 	popular_airline = db_conn.run_qry_popular_callsign(
 		db_session, TABLE, callsigns)
+	return(total_rows, flts_per_wkdy, flts_per_wind, popular_airline)
 
-except Exception as err:
-	print(str(err))
 
-finally:
-	# Always close out the session when done
-	print("Closing Session Connection...")
-	db_session.shutdown()
+######## Entry #########
+if __name__ == "__main__":
+	# Grab full list of callsigns from the catalog kept by the parser
+	callsigns = Callsigns().get_catalog_callsigns('../data/callsign_catalog.csv')
 
-# Create Charts 
-plt.bar(*zip(*flts_per_wkdy.items()))	
-plt.show()
-	
-	
-	
+	# Create DB object and set credintials. Query results are cached until the
+	# next bulk load (or an hour), so running the demo again doesn't rescan
+	db_conn = DataStaxAstra(cache=QueryCache('../data/query_cache.json'))
+	db_conn.set_secure_zip_location(SECURE_ZIP_LOCATION)
+	db_conn.set_json_credintials(CREDINTIAL_LOCATION)
+	db_conn.set_keyspace(KEYSPACE_NAME)
+
+	# Create session and run queries
+	try:
+		# Initialize the session
+		db_session = db_conn.create_session()
+
+		##### All further session calls go under here #####
+		total_rows, flts_per_wkdy, flts_per_wind, popular_airline = run_queries(
+			db_conn, db_session, callsigns)
+
+	except Exception as err:
+		print(str(err))
+
+	finally:
+		# Save this run's results for the next one
+		db_conn.cache.flush()
+		# Always close out the session when done
+		print("Closing Session Connection...")
+		db_session.shutdown()
 
+	# Create Charts 
+	import matplotlib.pyplot as plt
+	plt.bar(*zip(*flts_per_wkdy.items()))	
+	plt.show()
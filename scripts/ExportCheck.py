@@ -0,0 +1,200 @@
+################################################################################
+# ExportCheck.py
+# @author: Ryan Herrin
+#
+# Check for DataStaxAstra.export_table without a cluster. A fake session holds
+# a table of rows with known tokens (including the ends of the ring and the
+# range bounds) and answers the exporter's token range queries, failing the
+# ranges it is told to. Checks that every row is exported exactly once and
+# that a second run only redoes the ranges left out of export_state.json.
+################################################################################
+
+'''
+Usage:
+------------------
+python ExportCheck.py                 # flat and partitioned exports
+python ExportCheck.py --splits 64     # more ranges
+python ExportCheck.py --keep DIR      # leave the exported files in DIR
+'''
+
+import os
+import sys
+import csv
+import json
+import random
+import shutil
+import argparse
+import tempfile
+
+from DStaxAstraControl import DataStaxAstra, token_ranges, MIN_TOKEN, MAX_TOKEN
+
+
+HEADER = ['HexCode', 'Date', 'Time', 'FlightNumber', 'FlightKey']
+
+
+class FakeStatement:
+	'''Prepared (or bound) range query, token(...) >= or > start and <= end'''
+	def __init__(self, first, values=None):
+		self.first = first
+		self.values = values
+		self.fetch_size = None
+
+	def bind(self, values):
+		return(FakeStatement(self.first, tuple(values)))
+
+
+class FakeResults:
+	'''Pages through the rows of a range like the driver's ResultSet, failing
+	part way through if asked to'''
+	def __init__(self, rows, fail_after=None):
+		self.column_names = list(HEADER)
+		self.rows = rows
+		self.fail_after = fail_after
+
+	def __iter__(self):
+		for num, row in enumerate(self.rows):
+			if self.fail_after is not None and num >= self.fail_after:
+				raise RuntimeError("Connection lost")
+			yield(tuple(row))
+		if self.fail_after is not None and self.fail_after >= len(self.rows):
+			raise RuntimeError("Connection lost")
+
+
+class FakeSession:
+	'''Holds (token, row) pairs and answers the exporter's queries. Ranges
+	whose start token is in fail_starts raise after fail_after rows.'''
+	def __init__(self, table_rows, fail_starts=(), fail_after=1):
+		self.table_rows = sorted(table_rows)
+		self.fail_starts = set(fail_starts)
+		self.fail_after = fail_after
+		self.queried = [] # (start, end) of every range query run
+
+	def prepare(self, query):
+		return(FakeStatement('>=' in query))
+
+	def execute(self, bound):
+		start, end = bound.values
+		self.queried.append((start, end))
+		rows = [row for token, row in self.table_rows
+				if (token >= start if bound.first else token > start) and token <= end]
+		return(FakeResults(rows, self.fail_after if start in self.fail_starts else None))
+
+
+def make_table(rows, splits, seed=7):
+	'''Rows spread over the ring, plus rows on both ends of the ring and on
+	every range bound. Each row's FlightKey is unique.'''
+	rand = random.Random(seed)
+	tokens = [rand.randint(MIN_TOKEN, MAX_TOKEN) for num in range(rows)]
+	for start, end in token_ranges(splits):
+		tokens.extend([start, start + 1, end])
+	tokens.extend([MIN_TOKEN, MAX_TOKEN])
+	table = []
+	for num, token in enumerate(tokens):
+		hex_code = "{:06X}".format(rand.randint(0, 0xFFFFFF))
+		hour = rand.randint(0, 47)
+		date = "2022-06-{:02d}".format(20 + hour // 24)
+		time_str = "{:02d}:{:02d}:{:02d}".format(hour % 24, rand.randint(0, 59),
+												 rand.randint(0, 59))
+		table.append((token, [hex_code, date, time_str, 'NA',
+							  "{}_{:08d}".format(hex_code, num)]))
+	return(table)
+
+
+def read_export(output_dir):
+	'''FlightKeys of every exported row, and any .tmp files left behind'''
+	keys = []
+	left_over = []
+	for dir_path, dir_names, file_names in os.walk(output_dir):
+		for file_name in file_names:
+			if file_name.endswith('.tmp'):
+				left_over.append(os.path.join(dir_path, file_name))
+			elif file_name.startswith('range_') and file_name.endswith('.csv'):
+				with open(os.path.join(dir_path, file_name), 'r', newline='') as csv_in:
+					rows = list(csv.reader(csv_in))
+				keys.extend(row[-1] for row in rows[1:])
+	return(keys, left_over)
+
+
+def check_export(work_dir, splits=16, rows=5000, partitioned=False):
+	'''Export with a few ranges failing, then again with none. Returns a list
+	of what went wrong, empty if it all checked out.'''
+	problems = []
+	table = make_table(rows, splits)
+	expected = sorted(row[-1] for token, row in table)
+	ranges = token_ranges(splits)
+	output_dir = os.path.join(work_dir, 'partitioned' if partitioned else 'flat')
+	# A state file from an earlier check would skip ranges
+	shutil.rmtree(output_dir, ignore_errors=True)
+	astra = DataStaxAstra()
+	astra.keyspace = 'check'
+
+	# First run: the first, a middle and the last range fail on every attempt
+	fail_ids = [0, splits // 2, splits - 1]
+	failing = FakeSession(table, fail_starts=[ranges[num][0] for num in fail_ids])
+	exported, failed = astra.export_table(failing, 'flights', output_dir, splits=splits,
+										  workers=4, partitioned=partitioned, retries=1,
+										  partition_key='"HexCode"')
+	if sorted(failed) != fail_ids:
+		problems.append("failed ranges {} instead of {}".format(sorted(failed), fail_ids))
+	with open(os.path.join(output_dir, 'export_state.json'), 'r') as json_in:
+		state = json.load(json_in)
+	done = sorted(int(range_id) for range_id in state['done'])
+	if done != [num for num in range(splits) if num not in fail_ids]:
+		problems.append("export_state.json has ranges {} done".format(done))
+	keys, left_over = read_export(output_dir)
+	if left_over:
+		problems.append("failed ranges left {} .tmp file(s)".format(len(left_over)))
+	if len(keys) != exported:
+		problems.append("{} rows in the files but {} reported".format(len(keys), exported))
+
+	# Second run only has to redo the failed ranges
+	healthy = FakeSession(table)
+	exported, failed = astra.export_table(healthy, 'flights', output_dir, splits=splits,
+										  workers=4, partitioned=partitioned, retries=1,
+										  partition_key='"HexCode"')
+	redone = sorted(ranges.index(queried) for queried in healthy.queried)
+	if redone != fail_ids:
+		problems.append("resume queried ranges {} instead of {}".format(redone, fail_ids))
+	if failed:
+		problems.append("ranges {} failed on the healthy session".format(failed))
+
+	keys, left_over = read_export(output_dir)
+	if sorted(keys) != expected:
+		missing = len(set(expected) - set(keys))
+		problems.append("{} rows missing and {} extra of {}".format(
+			missing, len(keys) - (len(expected) - missing), len(expected)))
+	if exported != len(expected):
+		problems.append("{} rows reported instead of {}".format(exported, len(expected)))
+	if left_over:
+		problems.append("{} .tmp file(s) left after the resume".format(len(left_over)))
+	return(problems)
+
+
+######## Entry #########
+if __name__ == "__main__":
+	arg_parser = argparse.ArgumentParser(description="Check token range export and resume")
+	arg_parser.add_argument('--splits', type=int, default=16, help="Token ranges")
+	arg_parser.add_argument('--rows', type=int, default=5000, help="Random rows in the table")
+	arg_parser.add_argument('--keep', default=None, help="Export here and leave the files")
+	args = arg_parser.parse_args()
+
+	if args.splits < 3:
+		arg_parser.error("--splits has to be at least 3")
+
+	work_dir = args.keep or tempfile.mkdtemp(prefix='export_check_')
+	all_good = True
+	try:
+		for partitioned in [False, True]:
+			problems = check_export(work_dir, args.splits, args.rows, partitioned)
+			layout = 'partitioned' if partitioned else 'flat'
+			if problems:
+				all_good = False
+				print("{} export FAILED:".format(layout))
+				for problem in problems:
+					print("  " + problem)
+			else:
+				print("{} export OK".format(layout))
+	finally:
+		if args.keep is None:
+			shutil.rmtree(work_dir, ignore_errors=True)
+	sys.exit(0 if all_good else 1)
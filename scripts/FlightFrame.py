@@ -0,0 +1,137 @@
+################################################################################
+# FlightFrame.py
+# @author: Ryan Herrin
+#
+# Column oriented store for the parsed flight rows. Every column is dictionary
+# encoded: the distinct strings are kept once and each row is an index into
+# them in an array, so a snapshot costs a few bytes per field instead of a
+# list and a str object for every one. Formatting a column only touches its
+# distinct values, which is what makes the post-processing steps cheap.
+################################################################################
+
+'''
+Columns:
+------------------
+HexCode, Date, Time, FlightNumber, Alt, GroundSpeed, Squawk, then Airline,
+NearestHour and FlightKey once the parser adds them. Same order as the
+processed CSV.
+
+frame['Date'] is a StringColumn, frame.rows() gives the old list of lists.
+'''
+
+import csv
+from array import array
+from collections import Counter
+
+
+PARSED_COLUMNS = ['HexCode', 'Date', 'Time', 'FlightNumber', 'Alt', 'GroundSpeed',
+				  'Squawk']
+PROCESSED_HEADER = PARSED_COLUMNS + ['Airline', 'NearestHour', 'FlightKey']
+
+
+class StringColumn:
+	'''A column of strings stored as codes into a list of distinct values'''
+	def __init__(self, values=None, codes=None):
+		self.values = [] if values is None else values
+		self.codes = array('I') if codes is None else codes
+		self._lookup = dict(zip(self.values, range(len(self.values))))
+
+	@classmethod
+	def from_values(cls, iterable):
+		# Every pass here loops in C (fromkeys, zip, map) rather than Python
+		row_values = iterable if isinstance(iterable, list) else list(iterable)
+		column = cls(list(dict.fromkeys(row_values)))
+		column.codes = array('I', map(column._lookup.__getitem__, row_values))
+		return(column)
+
+	def __len__(self):
+		return(len(self.codes))
+
+	def __contains__(self, value):
+		return(value in self._lookup)
+
+	def __getitem__(self, row):
+		return(self.values[self.codes[row]])
+
+	def __setitem__(self, row, value):
+		self.codes[row] = self._code_for(value)
+
+	def map(self, func):
+		'''New column with func applied to every distinct value (not every
+		row). Values that end up the same are merged so codes stay unique.'''
+		mapped = [func(value) for value in self.values]
+		if len(set(mapped)) == len(mapped):
+			return(StringColumn(mapped, array('I', self.codes)))
+		merged = StringColumn()
+		remap = [merged._code_for(value) for value in mapped]
+		merged.codes = array('I', map(remap.__getitem__, self.codes))
+		return(merged)
+
+	def _code_for(self, value):
+		code = self._lookup.get(value)
+		if code is None:
+			code = self._lookup[value] = len(self.values)
+			self.values.append(value)
+		return(code)
+
+	def fill(self, empty, fills):
+		'''New column with every empty value replaced by the value from fills
+		(a list the same length) in that row, unless that is '' too.'''
+		code = self._lookup.get(empty)
+		if code is None:
+			return(self)
+		return(StringColumn.from_values([
+			fill if row_code == code and fill != '' else value
+			for row_code, value, fill in zip(self.codes, self.tolist(), fills)]))
+
+	def counts(self):
+		'''{value: rows with it}'''
+		return({self.values[code]: count for code, count in Counter(self.codes).items()})
+
+	def tolist(self):
+		return(list(map(self.values.__getitem__, self.codes)))
+
+
+class FlightFrame:
+	'''Named StringColumns of the same length'''
+	def __init__(self, columns=None):
+		# dicts keep their order, so this is the CSV column order
+		self.columns = dict() if columns is None else columns
+
+	@classmethod
+	def from_rows(cls, rows, names=None):
+		'''Frame from a list of row lists (no header)'''
+		rows = list(rows)
+		if names is None:
+			names = PROCESSED_HEADER[:len(rows[0])] if rows else PARSED_COLUMNS
+		return(cls({name: StringColumn.from_values(row[pos] for row in rows)
+					for pos, name in enumerate(names)}))
+
+	def __len__(self):
+		for column in self.columns.values():
+			return(len(column))
+		return(0)
+
+	def __getitem__(self, name):
+		return(self.columns[name])
+
+	def __setitem__(self, name, column):
+		self.columns[name] = column
+
+	def header(self):
+		return(list(self.columns))
+
+	def iter_rows(self):
+		'''Rows as tuples, built a column at a time'''
+		return(zip(*[column.tolist() for column in self.columns.values()]))
+
+	def rows(self):
+		return([list(row) for row in self.iter_rows()])
+
+	def write_csv(self, csv_path, header=False):
+		'''Write the frame to a CSV, with the column names first if header'''
+		with open(csv_path, 'w', newline='') as csv_out:
+			data_writer = csv.writer(csv_out, delimiter=',')
+			if header:
+				data_writer.writerow(self.header())
+			data_writer.writerows(self.iter_rows())
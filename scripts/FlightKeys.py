@@ -0,0 +1,107 @@
+################################################################################
+# FlightKeys.py
+# @author: Ryan Herrin
+#
+# Stable key for one flight: the aircraft's hex and the time its session
+# started, e.g. A4CA66_20220620233206. A snapshot taken mid-flight, or the
+# same snapshot processed twice, gives rows with the same key, so every writer
+# can upsert on it instead of adding another row. HexRegistry works out which
+# session a snapshot's sighting belongs to (see HexRegistry.session_for).
+################################################################################
+
+'''
+Merging:
+------------------
+Two rows with the same key (processed or combined, same first 8 columns)
+merge into the one seen first, with its time and anything that goes with it
+(NearestHour, the weather). Empty flight fields ('' or NA) are filled from the
+other row, and Airline always comes with the flight number. For the same time
+the newer row's values win, so reprocessing with changed parser code still
+changes the rows.
+
+Load ledger (sqlite):
+------------------
+loaded(tbl, key, digest) : digest of the row last loaded for each flight key,
+                           so a reload only sends new or changed rows. Forget
+                           the table if it is truncated in Astra.
+'''
+
+import sqlite3
+import hashlib
+import datetime
+
+
+# Messages from the same hex further apart than this are different flights
+SESSION_GAP = datetime.timedelta(minutes=30)
+
+_EMPTY = ('', 'NA')
+_FLIGHT_FIELDS = [3, 4, 5, 6] # FlightNumber, Alt, GroundSpeed, Squawk
+_AIRLINE = 7
+
+
+def flight_key(hex_code, session_start):
+	'''Key for a hex and a "YYYY-MM-DD HH:MM:SS" session start'''
+	return(hex_code + '_' + session_start.replace('-', '').replace(' ', '').replace(':', ''))
+
+
+def merge_rows(old, new):
+	'''One row for two rows of the same flight (see Merging above)'''
+	if (new[1], new[2]) <= (old[1], old[2]):
+		base, other = new, old
+	else:
+		base, other = old, new
+	merged = list(base)
+	for pos in _FLIGHT_FIELDS:
+		if merged[pos] in _EMPTY and other[pos] not in _EMPTY:
+			merged[pos] = other[pos]
+			if pos == 3:
+				merged[_AIRLINE] = other[_AIRLINE]
+	return(merged)
+
+
+def row_digest(row):
+	return(hashlib.sha1(','.join(row).encode('utf-8')).hexdigest()[:16])
+
+
+class LoadLedger:
+	"""Digest of what was last loaded for every flight key of a table"""
+	def __init__(self, db_path):
+		self.db_path = db_path
+		self.conn = sqlite3.connect(db_path)
+		self.conn.execute(
+			"CREATE TABLE IF NOT EXISTS loaded (" +
+			"tbl TEXT, key TEXT, digest TEXT, PRIMARY KEY (tbl, key))")
+		self.conn.commit()
+
+	def __enter__(self):
+		return(self)
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
+
+	def changed(self, table, rows, key_col):
+		"""The rows that are new or differ from what was loaded last"""
+		known = dict()
+		keys = [row[key_col] for row in rows]
+		# sqlite only takes so many parameters at once
+		for start in range(0, len(keys), 500):
+			part = keys[start:start + 500]
+			known.update(self.conn.execute(
+				"SELECT key, digest FROM loaded WHERE tbl = ? AND key IN ({})".format(
+					', '.join(['?'] * len(part))), [table] + part).fetchall())
+		return([row for row in rows if known.get(row[key_col]) != row_digest(row)])
+
+	def mark(self, table, rows, key_col):
+		"""Remember rows as loaded"""
+		self.conn.executemany(
+			"INSERT OR REPLACE INTO loaded VALUES (?, ?, ?)",
+			[(table, row[key_col], row_digest(row)) for row in rows])
+		self.conn.commit()
+
+	def forget(self, table):
+		"""Everything gets loaded again next time"""
+		self.conn.execute("DELETE FROM loaded WHERE tbl = ?", (table,))
+		self.conn.commit()
+
+	def close(self):
+		self.conn.close()
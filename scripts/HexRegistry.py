@@ -0,0 +1,262 @@
+################################################################################
+# HexRegistry.py
+# @author: Ryan Herrin
+#
+# Persistent registry of every aircraft we've seen, keyed by its ICAO hex.
+# Short snapshots often miss the callsign or squawk of an aircraft we already
+# know, so the parser can fill those in from here. Lookups go through an LRU
+# cache in memory first and only hit the sqlite file on a miss. It also keeps
+# every flight (session) of each aircraft, which is where the flight keys
+# come from.
+################################################################################
+
+'''
+Table aircraft:
+------------------
+hex        : ICAO hex code (primary key)
+flight     : Last known flight number
+airline    : Airline code for that flight number
+category   : airline, private, military... (from CallsignResolver)
+squawk     : Last known squawk
+first_seen : "YYYY-MM-DD HH:MM:SS"
+last_seen  : "YYYY-MM-DD HH:MM:SS"
+sightings  : Number of flights (sessions) the aircraft was seen on
+session    : Flight key of the session flight and squawk were seen on
+
+Table sessions:
+------------------
+key        : Flight key, see FlightKeys.flight_key (primary key)
+hex        : ICAO hex code
+start      : "YYYY-MM-DD HH:MM:SS" first message of the flight
+last_seen  : "YYYY-MM-DD HH:MM:SS" last message of the flight
+file       : Processed file the flight's row is written to
+
+An aircraft gets a new flight number and squawk for each flight, so
+backfilling only uses values from the row's own session that were seen before
+it (and within backfill_age). A snapshot's
+sighting of an aircraft joins a session it comes within session_gap of,
+otherwise it starts a new one. The key is made when the session is, so it
+doesn't change if an earlier snapshot is processed later.
+'''
+
+import sqlite3
+import datetime
+from collections import OrderedDict
+
+from CallsignResolver import get_resolver
+from FlightKeys import SESSION_GAP, flight_key
+
+
+_COLUMNS = ['hex', 'flight', 'airline', 'category', 'squawk', 'first_seen',
+			'last_seen', 'sightings', 'session']
+_SESSION_COLUMNS = ['key', 'hex', 'start', 'last_seen', 'file']
+_SEEN_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def _parse_seen(date_str, time_str):
+	'''Build a datetime from the processed Date and Time columns'''
+	try:
+		return(datetime.datetime.strptime(
+			date_str.replace('/', '-') + ' ' + time_str.split('.')[0],
+			"%Y-%m-%d %H:%M:%S"))
+	except ValueError:
+		return(None)
+
+
+class HexRegistry:
+	"""On-disk aircraft registry with an in-memory LRU in front of it"""
+	def __init__(self, db_path, cache_size=4096,
+				 backfill_age=datetime.timedelta(hours=6), session_gap=SESSION_GAP):
+		self.db_path = db_path
+		self.cache_size = cache_size
+		self.backfill_age = backfill_age
+		self.session_gap = session_gap
+		self._cache = OrderedDict() # hex -> entry dict, most recent last
+		self._pending = dict() # hex -> entry dict waiting to be written
+		self._sessions = dict() # hex -> [session dicts], until the next flush
+		self._pending_sessions = dict() # key -> session dict waiting to be written
+		self.hits = 0
+		self.misses = 0
+
+		self.conn = sqlite3.connect(db_path)
+		self.conn.execute(
+			"CREATE TABLE IF NOT EXISTS aircraft (" +
+			"hex TEXT PRIMARY KEY, flight TEXT, airline TEXT, category TEXT, " +
+			"squawk TEXT, first_seen TEXT, last_seen TEXT, sightings INTEGER, " +
+			"session TEXT)")
+		# Registries made before sessions were kept don't have the column yet
+		columns = [row[1] for row in self.conn.execute("PRAGMA table_info(aircraft)")]
+		if 'session' not in columns:
+			self.conn.execute("ALTER TABLE aircraft ADD COLUMN session TEXT DEFAULT ''")
+		self.conn.execute(
+			"CREATE TABLE IF NOT EXISTS sessions (" +
+			"key TEXT PRIMARY KEY, hex TEXT, start TEXT, last_seen TEXT, file TEXT)")
+		self.conn.execute("CREATE INDEX IF NOT EXISTS sessions_hex ON sessions (hex)")
+		self.conn.commit()
+
+	def __enter__(self):
+		return(self)
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
+
+	def _remember(self, hex_code, entry):
+		'''Put an entry at the front of the LRU and drop the oldest if full'''
+		self._cache[hex_code] = entry
+		self._cache.move_to_end(hex_code)
+		if len(self._cache) > self.cache_size:
+			self._cache.popitem(last=False)
+
+	def lookup(self, hex_code):
+		"""Returns the entry for a hex as a dictionary, or None"""
+		entry = self._cache.get(hex_code)
+		if entry is not None:
+			self.hits += 1
+			self._cache.move_to_end(hex_code)
+			return(entry)
+
+		self.misses += 1
+		entry = self._pending.get(hex_code)
+		if entry is None:
+			row = self.conn.execute("SELECT * FROM aircraft WHERE hex = ?",
+									(hex_code,)).fetchone()
+			if row is None:
+				return(None)
+			entry = dict(zip(_COLUMNS, row))
+		self._remember(hex_code, entry)
+		return(entry)
+
+	def record(self, parsed_row, new_session=True, key=None):
+		"""Update the registry from one parsed row
+		([hex, date, time, flight, alt, gs, squawk, ...]) of the session key.
+		Only a new session adds to sightings, so processing a snapshot again
+		doesn't."""
+		hex_code = parsed_row[0]
+		flight = str(parsed_row[3]).strip()
+		seen = parsed_row[1].replace('/', '-') + ' ' + parsed_row[2].split('.')[0]
+		entry = self.lookup(hex_code)
+
+		if entry is None:
+			entry = {'hex': hex_code, 'flight': '', 'airline': '', 'category': '',
+					 'squawk': '', 'first_seen': seen, 'last_seen': seen,
+					 'sightings': 0, 'session': ''}
+		else:
+			entry = dict(entry)
+
+		# Only overwrite what we knew with values that are newer and not empty
+		if seen >= entry['last_seen']:
+			if key is not None and key != entry['session'] and \
+					(flight not in ('', 'NA') or parsed_row[6] != ''):
+				# A new flight, what we knew about the last one doesn't go with it
+				entry.update({'flight': '', 'airline': '', 'category': '', 'squawk': '',
+							  'session': key})
+			if flight not in ('', 'NA'):
+				entry['flight'] = flight
+				entry['airline'], name, entry['category'] = get_resolver().resolve(flight)
+			if parsed_row[6] != '':
+				entry['squawk'] = parsed_row[6]
+			entry['last_seen'] = seen
+		if seen < entry['first_seen']:
+			entry['first_seen'] = seen
+		if new_session:
+			entry['sightings'] += 1
+
+		self._pending[hex_code] = entry
+		self._remember(hex_code, entry)
+
+	def backfill(self, parsed_row, key=None):
+		"""Fill an empty flight number or squawk in a parsed row from the
+		registry if they were seen earlier on the same session (flight key).
+		Without a key the values have to be from within session_gap before the
+		row. Returns True if anything was filled in."""
+		if parsed_row[3] != 'NA' and parsed_row[6] != '':
+			return(False)
+		entry = self.lookup(parsed_row[0])
+		if entry is None:
+			return(False)
+
+		row_seen = _parse_seen(parsed_row[1], parsed_row[2])
+		last_seen = _parse_seen(*entry['last_seen'].split(' '))
+		if row_seen is None or last_seen is None:
+			return(False)
+		if key is not None and entry['session'] != key:
+			return(False)
+		max_age = self.backfill_age if key is not None else self.session_gap
+		# Values seen after the row may already belong to a later flight
+		if last_seen > row_seen or row_seen - last_seen > max_age:
+			return(False)
+
+		filled = False
+		if parsed_row[3] == 'NA' and entry['flight'] != '':
+			parsed_row[3] = entry['flight']
+			filled = True
+		if parsed_row[6] == '' and entry['squawk'] != '':
+			parsed_row[6] = entry['squawk']
+			filled = True
+		return(filled)
+
+	def _hex_sessions(self, hex_code):
+		sessions = self._sessions.get(hex_code)
+		if sessions is None:
+			sessions = self._sessions[hex_code] = [
+				dict(zip(_SESSION_COLUMNS, row)) for row in self.conn.execute(
+					"SELECT * FROM sessions WHERE hex = ?", (hex_code,))]
+		return(sessions)
+
+	def session_for(self, hex_code, first_seen, last_seen, file_name):
+		"""Flight key for an aircraft seen from first_seen to last_seen
+		("YYYY-MM-DD HH:MM:SS") in a snapshot whose processed file is file_name.
+		Joins the session it overlaps, stretching it to cover the sighting, or
+		starts a new one. Returns (key, file the flight's row goes in, new)."""
+		sessions = self._hex_sessions(hex_code)
+		try:
+			first = datetime.datetime.strptime(first_seen, _SEEN_FORMAT)
+			last = datetime.datetime.strptime(last_seen, _SEEN_FORMAT)
+		except ValueError:
+			first = last = None
+
+		if first is not None:
+			for session in sessions:
+				start = datetime.datetime.strptime(session['start'], _SEEN_FORMAT)
+				end = datetime.datetime.strptime(session['last_seen'], _SEEN_FORMAT)
+				if first > end + self.session_gap or last < start - self.session_gap:
+					continue
+				if first_seen < session['start'] or last_seen > session['last_seen']:
+					session['start'] = min(session['start'], first_seen)
+					session['last_seen'] = max(session['last_seen'], last_seen)
+					self._pending_sessions[session['key']] = session
+				return(session['key'], session['file'], False)
+
+		session = {'key': flight_key(hex_code, first_seen), 'hex': hex_code,
+				   'start': first_seen, 'last_seen': last_seen, 'file': file_name}
+		sessions.append(session)
+		self._pending_sessions[session['key']] = session
+		return(session['key'], file_name, True)
+
+	def session_file(self, key):
+		"""Processed file a flight key's row belongs in, None if unknown"""
+		session = self._pending_sessions.get(key)
+		if session is not None:
+			return(session['file'])
+		row = self.conn.execute("SELECT file FROM sessions WHERE key = ?", (key,)).fetchone()
+		return(None if row is None else row[0])
+
+	def flush(self):
+		"""Write any pending changes to the sqlite file"""
+		if self._pending_sessions:
+			self.conn.executemany(
+				"INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?)",
+				[tuple(session[col] for col in _SESSION_COLUMNS) for session in
+				 self._pending_sessions.values()])
+			self._pending_sessions = dict()
+			self._sessions = dict()
+		if self._pending:
+			self.conn.executemany(
+				"INSERT OR REPLACE INTO aircraft VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+				[tuple(entry[col] for col in _COLUMNS) for entry in self._pending.values()])
+			self._pending = dict()
+		self.conn.commit()
+
+	def close(self):
+		self.flush()
+		self.conn.close()
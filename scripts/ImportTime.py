@@ -0,0 +1,144 @@
+################################################################################
+# ImportTime.py
+# @author: Ryan Herrin
+#
+# Cold start check for the scripts cron runs on the Pi. Each entry point is
+# imported in a fresh interpreter with python -X importtime, and the run fails
+# if a heavy dependency gets pulled in at import or the import time goes over
+# the saved baseline.
+################################################################################
+
+'''
+Usage:
+------------------
+python ImportTime.py                    # check every entry point
+python ImportTime.py --save-baseline    # store this run as the baseline
+python ImportTime.py --threshold 0.5    # fail if >50% slower than baseline
+'''
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+ENTRY_POINTS = ["Tracker", "TenNinty", "Weather", "CombineFltWthr",
+				"DStaxAstraControl", "ModeS", "RawIndex", "RawArchive",
+				"CallsignCatalog", "HexRegistry", "Benchmark", "Demo"]
+
+# Only the code paths that need these should load them
+HEAVY_MODULES = ["matplotlib", "cassandra", "requests", "numpy",
+				 "multiprocessing", "concurrent.futures"]
+
+DEFAULT_BASELINE = os.path.join(SCRIPTS_DIR, '..', 'data', 'metrics',
+								'import_baseline.json')
+
+
+def parse_importtime(stderr_text):
+	'''Turn -X importtime output into a list of (self us, cumulative us, module)'''
+	imports = []
+	for line in stderr_text.splitlines():
+		if not line.startswith('import time:') or 'self [us]' in line:
+			continue
+		self_us, cumulative_us, name = line[len('import time:'):].split('|')
+		imports.append((int(self_us), int(cumulative_us), name.strip()))
+	return(imports)
+
+
+def measure_import(module, repeat=5):
+	'''Import a module in a new interpreter repeat times. Returns the best
+	cumulative time, the heavy modules it loaded and the slowest imports.'''
+	best = None
+	for run in range(repeat):
+		proc = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+							   'import ' + module], cwd=SCRIPTS_DIR,
+							  capture_output=True, text=True)
+		if proc.returncode != 0:
+			return({'error': proc.stderr.strip().splitlines()[-1]})
+
+		imports = parse_importtime(proc.stderr)
+		total = [cumulative for self_us, cumulative, name in imports if name == module][-1]
+		if best is None or total < best['total_us']:
+			loaded = set(name for self_us, cumulative, name in imports)
+			best = {
+				'total_us': total,
+				'heavy': [heavy for heavy in HEAVY_MODULES if heavy in loaded],
+				'slowest': [[name, self_us] for self_us, cumulative, name in
+							sorted(imports, reverse=True)[:5]],
+				}
+	return(best)
+
+
+def run_import_checks(modules, repeat=5):
+	'''Measure every module. Returns {module: result}'''
+	return({module: measure_import(module, repeat) for module in modules})
+
+
+def print_table(results):
+	print("{:<20}{:>12}  {}".format("entry point", "import ms", "heavy imports"))
+	for module, result in results.items():
+		if 'error' in result:
+			print("{:<20}{:>12}  {}".format(module, 'error', result['error']))
+			continue
+		print("{:<20}{:>12.1f}  {}".format(module, result['total_us'] / 1000.0,
+										  ', '.join(result['heavy']) or '-'))
+
+
+def find_problems(results, baseline, threshold):
+	'''Heavy imports, failed imports and anything slower than the baseline'''
+	problems = []
+	for module, result in results.items():
+		if 'error' in result:
+			problems.append("{}: import failed ({})".format(module, result['error']))
+			continue
+		if result['heavy']:
+			problems.append("{}: loads {} at import".format(module,
+															', '.join(result['heavy'])))
+		base = baseline.get(module)
+		if base is None or 'total_us' not in base:
+			continue
+		limit = base['total_us'] * (1 + threshold)
+		if result['total_us'] > limit:
+			problems.append("{}: {:.1f}ms > {:.1f}ms (baseline {:.1f}ms)".format(
+				module, result['total_us'] / 1000.0, limit / 1000.0,
+				base['total_us'] / 1000.0))
+	return(problems)
+
+
+######## Entry #########
+if __name__ == "__main__":
+	arg_parser = argparse.ArgumentParser(description="Import time check for entry points")
+	arg_parser.add_argument('--modules', nargs='+', default=ENTRY_POINTS)
+	arg_parser.add_argument('--repeat', type=int, default=5,
+							help="Imports per module, the fastest one is kept")
+	arg_parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+	arg_parser.add_argument('--save-baseline', action='store_true')
+	# Import times are small and noisy, so allow more than the benchmarks do
+	arg_parser.add_argument('--threshold', type=float, default=0.5)
+	args = arg_parser.parse_args()
+
+	import_results = run_import_checks(args.modules, args.repeat)
+	print_table(import_results)
+
+	if args.save_baseline:
+		os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+		with open(args.baseline, 'w') as json_out:
+			json.dump(import_results, json_out, indent=2)
+		print("Saved baseline to {}".format(args.baseline))
+		sys.exit(0)
+
+	baseline = dict()
+	if os.path.exists(args.baseline):
+		with open(args.baseline, 'r') as json_in:
+			baseline = json.load(json_in)
+
+	found = find_problems(import_results, baseline, args.threshold)
+	if found:
+		print("Import problems:")
+		for problem in found:
+			print("  " + problem)
+		sys.exit(1)
+	print("No import problems")
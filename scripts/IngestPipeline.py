@@ -0,0 +1,235 @@
+################################################################################
+# IngestPipeline.py
+# @author: Ryan Herrin
+#
+# Live ingest split into reader -> parser -> writer threads joined by bounded
+# queues. The reader only ever reads the socket, so an SD card write that
+# takes half a second holds up the writer thread and nothing else, and
+# dump1090 keeps seeing us read. When the write queue is full the parser
+# waits up to max_stall seconds and then drops that batch of whole lines, so
+# a long stall shows up as dropped batches in the metrics instead of a dropped
+# connection. Raw chunks are never dropped: they end mid-line, and losing one
+# would glue the line cut off at its start onto the one after it.
+################################################################################
+
+'''
+Usage:
+------------------
+pipeline = IngestPipeline(lambda: sbs_sock.recv(65536), sbs_line_parser(), live_feed)
+pipeline.run()    # returns the metrics when the connection closes
+
+Metrics (Metrics('ingest')):
+------------------
+stages:   read, parse, write, <queue>_stall (time spent waiting on a full queue)
+counters: bytes_read, lines, writes, <queue>_dropped, <queue>_max_depth,
+          <queue>_mean_depth, write_max_ms, parse_errors, write_errors
+
+If parsing or writing fails the error is printed, the pipeline stops
+reading and run() returns once everything has shut down.
+'''
+
+import time
+import queue
+import threading
+
+from Metrics import Metrics
+
+
+_DONE = None # Sent down the queues once the reader is finished
+
+
+class BoundedQueue:
+	'''queue.Queue that keeps depth and stall numbers. put waits up to
+	max_stall seconds for room (forever if None) and then drops the batch.'''
+	def __init__(self, name, max_batches, metrics, max_stall=None):
+		self.name = name
+		self.queue = queue.Queue(maxsize=max_batches)
+		self.metrics = metrics
+		self.max_stall = max_stall
+		self.max_depth = 0
+		self._depth_total = 0
+		self._puts = 0
+
+	def put(self, item, force=False):
+		'''Returns False if the batch had to be dropped. force waits for room
+		however long it takes (raw chunks, the end marker).'''
+		depth = self.queue.qsize()
+		self.max_depth = max(self.max_depth, depth)
+		self._depth_total += depth
+		self._puts += 1
+		try:
+			self.queue.put_nowait(item)
+			return(True)
+		except queue.Full:
+			pass
+		with self.metrics.stage(self.name + '_stall'):
+			try:
+				self.queue.put(item, timeout=None if force else self.max_stall)
+				return(True)
+			except queue.Full:
+				self.metrics.count(self.name + '_dropped')
+				return(False)
+
+	def get(self, block=True):
+		return(self.queue.get(block))
+
+	def get_nowait(self):
+		return(self.queue.get_nowait())
+
+	def record(self):
+		'''Move the depth numbers into the metrics'''
+		self.metrics.counters[self.name + '_max_depth'] = self.max_depth
+		self.metrics.counters[self.name + '_mean_depth'] = round(
+			self._depth_total / max(1, self._puts), 2)
+
+
+class QueueWriter:
+	'''Writer thread that appends whatever is put on its queue to a file.
+	Batches that are waiting when it gets to them go out as one write.'''
+	def __init__(self, output_path, metrics=None, queue_batches=256, max_stall=None,
+				 write_batches=64, binary=True):
+		self.output_path = output_path
+		self.metrics = metrics if metrics is not None else Metrics('ingest')
+		self.in_queue = BoundedQueue('write_queue', queue_batches, self.metrics, max_stall)
+		self.write_batches = write_batches
+		self.binary = binary
+		self.write_max = 0.0
+		self.failed = threading.Event()
+		self._thread = threading.Thread(target=self._run, daemon=True)
+		self._thread.start()
+
+	def put(self, data):
+		return(self.in_queue.put(data))
+
+	def close(self):
+		'''Write what's left and stop the thread'''
+		self.in_queue.put(_DONE, force=True)
+		self._thread.join()
+		self.in_queue.record()
+		self.metrics.counters['write_max_ms'] = round(self.write_max * 1000.0, 3)
+
+	def _run(self):
+		try:
+			self._write_batches()
+		except Exception as err:
+			print("Writer stopped: " + str(err))
+			self.metrics.count('write_errors')
+			self.failed.set()
+			# Keep taking batches so nothing waiting on the queue gets stuck
+			while self.in_queue.get() is not _DONE:
+				pass
+
+	def _write_batches(self):
+		done = False
+		with open(self.output_path, 'ab' if self.binary else 'a',
+				  **({} if self.binary else {'newline': ''})) as out_file:
+			while not done:
+				batches = [self.in_queue.get()]
+				# Take whatever else is already waiting
+				while len(batches) < self.write_batches:
+					try:
+						batches.append(self.in_queue.get_nowait())
+					except queue.Empty:
+						break
+				if batches[-1] is _DONE:
+					done = True
+					batches.pop()
+				if not batches:
+					continue
+
+				start = time.perf_counter()
+				with self.metrics.stage('write'):
+					out_file.write((b'' if self.binary else '').join(batches))
+					out_file.flush()
+				self.write_max = max(self.write_max, time.perf_counter() - start)
+				self.metrics.count('writes')
+
+
+class IngestPipeline:
+	'''read_chunk() returns the next bytes from the source (b'' at the end).
+	parse_chunk(data) turns them into bytes to write; it is called with None
+	at the end to hand back anything it was holding on to.'''
+	def __init__(self, read_chunk, parse_chunk, output_path, metrics=None,
+				 queue_batches=256, max_stall=2.0, write_batches=64):
+		self.read_chunk = read_chunk
+		self.parse_chunk = parse_chunk
+		self.metrics = metrics if metrics is not None else Metrics('ingest')
+		self.parse_queue = BoundedQueue('parse_queue', queue_batches, self.metrics, max_stall)
+		self.writer = QueueWriter(output_path, self.metrics, queue_batches, max_stall,
+								  write_batches)
+		self.failed = threading.Event()
+
+	def _parser(self):
+		while True:
+			data = self.parse_queue.get()
+			if self.failed.is_set():
+				# Just empty the queue until the reader's end marker
+				if data is _DONE:
+					break
+				continue
+			try:
+				with self.metrics.stage('parse'):
+					parsed = self.parse_chunk(data)
+			except Exception as err:
+				print("Parser stopped: " + str(err))
+				self.metrics.count('parse_errors')
+				self.failed.set()
+				if data is _DONE:
+					break
+				continue
+			if parsed:
+				self.metrics.count('lines', parsed.count(b'\n'))
+				self.writer.put(parsed)
+			if data is _DONE:
+				break
+
+	def run(self):
+		'''Read until the source closes, then let the other stages finish.
+		Returns the metrics.'''
+		parser = threading.Thread(target=self._parser, daemon=True)
+		parser.start()
+		try:
+			while not self.failed.is_set() and not self.writer.failed.is_set():
+				with self.metrics.stage('read'):
+					data = self.read_chunk()
+				if not data:
+					break
+				self.metrics.count('bytes_read', len(data))
+				# Waits for room rather than dropping, see the top of the file
+				self.parse_queue.put(data, force=True)
+		finally:
+			self.parse_queue.put(_DONE, force=True)
+			parser.join()
+			self.writer.close()
+			self.parse_queue.record()
+		return(self.metrics)
+
+
+def sbs_line_parser():
+	'''parse_chunk for the 30003 feed: passes through whole lines only, and
+	keeps a line that was cut off until the rest of it comes in'''
+	left_over = [b'']
+
+	def parse_chunk(data):
+		if data is None:
+			rest, left_over[0] = left_over[0], b''
+			return(rest)
+		data = left_over[0] + data
+		cut = data.rfind(b'\n') + 1
+		left_over[0] = data[cut:]
+		return(data[:cut])
+	return(parse_chunk)
+
+
+def beast_parser(decoder):
+	'''parse_chunk for the Beast feed: decodes the frames into SBS lines'''
+	from ModeS import read_beast_frames
+	left_over = [b'']
+
+	def parse_chunk(data):
+		if data is None:
+			return(b'')
+		frames, left_over[0] = read_beast_frames(left_over[0] + data, with_mlat=True)
+		rows = decoder.decode_batch(frames)
+		return(''.join(','.join(row) + '\r\n' for row in rows).encode('latin-1'))
+	return(parse_chunk)
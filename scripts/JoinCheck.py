@@ -0,0 +1,130 @@
+################################################################################
+# JoinCheck.py
+# @author: Ryan Herrin
+#
+# Check for the timestamp joins in CombineFltWthr. Weather observations taken
+# a few minutes before the hour (like the wunderground and weather.gov ones)
+# are converted the way Weather.py does it, then flights are matched against
+# them in nearest and backward mode, in memory and streamed. Each observation
+# has its own temperature so the check can tell which one a flight got.
+################################################################################
+
+'''
+Usage:
+------------------
+python JoinCheck.py
+'''
+
+import os
+import sys
+import csv
+import shutil
+import tempfile
+
+import CombineFltWthr
+from Weather import WEATHER_HEADER, convert_wunder_rows
+
+
+# Wunderground rows (time, temp, dew point, humidity, wind, speed, gust,
+# pressure, precip, condition). Temp tells the observations apart.
+WUNDER_DAYS = {
+	'2022-06-20': [
+		['9:53 AM', '71 F', '60 F', '70 %', 'S', '5 mph', '0 mph', '29.30 in', '0.0 in', 'Fair'],
+		['10:53 AM', '72 F', '60 F', '70 %', 'S', '5 mph', '0 mph', '29.30 in', '0.0 in', 'Fair'],
+		['11:53 AM', '73 F', '60 F', '70 %', 'S', '5 mph', '0 mph', '29.30 in', '0.0 in', 'Fair'],
+		['11:53 PM', '74 F', '60 F', '70 %', 'S', '5 mph', '0 mph', '29.30 in', '0.0 in', 'Fair']],
+	'2022-06-21': [
+		['12:05 AM', '75 F', '60 F', '70 %', 'S', '5 mph', '0 mph', '29.30 in', '0.0 in', 'Fair']],
+	}
+
+# (flight time, temp it should get for nearest, for backward). None is no
+# match within the 60 minute tolerance.
+FLIGHTS = [
+	('2022-06-20', '10:35:00', '72', '71'), # the 11:00 label is really 11:53
+	('2022-06-20', '10:05:00', '71', '71'),
+	('2022-06-20', '10:53:00', '72', '72'),
+	('2022-06-20', '11:20:00', '72', '72'), # 27 minutes from 10:53, 33 to 11:53
+	('2022-06-20', '11:30:00', '73', '72'),
+	('2022-06-20', '12:45:00', '73', '73'),
+	('2022-06-20', '13:00:00', None, None), # 67 minutes after 11:53
+	('2022-06-20', '08:55:00', '71', None),
+	('2022-06-20', '23:59:30', '75', '74'), # next day's first observation
+	]
+
+
+def weather_rows():
+	'''The wunderground days converted like Weather.py does'''
+	rows = []
+	for day, wunder_rows in sorted(WUNDER_DAYS.items()):
+		rows.extend(convert_wunder_rows(wunder_rows, day, 'Monday'))
+	return(rows)
+
+
+def flight_rows():
+	return([['A{:05d}'.format(num), day, when, 'NA', '', '', '', '', when[:2] + ':00:00',
+			 'A{:05d}_{}'.format(num, num)] for num, (day, when, nearest, backward)
+			in enumerate(FLIGHTS)])
+
+
+def check_matches(combined, mode, how):
+	'''Compare what each flight got with FLIGHTS'''
+	problems = []
+	got = dict((row[14], row[10]) for row in combined)
+	for num, (day, when, nearest, backward) in enumerate(FLIGHTS):
+		expected = nearest if mode == 'nearest' else backward
+		key = 'A{:05d}_{}'.format(num, num)
+		if got.get(key) != expected:
+			problems.append("{} {} join: flight at {} got temp {}, not {}".format(
+				how, mode, when, got.get(key), expected))
+	return(problems)
+
+
+def check_join(work_dir):
+	'''Returns a list of what went wrong, empty if it all checked out'''
+	problems = []
+	wthr_rows = weather_rows()
+	if any(len(row) != len(WEATHER_HEADER) for row in wthr_rows):
+		problems.append("converted weather rows don't match WEATHER_HEADER")
+
+	for mode in ['nearest', 'backward']:
+		combined = CombineFltWthr.combine_flt_and_wthr(flight_rows(), wthr_rows, mode, 60)
+		problems.extend(check_matches(combined, mode, 'in memory'))
+
+	# Streamed, reading the weather files from disk like a real run
+	flt_dir = os.path.join(work_dir, 'flights')
+	wthr_dir = os.path.join(work_dir, 'weather')
+	for dir_path in [flt_dir, wthr_dir]:
+		os.makedirs(dir_path, exist_ok=True)
+	with open(os.path.join(flt_dir, '2022_06_20_10_log.csv'), 'w', newline='') as csv_out:
+		csv_writer = csv.writer(csv_out)
+		csv_writer.writerow(['HexCode', 'Date', 'Time', 'FlightNumber', 'Alt', 'GroundSpeed',
+							 'Squawk', 'Airline', 'NearestHour', 'FlightKey'])
+		csv_writer.writerows(flight_rows())
+	for day in WUNDER_DAYS:
+		with open(os.path.join(wthr_dir, day + '_Weather_log.csv'), 'w', newline='') as csv_out:
+			csv_writer = csv.writer(csv_out)
+			csv_writer.writerow(WEATHER_HEADER)
+			csv_writer.writerows(row for row in wthr_rows if row[0] == day)
+	for mode in ['nearest', 'backward']:
+		output_file = os.path.join(work_dir, mode + '.csv')
+		CombineFltWthr.stream_combine(flt_dir, wthr_dir, work_dir, CombineFltWthr.FULL_HEADER,
+									  output_file=output_file, mode=mode, tolerance_minutes=60)
+		with open(output_file, newline='') as csv_in:
+			problems.extend(check_matches(list(csv.reader(csv_in))[1:], mode, 'streamed'))
+	return(problems)
+
+
+######## Entry #########
+if __name__ == "__main__":
+	work_dir = tempfile.mkdtemp(prefix='join_check_')
+	try:
+		check_problems = check_join(work_dir)
+	finally:
+		shutil.rmtree(work_dir, ignore_errors=True)
+	if check_problems:
+		print("Timestamp join FAILED:")
+		for problem in check_problems:
+			print("  " + problem)
+		sys.exit(1)
+	print("Timestamp join OK")
+	sys.exit(0)
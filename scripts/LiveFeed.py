@@ -0,0 +1,356 @@
+################################################################################
+# LiveFeed.py
+# @author: Ryan Herrin
+#
+# Live flight frequency straight off the dump1090 feed. Every SBS-1 message
+# updates rolling counters (aircraft per minute and per hour, by airline and by
+# altitude band) kept in fixed size ring buffers, and a small asyncio HTTP
+# server hands them out as JSON. A recorded feed can be replayed through the
+# same path to try it out locally.
+################################################################################
+
+'''
+Usage:
+------------------
+python LiveFeed.py                                  # read localhost:30003
+python LiveFeed.py --live-feed <30003_LiveFeed.csv> # also append to the live file
+python LiveFeed.py --replay <raw file> --speed 60   # replay a capture, 60x speed
+python LiveFeed.py --replay <raw file> --speed 0    # as fast as possible
+
+Endpoints (default http://localhost:8090):
+------------------
+/counters        : Everything below in one document
+/counters/minute : Aircraft per minute for the last hour
+/counters/hour   : Aircraft per hour for the last day, by airline and altitude
+/health          : Messages seen and time of the last one
+
+Times come from the message Date/Time columns so a replayed feed is bucketed
+the same way it was when it was captured.
+'''
+
+import sys
+import json
+import time
+import asyncio
+import argparse
+import datetime
+
+from CallsignResolver import get_resolver
+from IngestPipeline import QueueWriter
+from Sketches import RingBuffer, DecayingWindow
+
+
+# Altitude bands (ft) and their names. Anything without an altitude yet goes
+# in 'unknown'
+ALTITUDE_BANDS = [(10000, '0-9999'), (20000, '10000-19999'),
+				  (30000, '20000-29999'), (None, '30000+')]
+
+
+def altitude_band(altitude):
+	'''Name of the altitude band for an altitude string from the feed'''
+	try:
+		altitude = int(altitude)
+	except ValueError:
+		return('unknown')
+	for upper, band in ALTITUDE_BANDS:
+		if upper is None or altitude < upper:
+			return(band)
+
+
+def _summary(aircraft):
+	'''Counts for one exact bucket (hex -> [airline, altitude band])'''
+	by_airline = dict()
+	by_altitude = dict()
+	for airline, band in aircraft.values():
+		by_airline[airline] = by_airline.get(airline, 0) + 1
+		by_altitude[band] = by_altitude.get(band, 0) + 1
+	return({'aircraft': len(aircraft), 'by_airline': by_airline,
+			'by_altitude': by_altitude})
+
+
+def _iso(timestamp):
+	return(datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S"))
+
+
+class LiveCounters:
+	'''Rolling counters for the live feed. update() is called for each SBS row
+	and the JSON documents are only rebuilt when something asks for them after
+	an update, so reads in between are just handing back bytes.
+	
+	With approximate=True the buckets are fixed size sketches (see Sketches.py)
+	instead of a dictionary of every hex, so memory stays the same however
+	busy the sky gets.'''
+	def __init__(self, minutes=60, hours=24, approximate=False, **sketch_args):
+		self.approximate = approximate
+		if approximate:
+			self.per_minute = DecayingWindow(60, minutes, **sketch_args)
+			self.per_hour = DecayingWindow(3600, hours, **sketch_args)
+		else:
+			self.per_minute = RingBuffer(60, minutes)
+			self.per_hour = RingBuffer(3600, hours)
+		# hex -> [airline, altitude band, last seen, minute counted in, hour
+		# counted in]. Aircraft not heard from in an hour are dropped
+		self.known = dict()
+		self.messages = 0
+		self.last_message = None
+		self._next_prune = 0
+		self._day_start = dict() # "YYYY/MM/DD" -> epoch seconds of midnight
+		self._documents = dict() # path -> JSON bytes, cleared on update
+
+	def _timestamp(self, msg_date, msg_time):
+		'''Seconds since the epoch for the Date and Time columns. The day is
+		only worked out once, the rest is slicing.'''
+		day_start = self._day_start.get(msg_date)
+		if day_start is None:
+			day_start = time.mktime(datetime.datetime.strptime(
+				msg_date, "%Y/%m/%d").timetuple())
+			self._day_start[msg_date] = day_start
+		return(day_start + int(msg_time[0:2]) * 3600 + int(msg_time[3:5]) * 60 +
+			   float(msg_time[6:]))
+
+	def update(self, row):
+		'''Count one SBS-1 row (already split on commas)'''
+		if len(row) < 12 or row[0] != 'MSG' or row[4] == '000000':
+			return
+		try:
+			timestamp = self._timestamp(row[6], row[7])
+		except (ValueError, IndexError):
+			timestamp = time.time()
+
+		hex_code = row[4]
+		entry = self.known.get(hex_code)
+		if entry is None:
+			entry = ['NA', 'unknown', timestamp, None, None]
+			self.known[hex_code] = entry
+		old_airline = entry[0]
+		old_band = entry[1]
+		if row[10].strip() != '':
+			entry[0] = get_resolver().airline_code(row[10].strip())
+		if row[11] != '':
+			entry[1] = altitude_band(row[11])
+		entry[2] = timestamp
+
+		for ring, counted in ((self.per_minute, 3), (self.per_hour, 4)):
+			bucket = ring.bucket_for(timestamp)
+			if bucket is None:
+				continue
+			if not self.approximate:
+				bucket[hex_code] = entry[:2]
+				continue
+
+			# Sketches can't tell if a hex was already counted, so the entry
+			# remembers the last bucket it went into
+			bucket_id = ring.bucket_id(timestamp)
+			if entry[counted] != bucket_id:
+				entry[counted] = bucket_id
+				bucket.aircraft.add(hex_code)
+				bucket.airlines.add(entry[0])
+				bucket.by_altitude[entry[1]] = bucket.by_altitude.get(entry[1], 0) + 1
+			else:
+				# Flight number or altitude changed after the aircraft was
+				# counted, so move it over like the exact buckets would
+				if entry[0] != old_airline:
+					bucket.airlines.add(old_airline, -1)
+					bucket.airlines.add(entry[0])
+				if entry[1] != old_band:
+					bucket.by_altitude[old_band] -= 1
+					bucket.by_altitude[entry[1]] = bucket.by_altitude.get(entry[1], 0) + 1
+
+		self.messages += 1
+		if self.last_message is None or timestamp > self.last_message:
+			self.last_message = timestamp
+			self._forget_old(timestamp)
+		self._documents = dict()
+
+	def _forget_old(self, now):
+		'''Drop aircraft we haven't heard from in an hour, once a minute'''
+		if now < self._next_prune:
+			return
+		self._next_prune = now + 60
+		for hex_code in [hex_code for hex_code, entry in self.known.items()
+						 if now - entry[2] > 3600]:
+			del self.known[hex_code]
+
+	def update_lines(self, lines):
+		for line in lines:
+			self.update(line.rstrip('\r\n').split(','))
+
+	def _bucket_summary(self, bucket):
+		if self.approximate:
+			return(bucket.summary())
+		return(_summary(bucket))
+
+	def minute_counts(self):
+		return([{'start': _iso(start), 'aircraft': self._bucket_summary(bucket)['aircraft']}
+				for start, bucket in self.per_minute.windows()])
+
+	def hour_counts(self):
+		hours = []
+		for start, bucket in self.per_hour.windows():
+			summary = self._bucket_summary(bucket)
+			summary['start'] = _iso(start)
+			hours.append(summary)
+		return(hours)
+
+	def health(self):
+		return({'messages': self.messages, 'tracked_aircraft': len(self.known),
+				'last_message': None if self.last_message is None else
+				_iso(self.last_message)})
+
+	def counters(self):
+		if self.approximate:
+			# Buckets can't be unioned by hex, so the airline and altitude
+			# counts here are aircraft-minutes. The aircraft count is unique.
+			last_hour = self.per_minute.merged().summary()
+			last_hour['units'] = 'aircraft_minutes'
+		else:
+			last_hour = dict()
+			for start, bucket in self.per_minute.windows():
+				last_hour.update(bucket)
+			last_hour = _summary(last_hour)
+		return({'health': self.health(), 'last_60_minutes': last_hour,
+				'per_minute': self.minute_counts(), 'per_hour': self.hour_counts()})
+
+	def document(self, path):
+		'''JSON bytes for an endpoint path, or None if there isn't one'''
+		found = self._documents.get(path)
+		if found is not None:
+			return(found)
+		builders = {'/counters': self.counters, '/counters/minute': self.minute_counts,
+					'/counters/hour': self.hour_counts, '/health': self.health}
+		if path not in builders:
+			return(None)
+		found = json.dumps(builders[path]()).encode()
+		self._documents[path] = found
+		return(found)
+
+
+############ HTTP ###########
+async def _handle_http(counters, reader, writer):
+	'''Answer one GET request with the counters as JSON'''
+	try:
+		request_line = await reader.readline()
+		# Read the rest of the headers, we don't need any of them
+		while True:
+			header = await reader.readline()
+			if header in (b'\r\n', b'\n', b''):
+				break
+
+		parts = request_line.decode('latin-1').split()
+		path = parts[1].split('?')[0] if len(parts) > 1 else '/'
+		body = counters.document(path.rstrip('/') or '/counters')
+		status = '200 OK'
+		if body is None:
+			status = '404 Not Found'
+			body = json.dumps({'error': 'unknown path', 'path': path}).encode()
+
+		writer.write("HTTP/1.1 {}\r\nContent-Type: application/json\r\n".format(status)
+					 .encode() + "Content-Length: {}\r\nConnection: close\r\n\r\n"
+					 .format(len(body)).encode() + body)
+		await writer.drain()
+	except Exception as err:
+		print("HTTP error: {}".format(err))
+	finally:
+		writer.close()
+
+
+async def serve_http(counters, host='127.0.0.1', port=8090):
+	'''Start the JSON endpoint. Returns the asyncio server.'''
+	server = await asyncio.start_server(
+		lambda reader, writer: _handle_http(counters, reader, writer), host, port)
+	print("Serving counters on http://{}:{}/counters".format(host, port))
+	return(server)
+
+
+############ Feeds ###########
+async def follow_sbs_socket(counters, host='localhost', port=30003, live_feed_loc=None,
+							metrics=None, queue_lines=8192):
+	'''Count the dump1090 SBS feed, and append it to the live feed file if one
+	is given so the snapshots still get everything. The file is written by an
+	IngestPipeline.QueueWriter thread, so a slow SD card never holds up the
+	loop. If the writer falls queue_lines behind, lines are dropped from the
+	file (not the counters) and counted as write_queue_dropped.'''
+	reader, writer = await asyncio.open_connection(host, port)
+	live_writer = None
+	if live_feed_loc:
+		live_writer = QueueWriter(live_feed_loc, metrics, queue_batches=queue_lines,
+								  max_stall=0, write_batches=256)
+	try:
+		while True:
+			line = await reader.readline()
+			if not line:
+				break
+			if live_writer is not None:
+				live_writer.put(line)
+			counters.update(line.decode('latin-1').rstrip('\r\n').split(','))
+	finally:
+		writer.close()
+		if live_writer is not None:
+			# Waits for the last writes, off the loop
+			await asyncio.get_running_loop().run_in_executor(None, live_writer.close)
+			dropped = live_writer.metrics.counters.get('write_queue_dropped', 0)
+			if dropped:
+				print("Live feed writer fell behind, {} lines not written".format(dropped))
+
+
+async def replay_file(counters, raw_path, speed=0.0):
+	'''Feed a recorded raw file through the counters. speed is how many times
+	faster than real time to go, 0 for as fast as possible.'''
+	first_msg = None
+	first_wall = time.monotonic()
+	with open(raw_path, 'r', newline='') as raw_in:
+		for line_num, line in enumerate(raw_in):
+			row = line.rstrip('\r\n').split(',')
+			if speed > 0 and len(row) > 7 and row[0] == 'MSG':
+				try:
+					msg_time = counters._timestamp(row[6], row[7])
+				except (ValueError, IndexError):
+					msg_time = None
+				if msg_time is not None:
+					if first_msg is None:
+						first_msg = msg_time
+					delay = (msg_time - first_msg) / speed - (time.monotonic() - first_wall)
+					if delay > 0:
+						await asyncio.sleep(delay)
+			elif line_num % 1000 == 0:
+				# Let the HTTP server answer while replaying flat out
+				await asyncio.sleep(0)
+			counters.update(row)
+	print("Replay finished: {} messages".format(counters.messages))
+
+
+async def run_live(counters, feed, http_host='127.0.0.1', http_port=8090):
+	'''Run a feed coroutine with the HTTP endpoint next to it. Keeps serving
+	after the feed ends until interrupted.'''
+	server = await serve_http(counters, http_host, http_port)
+	async with server:
+		await feed
+		await server.serve_forever()
+
+
+######## Entry #########
+if __name__ == "__main__":
+	arg_parser = argparse.ArgumentParser(description="Live flight frequency counters")
+	arg_parser.add_argument('--host', default='localhost', help="dump1090 host")
+	arg_parser.add_argument('--port', type=int, default=30003, help="dump1090 SBS port")
+	arg_parser.add_argument('--live-feed', default=None,
+							help="Also append the feed to this file")
+	arg_parser.add_argument('--replay', default=None, help="Replay a raw file instead")
+	arg_parser.add_argument('--speed', type=float, default=0.0,
+							help="Replay speed multiplier, 0 for as fast as possible")
+	arg_parser.add_argument('--approximate', action='store_true',
+							help="Fixed size sketches instead of exact hex sets")
+	arg_parser.add_argument('--http-host', default='127.0.0.1')
+	arg_parser.add_argument('--http-port', type=int, default=8090)
+	args = arg_parser.parse_args()
+
+	live_counters = LiveCounters(approximate=args.approximate)
+	if args.replay:
+		live_feed = replay_file(live_counters, args.replay, args.speed)
+	else:
+		live_feed = follow_sbs_socket(live_counters, args.host, args.port, args.live_feed)
+
+	try:
+		asyncio.run(run_live(live_counters, live_feed, args.http_host, args.http_port))
+	except KeyboardInterrupt:
+		sys.exit(0)
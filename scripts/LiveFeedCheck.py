@@ -0,0 +1,115 @@
+################################################################################
+# LiveFeedCheck.py
+# @author: Ryan Herrin
+#
+# Check that appending to the live feed file never holds up the live counters.
+# The live file is a named pipe nobody reads yet, so every write to it blocks
+# for as long as we like. The whole sample feed has to be counted while it is
+# blocked, and once the pipe is read every line has to come out of it or be
+# counted as dropped.
+################################################################################
+
+'''
+Usage:
+------------------
+python LiveFeedCheck.py
+python LiveFeedCheck.py --sample ../data/adsb_sample_data/30003_Sample_Data.csv
+'''
+
+import os
+import sys
+import time
+import shutil
+import socket
+import asyncio
+import argparse
+import tempfile
+import threading
+
+import LiveFeed
+from Metrics import Metrics
+
+
+def _serve_file(sample_path):
+	'''Local SBS port that sends the sample feed once and hangs up. Returns
+	(port, thread).'''
+	server = socket.create_server(('localhost', 0))
+	port = server.getsockname()[1]
+
+	def send():
+		conn = server.accept()[0]
+		with open(sample_path, 'rb') as sample_in:
+			conn.sendall(sample_in.read())
+		conn.close()
+		server.close()
+
+	sending = threading.Thread(target=send, daemon=True)
+	sending.start()
+	return(port, sending)
+
+
+def check_blocked_file(work_dir, sample_path, queue_lines=256):
+	'''Returns a list of what went wrong, empty if it all checked out'''
+	problems = []
+	expected = LiveFeed.LiveCounters()
+	with open(sample_path, 'r', encoding='latin-1', newline='') as sample_in:
+		lines = sample_in.readlines()
+	for line in lines:
+		expected.update(line.rstrip('\r\n').split(','))
+
+	fifo_path = os.path.join(work_dir, 'live_feed.fifo')
+	os.mkfifo(fifo_path)
+	port, sending = _serve_file(sample_path)
+	counters = LiveFeed.LiveCounters()
+	metrics = Metrics('live')
+
+	async def follow():
+		feed = asyncio.ensure_future(LiveFeed.follow_sbs_socket(
+			counters, 'localhost', port, fifo_path, metrics, queue_lines))
+		deadline = time.monotonic() + 10.0
+		while counters.messages < expected.messages and time.monotonic() < deadline:
+			await asyncio.sleep(0.01)
+		if counters.messages < expected.messages:
+			problems.append("{} of {} messages counted while the live file was "
+							"blocked".format(counters.messages, expected.messages))
+		# Let the file be written now, the feed finishes once it is
+		read_lines = []
+		reading = threading.Thread(target=lambda: read_lines.extend(
+			open(fifo_path, 'rb').readlines()), daemon=True)
+		reading.start()
+		await asyncio.wait_for(feed, 10.0)
+		reading.join(10.0)
+		return(read_lines)
+
+	written = asyncio.run(follow())
+	sending.join(5.0)
+	dropped = metrics.counters.get('write_queue_dropped', 0)
+	if len(written) + dropped != len(lines):
+		problems.append("{} lines written and {} dropped out of {}".format(
+			len(written), dropped, len(lines)))
+	if len(written) < queue_lines:
+		problems.append("only {} lines written, the queue holds {}".format(
+			len(written), queue_lines))
+	return(problems)
+
+
+######## Entry #########
+if __name__ == "__main__":
+	arg_parser = argparse.ArgumentParser(description="Check a slow live file doesn't stall the counters")
+	arg_parser.add_argument('--sample', default=os.path.join(
+		os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'adsb_sample_data',
+		'30003_Sample_Data.csv'), help="Feed to count")
+	args = arg_parser.parse_args()
+
+	work_dir = tempfile.mkdtemp(prefix='live_feed_check_')
+	try:
+		check_problems = check_blocked_file(work_dir, args.sample)
+	finally:
+		shutil.rmtree(work_dir, ignore_errors=True)
+	if check_problems:
+		print("Blocked live file FAILED:")
+		for problem in check_problems:
+			print("  " + problem)
+		sys.exit(1)
+	print("Blocked live file OK")
+	sys.exit(0)
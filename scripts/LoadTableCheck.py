@@ -0,0 +1,173 @@
+################################################################################
+# LoadTableCheck.py
+# @author: Ryan Herrin
+#
+# Check for the table checks in DataStaxAstra without a cluster. A fake
+# session has the cluster metadata of a few tables: one bulk_load_csv can
+# write to, one keyed by hex and time like before FlightKey, one with an int
+# column and none at all. Loading a combined CSV has to stop before anything
+# is sent for all but the first, and migrating the old table has to give one
+# the load accepts, with the rows that had a FlightKey copied as text.
+################################################################################
+
+'''
+Usage:
+------------------
+python LoadTableCheck.py
+'''
+
+import os
+import re
+import csv
+import sys
+import shutil
+import tempfile
+
+from CombineFltWthr import FULL_HEADER
+from DStaxAstraControl import DataStaxAstra
+
+
+KEYSPACE = 'flights'
+
+
+class FakeColumn:
+	def __init__(self, name, cql_type):
+		self.name = name
+		self.cql_type = cql_type
+
+
+class FakeTable:
+	'''Table metadata like the driver's: primary_key and columns'''
+	def __init__(self, columns, primary_key, rows=()):
+		self.columns = dict((name, FakeColumn(name, cql_type)) for name, cql_type in columns)
+		self.primary_key = [self.columns[name] for name in primary_key]
+		self.rows = list(rows)
+
+
+class FakeResults(list):
+	def __init__(self, column_names, rows):
+		list.__init__(self, rows)
+		self.column_names = column_names
+
+
+class FakeStatement:
+	def __init__(self, table, columns):
+		self.table = table
+		self.columns = columns
+
+	def bind(self, values):
+		return((self, values))
+
+
+class FakeSession:
+	'''Answers CREATE TABLE, SELECT * and prepared INSERTs against the tables,
+	and counts every statement it is asked to prepare or run'''
+	def __init__(self, tables):
+		self.tables = tables
+		self.prepared = 0
+		self.inserted = []
+		keyspace = type('Keyspace', (), {'tables': tables})
+		metadata = type('Metadata', (), {'keyspaces': {KEYSPACE: keyspace}})
+		self.cluster = type('Cluster', (), {'metadata': metadata})
+
+	def prepare(self, query):
+		self.prepared += 1
+		table = re.match(r'INSERT INTO \w+\.(\w+)', query).group(1)
+		return(FakeStatement(table, re.findall(r'"(\w+)"', query)))
+
+	def execute(self, query):
+		if isinstance(query, tuple):
+			statement, values = query
+			self.inserted.append(dict(zip(statement.columns, values)))
+			return(None)
+		created = re.match(r'CREATE TABLE IF NOT EXISTS \w+\.(\w+)', query)
+		if created:
+			if created.group(1) not in self.tables:
+				self.tables[created.group(1)] = FakeTable(
+					re.findall(r'"(\w+)" (\w+)', query),
+					re.search(r'PRIMARY KEY \("(\w+)"\)', query).groups())
+			return(None)
+		table = self.tables[re.match(r'SELECT \* FROM \w+\.(\w+)', query).group(1)]
+		names = list(table.columns)
+		return(FakeResults(names, [tuple(row.get(name) for name in names)
+								   for row in table.rows]))
+
+
+def make_tables():
+	good = FakeTable([(col, 'text') for col in FULL_HEADER], ['FlightKey'])
+	# Before FlightKey: keyed by hex and time, Alt as an int, no FlightKey on
+	# the rows loaded before it existed
+	old_cols = [(col, 'int' if col == 'Alt' else 'text') for col in FULL_HEADER]
+	old_rows = [
+		{'HexCode': 'A4CA66', 'Date': '2022-06-20', 'Time': '23:32:06', 'Alt': 3500,
+		 'FlightKey': 'A4CA66_20220620233206'},
+		{'HexCode': 'A12345', 'Date': '2022-06-20', 'Time': '23:40:00', 'Alt': None,
+		 'FlightKey': 'A12345_20220620234000'},
+		{'HexCode': 'ABCDEF', 'Date': '2022-06-19', 'Time': '10:00:00', 'Alt': 1200}]
+	old = FakeTable(old_cols, ['HexCode', 'Time'], old_rows)
+	typed = FakeTable(old_cols, ['FlightKey'])
+	return({'f_data': good, 'f_data_old': old, 'f_data_typed': typed})
+
+
+def check_tables(work_dir):
+	'''Returns a list of what went wrong, empty if it all checked out'''
+	problems = []
+	csv_path = os.path.join(work_dir, '2022_06_20_full.csv')
+	with open(csv_path, 'w', newline='') as csv_out:
+		csv.writer(csv_out).writerow(FULL_HEADER)
+
+	def load_error(session, table):
+		db_conn = DataStaxAstra()
+		db_conn.set_keyspace(KEYSPACE)
+		try:
+			db_conn.bulk_load_csv(session, table, csv_path)
+		except ValueError as err:
+			return(str(err))
+		except ImportError:
+			# Got past the check to the driver, which isn't needed for the rest
+			return(None)
+		return(None)
+
+	session = FakeSession(make_tables())
+	if load_error(session, 'f_data') is not None:
+		problems.append("the FlightKey table was refused: " + load_error(session, 'f_data'))
+	for table, expected in [('f_data_old', 'primary key is (HexCode, Time)'),
+							('f_data_typed', 'Alt int'), ('missing', 'no such table')]:
+		prepared = session.prepared
+		error = load_error(session, table)
+		if error is None or expected not in error:
+			problems.append("{}: load error {!r} doesn't say {!r}".format(table, error,
+																		  expected))
+		if session.prepared != prepared:
+			problems.append("{}: an INSERT was prepared before the check".format(table))
+
+	db_conn = DataStaxAstra()
+	db_conn.set_keyspace(KEYSPACE)
+	copied, skipped = db_conn.migrate_load_table(session, 'f_data_old', 'f_data_v2')
+	if (copied, skipped) != (2, 1):
+		problems.append("migrate copied {} and skipped {}, not 2 and 1".format(copied, skipped))
+	if load_error(session, 'f_data_v2') is not None:
+		problems.append("the migrated table was refused: " + load_error(session, 'f_data_v2'))
+	migrated = dict((row['FlightKey'], row) for row in session.inserted)
+	first = migrated.get('A4CA66_20220620233206', {})
+	if first.get('Alt') != '3500' or first.get('Temp') != '':
+		problems.append("migrated row is {}".format(first))
+	if migrated.get('A12345_20220620234000', {}).get('Alt') != '':
+		problems.append("a missing Alt wasn't migrated as empty")
+	return(problems)
+
+
+######## Entry #########
+if __name__ == "__main__":
+	work_dir = tempfile.mkdtemp(prefix='load_table_check_')
+	try:
+		check_problems = check_tables(work_dir)
+	finally:
+		shutil.rmtree(work_dir, ignore_errors=True)
+	if check_problems:
+		print("Load table FAILED:")
+		for problem in check_problems:
+			print("  " + problem)
+		sys.exit(1)
+	print("Load table OK")
+	sys.exit(0)
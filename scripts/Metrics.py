@@ -0,0 +1,135 @@
+################################################################################
+# Metrics.py
+# @author: Ryan Herrin
+#
+# Lightweight timing and counters for the pipeline. Each class/step records
+# how long its stages took and how many rows it went through, and a run can
+# be written out as one JSON file so we can watch for slow downs on the Pi.
+################################################################################
+
+'''
+Stage names used across the scripts:
+------------------
+read, parse, merge, format, callsign, write   (TenNinty_Parser)
+fetch, parse, convert, write          (Weather)
+read, join, write                     (CombineFltWthr)
+query                                 (DataStaxAstra)
+
+cProfile and tracemalloc are only turned on when asked for, since both slow
+the run down (Tracker.py --profile / --trace-memory). tracemalloc is one per
+process, so when stages run at the same time it stays on until the last of
+them stops, and each one's peak covers the others too.
+'''
+
+import os
+import json
+import time
+import platform
+import datetime
+import threading
+import contextlib
+
+
+# Runs that have tracemalloc on right now
+_tracing_lock = threading.Lock()
+_tracing_runs = [0]
+
+
+class Metrics:
+	"""Collects stage timers and counters for one run"""
+	def __init__(self, run_name='run', profile=False, trace_memory=False):
+		self.run_name = run_name
+		self.started = datetime.datetime.now()
+		self.stages = dict()   # name -> [seconds, calls]
+		self.counters = dict() # name -> value
+		self.profile = profile
+		self.trace_memory = trace_memory
+		self._profiler = None
+		self._tracing = False
+		self._capture_start = None
+
+	@contextlib.contextmanager
+	def stage(self, name):
+		"""Time the code inside the with block and add it to the stage"""
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			elapsed = time.perf_counter() - start
+			curr = self.stages.setdefault(name, [0.0, 0])
+			curr[0] += elapsed
+			curr[1] += 1
+
+	def count(self, name, amount=1):
+		"""Add to a counter"""
+		self.counters[name] = self.counters.get(name, 0) + amount
+
+	def start_capture(self):
+		"""Start cProfile and/or tracemalloc if they were turned on"""
+		self._capture_start = time.perf_counter()
+		if self.trace_memory and not self._tracing:
+			import tracemalloc
+			with _tracing_lock:
+				if not tracemalloc.is_tracing():
+					tracemalloc.start()
+				_tracing_runs[0] += 1
+			self._tracing = True
+		if self.profile and self._profiler is None:
+			import cProfile
+			self._profiler = cProfile.Profile()
+			try:
+				# Profiles the thread it is started from
+				self._profiler.enable()
+			except ValueError as err:
+				print("Could not start cProfile for {}: {}".format(self.run_name, err))
+				self._profiler = None
+
+	def stop_capture(self):
+		"""Stop whatever start_capture started"""
+		if self._profiler is not None:
+			self._profiler.disable()
+		if self._tracing:
+			import tracemalloc
+			with _tracing_lock:
+				if tracemalloc.is_tracing():
+					curr_bytes, peak_bytes = tracemalloc.get_traced_memory()
+					self.counters['memory_peak_bytes'] = peak_bytes
+				_tracing_runs[0] -= 1
+				if _tracing_runs[0] == 0:
+					tracemalloc.stop()
+			self._tracing = False
+		if self._capture_start is not None:
+			self.stages.setdefault('total', [0.0, 0])
+			self.stages['total'][0] += time.perf_counter() - self._capture_start
+			self.stages['total'][1] += 1
+			self._capture_start = None
+
+	def to_dict(self):
+		"""Return the metrics as a dictionary ready for JSON"""
+		return({
+			'run': self.run_name,
+			'started': self.started.isoformat(timespec='seconds'),
+			'host': platform.node(),
+			'stages': {name: {'seconds': round(vals[0], 6), 'calls': vals[1]}
+					   for name, vals in self.stages.items()},
+			'counters': dict(self.counters),
+			})
+
+	def write_json(self, metrics_dir):
+		"""Write the run out to <metrics_dir>/<run>_<time>_metrics.json. If
+		profiling was on, the cProfile stats go next to it as a .prof file.
+		Returns the path of the JSON file."""
+		self.stop_capture()
+		os.makedirs(metrics_dir, exist_ok=True)
+		file_base = os.path.join(metrics_dir, "{}_{}".format(
+			self.run_name, self.started.strftime("%Y_%m_%d_%H%M%S")))
+
+		metrics_dict = self.to_dict()
+		if self._profiler is not None:
+			self._profiler.dump_stats(file_base + '.prof')
+			metrics_dict['profile'] = file_base + '.prof'
+
+		with open(file_base + '_metrics.json', 'w') as json_out:
+			json.dump(metrics_dict, json_out, indent=2)
+
+		return(file_base + '_metrics.json')
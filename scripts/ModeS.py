@@ -0,0 +1,483 @@
+################################################################################
+# ModeS.py
+# @author: Ryan Herrin
+#
+# Decodes raw Mode-S frames from dump1090's Beast binary output (port 30005)
+# or AVR text frames and turns them into the same SBS-1 rows that the 30003
+# text feed produces, so TenNinty_Parser can use them without changes.
+################################################################################
+
+'''
+Decoded messages:
+------------------
+DF17 TC 1-4, Identification (Callsign)         -> MSG,1
+DF17 TC 9-18, Airborne position (Alt, Lat/Lon)  -> MSG,3
+DF17 TC 19, Airborne velocity (GS, Track, VR)   -> MSG,4
+DF5 / DF21, Identity reply (Squawk)            -> MSG,6
+
+Frames are turned into one integer each and every field is pulled out with
+shifts and masks. dump1090 only forwards Beast frames that passed its CRC
+check, so the CRC is only checked here when asked for.
+
+Beast frames carry a 48 bit timestamp from the receiver's 12 MHz clock. When
+a frame has one, its row is stamped from it: the first timestamped frame is
+the capture start (the wall clock when none is given) and later frames are
+that plus the ticks since. Frames without one, and AVR frames, get the time
+their batch was decoded.
+
+python ModeS.py frames.beast      # print the SBS rows of a recording
+python ModeS.py frames.beast --capture-start "2022-06-20 12:00:00"
+python ModeS.py --check           # decode the recorded fixtures in
+                                  # data/adsb_sample_data and compare
+'''
+
+import os
+import sys
+import math
+import socket
+import argparse
+import datetime
+
+
+# Characters used by the identification message
+_ID_CHARS = "#ABCDEFGHIJKLMNOPQRSTUVWXYZ##### ###############0123456789######"
+
+# Mode-S CRC-24 generator and a lookup table for it
+_CRC_GENERATOR = 0xFFF409
+_CRC_TABLE = []
+for _byte in range(256):
+	_crc = _byte << 16
+	for _bit in range(8):
+		_crc = _crc << 1
+		if _crc & 0x1000000:
+			_crc = _crc ^ _CRC_GENERATOR
+	_CRC_TABLE.append(_crc & 0xFFFFFF)
+
+# Beast frame types and the length of the Mode-S data that follows the
+# 6 byte timestamp and 1 byte signal level
+_BEAST_ESCAPE = 0x1a
+_BEAST_LENGTHS = {0x31: 2, 0x32: 7, 0x33: 14}
+# Ticks per second of the timestamp, and where the 48 bit counter wraps
+MLAT_HZ = 12000000
+_MLAT_WRAP = 1 << 48
+
+# How long an even/odd position pair can be apart and still be used
+_CPR_MAX_AGE = 10.0
+
+# Recorded frames and what they decode to: (msg type, hex, callsign, alt, gs,
+# track, lat, lon, vr, squawk). The odd position frame is the newer of the
+# pair, so the position is the odd one's (the even one's is 52.2572/3.91937).
+# The Beast frames are one second apart.
+SAMPLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data',
+						  'adsb_sample_data')
+SAMPLE_EXPECTED = [
+	('1', '4840D6', 'KLM1023 ', '', '', '', '', '', '', ''),
+	('4', '485020', '', '', '159', '183', '', '', '-832', ''),
+	('3', '40621D', '', '38000', '', '', '', '', '', ''),
+	('3', '40621D', '', '38000', '', '', '52.26578', '3.93891', '', '')]
+SAMPLE_BEAST_TIMES = ['12:00:00.000', '12:00:01.000', '12:00:02.000', '12:00:03.000']
+
+
+def mode_s_crc(frame):
+	'''Returns the CRC remainder of a whole frame. A valid DF17 gives 0 and
+	for DF4/5/20/21 it gives the aircraft address.'''
+	crc = 0
+	for byte in frame[:-3]:
+		crc = ((crc << 8) & 0xFFFFFF) ^ _CRC_TABLE[((crc >> 16) ^ byte) & 0xFF]
+	return(crc ^ int.from_bytes(frame[-3:], 'big'))
+
+
+def read_beast_frames(buffer, with_mlat=False):
+	'''Split a buffer of Beast binary data into Mode-S frames. Returns the list
+	of frames and whatever bytes are left over from a frame that is not
+	complete yet (for reading from a socket). With with_mlat each frame is a
+	(timestamp ticks, frame) pair, 0 ticks meaning the frame has none.'''
+	frames = []
+	pos = 0
+	buf_len = len(buffer)
+
+	while pos < buf_len:
+		# Find the start of the next frame
+		if buffer[pos] != _BEAST_ESCAPE:
+			pos += 1
+			continue
+		if pos + 1 >= buf_len:
+			return(frames, bytes(buffer[pos:]))
+
+		frame_len = _BEAST_LENGTHS.get(buffer[pos + 1])
+		if frame_len is None:
+			pos += 1
+			continue
+
+		# Unescape the timestamp, signal and data. A 0x1a in the data is sent
+		# as 0x1a 0x1a
+		body = bytearray()
+		need = 7 + frame_len
+		scan = pos + 2
+		while len(body) < need and scan < buf_len:
+			byte = buffer[scan]
+			if byte == _BEAST_ESCAPE:
+				if scan + 1 >= buf_len:
+					break
+				if buffer[scan + 1] != _BEAST_ESCAPE:
+					# Start of a new frame, so this one was cut short
+					break
+				scan += 1
+			body.append(byte)
+			scan += 1
+
+		if len(body) < need:
+			if scan >= buf_len - 1:
+				# Not all of the frame is here yet
+				return(frames, bytes(buffer[pos:]))
+			pos = scan
+			continue
+
+		# Mode A/C frames are not used
+		if frame_len != 2:
+			if with_mlat:
+				frames.append((int.from_bytes(body[:6], 'big'), bytes(body[7:])))
+			else:
+				frames.append(bytes(body[7:]))
+		pos = scan
+
+	return(frames, b'')
+
+
+def read_avr_frames(lines):
+	'''Pull Mode-S frames out of AVR text lines. Handles "*...;" frames and the
+	"@" frames that have a 12 hex digit timestamp in front.'''
+	frames = []
+	for line in lines:
+		line = line.strip()
+		if len(line) < 3 or line[-1] != ';':
+			continue
+		if line[0] == '*':
+			hex_frame = line[1:-1]
+		elif line[0] == '@':
+			hex_frame = line[13:-1]
+		else:
+			continue
+
+		# Only short (56 bit) and long (112 bit) frames
+		if len(hex_frame) not in (14, 28):
+			continue
+		try:
+			frames.append(bytes.fromhex(hex_frame))
+		except ValueError:
+			continue
+
+	return(frames)
+
+
+def _cpr_nl(lat):
+	'''Number of longitude zones for a latitude'''
+	if lat == 0:
+		return(59)
+	if abs(lat) == 87:
+		return(2)
+	if abs(lat) > 87:
+		return(1)
+
+	tmp = 1 - (1 - math.cos(math.pi / 30)) / math.cos(math.pi / 180 * abs(lat)) ** 2
+	return(int(math.floor(2 * math.pi / math.acos(tmp))))
+
+
+def cpr_global_position(even, odd, even_is_newest):
+	'''Global airborne CPR decode from an even and an odd (lat, lon) pair. The
+	values are the raw 17 bit numbers. Returns (lat, lon) or None if the pair
+	straddles a latitude zone.'''
+	lat_e = even[0] / 131072.0
+	lon_e = even[1] / 131072.0
+	lat_o = odd[0] / 131072.0
+	lon_o = odd[1] / 131072.0
+
+	j = int(math.floor(59 * lat_e - 60 * lat_o + 0.5))
+	lat_even = (360.0 / 60) * (j % 60 + lat_e)
+	lat_odd = (360.0 / 59) * (j % 59 + lat_o)
+	if lat_even >= 270:
+		lat_even = lat_even - 360
+	if lat_odd >= 270:
+		lat_odd = lat_odd - 360
+
+	nl = _cpr_nl(lat_even)
+	if nl != _cpr_nl(lat_odd):
+		return(None)
+
+	if even_is_newest:
+		lat = lat_even
+		ni = max(nl, 1)
+		m = int(math.floor(lon_e * (nl - 1) - lon_o * nl + 0.5))
+		lon = (360.0 / ni) * (m % ni + lon_e)
+	else:
+		lat = lat_odd
+		ni = max(nl - 1, 1)
+		m = int(math.floor(lon_e * (nl - 1) - lon_o * nl + 0.5))
+		lon = (360.0 / ni) * (m % ni + lon_o)
+
+	if lon >= 180:
+		lon = lon - 360
+
+	return(round(lat, 5), round(lon, 5))
+
+
+def _sbs_stamp(when):
+	'''(date, time) strings for an SBS row'''
+	return((when.strftime("%Y/%m/%d"),
+			when.strftime("%H:%M:%S.") + "{:03d}".format(when.microsecond // 1000)))
+
+
+def _decode_squawk(id_code):
+	'''Turn the 13 bit identity field into the 4 digit squawk'''
+	bits = [(id_code >> (12 - pos)) & 1 for pos in range(13)]
+	# Bit order: C1 A1 C2 A2 C4 A4 X B1 D1 B2 D2 B4 D4
+	a = bits[1] + bits[3] * 2 + bits[5] * 4
+	b = bits[7] + bits[9] * 2 + bits[11] * 4
+	c = bits[0] + bits[2] * 2 + bits[4] * 4
+	d = bits[8] + bits[10] * 2 + bits[12] * 4
+	return("{}{}{}{}".format(a, b, c, d))
+
+
+class ModeS_Decoder:
+	'''Decodes Mode-S frames into SBS-1 rows. Keeps the last even and odd
+	position of every aircraft so positions can be decoded globally.'''
+	def __init__(self, check_crc=False, clock=None, capture_start=None):
+		self.check_crc = check_crc
+		# Function that returns the time to stamp each row with
+		self.clock = clock if clock is not None else datetime.datetime.now
+		# Time of the first Beast timestamp, and that timestamp once seen
+		self.capture_start = capture_start
+		self.first_mlat = None
+		self.cpr_state = dict() # hex -> [even, even_time, odd, odd_time]
+		self.known_hex = set()
+		self.frames_seen = 0
+		self.frames_bad = 0
+
+	def _sbs_row(self, msg_type, hex_code, stamp, callsign='', alt='', gs='',
+				 track='', lat='', lon='', vr='', squawk=''):
+		'''Build a row laid out like the 30003 BaseStation output. stamp is the
+		(date, time) strings for the batch.'''
+		msg_date, msg_time = stamp
+		return(['MSG', str(msg_type), '111', '11111', hex_code, '111111',
+				msg_date, msg_time, msg_date, msg_time, callsign, str(alt),
+				str(gs), str(track), str(lat), str(lon), str(vr), squawk,
+				'', '', '', ''])
+
+	def _mlat_time(self, ticks):
+		'''When a frame with this Beast timestamp was received'''
+		if self.first_mlat is None:
+			self.first_mlat = ticks
+			if self.capture_start is None:
+				self.capture_start = self.clock()
+		return(self.capture_start + datetime.timedelta(
+			seconds=((ticks - self.first_mlat) % _MLAT_WRAP) / MLAT_HZ))
+
+	def decode(self, frame, now=None):
+		'''Decode one frame. Returns a list of SBS rows, which is empty if the
+		frame is not one of the types we use.'''
+		return(self.decode_batch([frame], now))
+
+	def decode_batch(self, frames, now=None):
+		'''Decode a batch of frames that were received together. Frames can be
+		(Beast timestamp, frame) pairs from read_beast_frames(with_mlat=True),
+		which are stamped with their own time.'''
+		if now is None:
+			now = self.clock()
+		batch_secs = now.timestamp()
+		# Frames without a timestamp get the time of the batch
+		batch_stamp = _sbs_stamp(now)
+		rows = []
+
+		for frame in frames:
+			self.frames_seen += 1
+			stamp = batch_stamp
+			now_secs = batch_secs
+			if type(frame) is tuple:
+				ticks, frame = frame
+				if ticks:
+					frame_time = self._mlat_time(ticks)
+					stamp = _sbs_stamp(frame_time)
+					now_secs = frame_time.timestamp()
+			msg = int.from_bytes(frame, 'big')
+			df = msg >> (len(frame) * 8 - 5)
+
+			if df == 17 and len(frame) == 14:
+				if self.check_crc and mode_s_crc(frame) != 0:
+					self.frames_bad += 1
+					continue
+				row = self._decode_df17(msg, stamp, now_secs)
+				if row is not None:
+					rows.append(row)
+
+			elif df == 5 or (df == 21 and len(frame) == 14):
+				# The address is hidden in the parity, so only trust it for
+				# aircraft we have already seen an extended squitter from
+				hex_code = "{:06X}".format(mode_s_crc(frame))
+				if hex_code not in self.known_hex:
+					continue
+				id_code = (msg >> (len(frame) * 8 - 32)) & 0x1FFF
+				rows.append(self._sbs_row(6, hex_code, stamp,
+										  squawk=_decode_squawk(id_code)))
+
+		return(rows)
+
+	def _decode_df17(self, msg, stamp, now_secs):
+		'''Decode the ME field of an extended squitter'''
+		hex_code = "{:06X}".format((msg >> 80) & 0xFFFFFF)
+		me = (msg >> 24) & 0xFFFFFFFFFFFFFF
+		tc = me >> 51
+		self.known_hex.add(hex_code)
+
+		if 1 <= tc <= 4:
+			callsign = ''.join(_ID_CHARS[(me >> (42 - 6 * pos)) & 0x3F]
+							   for pos in range(8))
+			return(self._sbs_row(1, hex_code, stamp, callsign=callsign))
+
+		if 9 <= tc <= 18:
+			alt = ''
+			alt_code = (me >> 36) & 0xFFF
+			# Only the 25ft (Q bit set) encoding is decoded
+			if alt_code & 0x10:
+				alt = (((alt_code & 0xFE0) >> 1) | (alt_code & 0x0F)) * 25 - 1000
+
+			lat = ''
+			lon = ''
+			cpr = (((me >> 17) & 0x1FFFF), me & 0x1FFFF)
+			odd = (me >> 34) & 1
+			state = self.cpr_state.setdefault(hex_code, [None, 0.0, None, 0.0])
+			if odd:
+				state[2] = cpr; state[3] = now_secs
+			else:
+				state[0] = cpr; state[1] = now_secs
+
+			if (state[0] is not None and state[2] is not None and
+					abs(state[1] - state[3]) <= _CPR_MAX_AGE):
+				position = cpr_global_position(state[0], state[2], not odd)
+				if position is not None:
+					lat, lon = position
+
+			return(self._sbs_row(3, hex_code, stamp, alt=alt, lat=lat, lon=lon))
+
+		if tc == 19:
+			subtype = (me >> 48) & 0x7
+			if subtype not in (1, 2):
+				return(None)
+
+			v_ew = ((me >> 32) & 0x3FF) - 1
+			v_ns = ((me >> 21) & 0x3FF) - 1
+			if v_ew < 0 or v_ns < 0:
+				return(None)
+			if subtype == 2:
+				v_ew = v_ew * 4; v_ns = v_ns * 4
+			if (me >> 42) & 1:
+				v_ew = -v_ew
+			if (me >> 31) & 1:
+				v_ns = -v_ns
+
+			gs = int(round(math.hypot(v_ew, v_ns)))
+			track = int(round(math.degrees(math.atan2(v_ew, v_ns)) % 360))
+
+			vr = ''
+			vr_code = (me >> 10) & 0x1FF
+			if vr_code != 0:
+				vr = (vr_code - 1) * 64
+				if (me >> 19) & 1:
+					vr = -vr
+
+			return(self._sbs_row(4, hex_code, stamp, gs=gs, track=track, vr=vr))
+
+		return(None)
+
+	def decode_beast_file(self, file_path):
+		'''Decode a recorded Beast binary file into SBS rows'''
+		with open(file_path, 'rb') as beast_file:
+			frames, left_over = read_beast_frames(beast_file.read(), with_mlat=True)
+		return(self.decode_batch(frames))
+
+	def decode_avr_file(self, file_path):
+		'''Decode a recorded AVR text file into SBS rows'''
+		with open(file_path, 'r') as avr_file:
+			frames = read_avr_frames(avr_file)
+		return(self.decode_batch(frames))
+
+	def ingest_beast_socket(self, live_feed_loc, host='localhost', port=30005):
+		'''Read Beast frames from dump1090 and append the decoded SBS rows to the
+		live feed file, the same file the 30003 capture writes to. Runs until
+		the connection closes.'''
+		left_over = b''
+		with socket.create_connection((host, port)) as beast_sock:
+			while True:
+				data = beast_sock.recv(65536)
+				if not data:
+					break
+				frames, left_over = read_beast_frames(left_over + data, with_mlat=True)
+				rows = self.decode_batch(frames)
+				if rows:
+					with open(live_feed_loc, 'a', newline='') as live_feed:
+						live_feed.write(''.join(','.join(row) + '\r\n' for row in rows))
+
+
+def check_sample_frames(sample_dir=SAMPLE_DIR):
+	'''Decode the recorded fixtures in both formats and compare them with
+	SAMPLE_EXPECTED. Prints what differs, returns True if everything matched.'''
+	stamp = datetime.datetime(2022, 6, 20, 12, 0, 0)
+	all_good = True
+	for ext in ['avr', 'beast']:
+		decoder = ModeS_Decoder(check_crc=True, clock=lambda: stamp)
+		sample_path = os.path.join(sample_dir, 'modes_sample_frames.' + ext)
+		if ext == 'beast':
+			rows = decoder.decode_beast_file(sample_path)
+		else:
+			rows = decoder.decode_avr_file(sample_path)
+		decoded = [tuple(row[col] for col in (1, 4, 10, 11, 12, 13, 14, 15, 16, 17))
+				   for row in rows]
+		# Beast rows are stamped from their own timestamps, the clock being
+		# the capture start. AVR has none, so they all get the clock.
+		times = [row[7] for row in rows]
+		expected_times = SAMPLE_BEAST_TIMES if ext == 'beast' else \
+			['12:00:00.000'] * len(SAMPLE_EXPECTED)
+		if decoded != SAMPLE_EXPECTED or decoder.frames_bad:
+			all_good = False
+			print("{} frames don't decode as expected ({} failed the CRC):".format(
+				ext, decoder.frames_bad))
+			for got in decoded:
+				print("  " + ','.join(got))
+		elif times != expected_times:
+			all_good = False
+			print("{} frames stamped {} instead of {}".format(ext, times, expected_times))
+		else:
+			print("{} frames OK".format(ext))
+	return(all_good)
+
+######## Entry #########
+if __name__ == "__main__":
+	arg_parser = argparse.ArgumentParser(description="Decode recorded Mode-S frames into SBS rows")
+	arg_parser.add_argument('frame_file', nargs='?', default=None,
+							help="Beast (.beast) or AVR recording")
+	arg_parser.add_argument('--capture-start', default=None,
+							help="When the recording started, YYYY-MM-DD HH:MM:SS "
+							"(default now). Beast rows are stamped from it.")
+	arg_parser.add_argument('--check', action='store_true',
+							help="Decode the recorded fixtures and compare")
+	args = arg_parser.parse_args()
+
+	if args.check:
+		sys.exit(0 if check_sample_frames() else 1)
+	if args.frame_file is None:
+		arg_parser.error("give a frame file or --check")
+
+	capture_start = None
+	if args.capture_start is not None:
+		try:
+			capture_start = datetime.datetime.fromisoformat(args.capture_start)
+		except ValueError:
+			arg_parser.error("--capture-start has to be YYYY-MM-DD HH:MM:SS")
+
+	decoder = ModeS_Decoder(capture_start=capture_start)
+	if args.frame_file.endswith(".beast"):
+		sbs_rows = decoder.decode_beast_file(args.frame_file)
+	else:
+		sbs_rows = decoder.decode_avr_file(args.frame_file)
+
+	for sbs_row in sbs_rows:
+		print(','.join(sbs_row))
@@ -0,0 +1,391 @@
+################################################################################
+# MultiFeed.py
+# @author: Ryan Herrin
+#
+# Merge the SBS-1 feeds of several receivers (Pis running dump1090 at
+# different sites) into one feed where each message and each aircraft only
+# counts once. Messages are put back in time order with a bounded reorder
+# buffer, copies of the same message heard by another receiver are dropped,
+# and per-receiver coverage stats are kept so we can see what each site adds.
+################################################################################
+
+'''
+Usage:
+------------------
+python MultiFeed.py <source> <source> ... --output <30003_LiveFeed.csv>
+
+A source is a raw file or tcp://host:port, optionally named:
+	pi_north=tcp://10.0.0.21:30003  pi_south=../data/south/live_raw_...
+Unnamed sources are called rx0, rx1...
+
+Options:
+------------------
+--reorder 2.0     : Seconds a message can arrive out of order and still be
+                    put back in place
+--max-buffer N    : Most messages held for reordering before the oldest are
+                    let through anyway
+--dedupe 1.0      : Seconds within which the same message from another
+                    receiver is a duplicate
+--session-gap 30  : Minutes without hearing an aircraft before it counts as
+                    a new flight session
+--stats <json>    : Where to write the per-receiver stats
+
+The merged file is laid out exactly like a single receiver's live feed, so
+the snapshot -> process chain runs on it unchanged.
+'''
+
+import sys
+import json
+import time
+import heapq
+import queue
+import socket
+import argparse
+import threading
+
+from RawIndex import message_ms
+from IngestPipeline import QueueWriter
+
+
+_BATCH = 512
+
+
+def parse_source(spec, default_name):
+	'''"name=where" or "where" -> (name, where)'''
+	if '=' in spec.split('://')[0]:
+		name, where = spec.split('=', 1)
+		return(name, where)
+	return(default_name, spec)
+
+
+def _parse_line(receiver, line):
+	'''(time ms, receiver, hex, dedupe key, line) for an SBS MSG line, None for
+	anything else'''
+	fields = line.split(',')
+	if len(fields) < 22 or fields[0] != 'MSG' or fields[4] in ('', '000000'):
+		return(None)
+	try:
+		msg_ms = message_ms(fields[6], fields[7])
+	except (ValueError, IndexError):
+		return(None)
+	# Session, aircraft and flight ids and the times are set by each receiver,
+	# so only the message type, hex and what was heard make up the key
+	key = fields[1] + fields[4] + ','.join(fields[10:22])
+	return((msg_ms, receiver, fields[4], key, line))
+
+
+def _read_lines(where):
+	'''Lines from a raw file or a tcp://host:port SBS feed'''
+	if where.startswith('tcp://'):
+		host, port = where[len('tcp://'):].rsplit(':', 1)
+		with socket.create_connection((host, int(port))) as sbs_sock:
+			sbs_file = sbs_sock.makefile('r', newline='', encoding='latin-1')
+			for line in sbs_file:
+				yield(line)
+	else:
+		with open(where, 'r', newline='', encoding='latin-1') as raw_in:
+			for line in raw_in:
+				yield(line)
+
+
+def _reader(receiver, where, out_queue):
+	'''Thread per source: parse lines into batches and hand them to the merger.
+	The queue is bounded so a fast source waits instead of filling memory.'''
+	batch = []
+	try:
+		for line in _read_lines(where):
+			parsed = _parse_line(receiver, line)
+			if parsed is not None:
+				batch.append(parsed)
+				if len(batch) >= _BATCH:
+					out_queue.put(batch)
+					batch = []
+	except Exception as err:
+		print("Source {} stopped: {}".format(receiver, err))
+	if batch:
+		out_queue.put(batch)
+	out_queue.put(receiver) # This source is done
+
+
+class ReceiverStats:
+	'''What one receiver sent and what it added'''
+	def __init__(self):
+		self.messages = 0 # Everything that came in
+		self.unique = 0 # Messages this receiver was the first to deliver
+		self.duplicates = 0 # Already heard from another receiver
+		self.late = 0 # Arrived after its time was already let through
+		self.sessions = 0 # Flight sessions it heard at least once
+		self.exclusive_sessions = 0 # Flight sessions only it heard
+		self.first_ms = None
+		self.last_ms = None
+
+	def to_dict(self, total_sessions):
+		return({'messages': self.messages, 'unique': self.unique,
+				'duplicates': self.duplicates, 'late': self.late,
+				'sessions': self.sessions,
+				'exclusive_sessions': self.exclusive_sessions,
+				'session_coverage': round(self.sessions / float(total_sessions), 4)
+				if total_sessions else 0.0,
+				'first_ms': self.first_ms, 'last_ms': self.last_ms})
+
+
+class FeedMerger:
+	'''Puts messages from several receivers back in time order, drops copies
+	of the same message from other receivers and tracks flight sessions.
+	push() messages in, and write out what ready() / flush() hand back.'''
+	def __init__(self, reorder_seconds=2.0, max_buffer=50000, dedupe_seconds=1.0,
+				 session_gap_minutes=30):
+		self.reorder_ms = int(reorder_seconds * 1000)
+		self.max_buffer = max_buffer
+		self.dedupe_ms = int(dedupe_seconds * 1000)
+		self.session_gap_ms = int(session_gap_minutes * 60000)
+		self._buffer = [] # heap of (time ms, seq, receiver, hex, key, line)
+		self._seq = 0
+		self.newest_ms = None # Newest time pushed
+		self.released_ms = None # Newest time let through
+		self._recent = dict() # dedupe key -> (time ms, receiver)
+		self._recent_order = [] # heap of (time ms, key) for forgetting keys
+		self.sessions = dict() # hex -> [start ms, last ms, set of receivers]
+		self.closed_sessions = 0
+		self.forced = 0 # Let through early because the buffer was full
+		self.receivers = dict() # name -> ReceiverStats
+		self._next_session_sweep = None
+
+	def stats_for(self, receiver):
+		stats = self.receivers.get(receiver)
+		if stats is None:
+			stats = ReceiverStats()
+			self.receivers[receiver] = stats
+		return(stats)
+
+	def push(self, parsed):
+		'''Add one parsed message (see _parse_line)'''
+		msg_ms, receiver = parsed[0], parsed[1]
+		stats = self.stats_for(receiver)
+		stats.messages += 1
+		if stats.first_ms is None or msg_ms < stats.first_ms:
+			stats.first_ms = msg_ms
+		if stats.last_ms is None or msg_ms > stats.last_ms:
+			stats.last_ms = msg_ms
+		if self.newest_ms is None or msg_ms > self.newest_ms:
+			self.newest_ms = msg_ms
+
+		heapq.heappush(self._buffer, (msg_ms, self._seq) + parsed[1:])
+		self._seq += 1
+
+	def ready(self, low_ms=None):
+		'''Lines that can go out now, in time order, without duplicates. low_ms
+		is the oldest time any source could still send (the slowest source's
+		newest message). Without it the newest time pushed is used.'''
+		out = []
+		if low_ms is None:
+			low_ms = self.newest_ms
+		limit = low_ms - self.reorder_ms if low_ms is not None else None
+		while self._buffer and ((limit is not None and self._buffer[0][0] <= limit) or
+								len(self._buffer) > self.max_buffer):
+			if limit is None or self._buffer[0][0] > limit:
+				self.forced += 1
+			self._release(heapq.heappop(self._buffer), out)
+		return(out)
+
+	def flush(self):
+		'''Everything left in the buffer, at the end of the feeds'''
+		out = []
+		while self._buffer:
+			self._release(heapq.heappop(self._buffer), out)
+		self._close_sessions(None)
+		return(out)
+
+	def _release(self, entry, out):
+		msg_ms, seq, receiver, hex_code, key, line = entry
+		stats = self.receivers[receiver]
+		if self.released_ms is not None and msg_ms < self.released_ms:
+			stats.late += 1
+		else:
+			self.released_ms = msg_ms
+		self._forget_keys(msg_ms)
+
+		seen = self._recent.get(key)
+		if seen is not None and seen[1] != receiver and msg_ms - seen[0] <= self.dedupe_ms:
+			stats.duplicates += 1
+		else:
+			stats.unique += 1
+			self._recent[key] = (msg_ms, receiver)
+			heapq.heappush(self._recent_order, (msg_ms, key))
+			out.append(line)
+
+		# Every receiver that heard the aircraft counts toward the session,
+		# duplicate or not
+		self._track_session(hex_code, msg_ms, receiver)
+
+	def _forget_keys(self, now_ms):
+		'''Drop dedupe keys older than the dedupe window'''
+		while self._recent_order and self._recent_order[0][0] < now_ms - self.dedupe_ms:
+			old_ms, key = heapq.heappop(self._recent_order)
+			seen = self._recent.get(key)
+			if seen is not None and seen[0] == old_ms:
+				del self._recent[key]
+
+	def _track_session(self, hex_code, msg_ms, receiver):
+		session = self.sessions.get(hex_code)
+		if session is not None and msg_ms - session[1] > self.session_gap_ms:
+			self._end_session(session)
+			session = None
+		if session is None:
+			session = [msg_ms, msg_ms, set()]
+			self.sessions[hex_code] = session
+		if msg_ms > session[1]:
+			session[1] = msg_ms
+		session[2].add(receiver)
+
+		# Close sessions that went quiet every minute of feed time so the
+		# table only holds aircraft that are still around
+		if self._next_session_sweep is None:
+			self._next_session_sweep = msg_ms + 60000
+		elif msg_ms >= self._next_session_sweep:
+			self._next_session_sweep = msg_ms + 60000
+			self._close_sessions(msg_ms)
+
+	def _end_session(self, session):
+		self.closed_sessions += 1
+		for receiver in session[2]:
+			self.receivers[receiver].sessions += 1
+		if len(session[2]) == 1:
+			self.receivers[next(iter(session[2]))].exclusive_sessions += 1
+
+	def _close_sessions(self, now_ms):
+		'''End sessions quiet for longer than the gap (all of them if now_ms is
+		None)'''
+		for hex_code in [hex_code for hex_code, session in self.sessions.items()
+						 if now_ms is None or now_ms - session[1] > self.session_gap_ms]:
+			self._end_session(self.sessions.pop(hex_code))
+
+	def stats(self):
+		'''Per receiver stats plus totals, as a dictionary'''
+		total_sessions = self.closed_sessions
+		return({'sessions': total_sessions, 'open_sessions': len(self.sessions),
+				'forced_releases': self.forced,
+				'receivers': {name: stats.to_dict(total_sessions) for name, stats in
+							  sorted(self.receivers.items())}})
+
+
+def merge_feeds(sources, output_path, merger=None, queue_batches=64, stall_seconds=5.0,
+				metrics=None):
+	'''Read every source at once (a thread and a bounded queue each), merge
+	them and append the merged feed to output_path. The appending is done by
+	a QueueWriter thread so the merge never waits on the disk, and its queue
+	and write timings go in metrics. sources is a list of (name, where).
+	Returns the FeedMerger so its stats can be read.
+
+	Each pass takes everything waiting in every queue. Messages are let
+	through up to the newest time of the source furthest behind, so a source
+	that is behind holds the others in the reorder buffer. When nothing is
+	waiting the merge waits on that source, and if it sends nothing for
+	stall_seconds it is marked stalled and no longer holds anyone back (a
+	receiver with no traffic, say). It rejoins as soon as it sends again.'''
+	merger = merger if merger is not None else FeedMerger()
+	queues = dict()
+	readers = []
+	for name, where in sources:
+		queues[name] = queue.Queue(maxsize=queue_batches)
+		readers.append(threading.Thread(target=_reader, args=(name, where, queues[name]),
+										daemon=True))
+	for reader in readers:
+		reader.start()
+
+	newest = dict((name, None) for name in queues) # newest time per source
+	stalled = set()
+	last_heard = dict((name, time.monotonic()) for name in queues)
+	merged_out = QueueWriter(output_path, metrics, binary=False)
+
+	def take(name, batch):
+		if isinstance(batch, str):
+			del newest[name]
+			stalled.discard(name)
+			return
+		for parsed in batch:
+			merger.push(parsed)
+		newest[name] = max(newest[name] or 0, batch[-1][0])
+		last_heard[name] = time.monotonic()
+		stalled.discard(name)
+
+	try:
+		while newest:
+			taken = 0
+			for name in list(newest):
+				# At most a queue's worth, so a fast reader can't keep us here
+				for num in range(queue_batches):
+					try:
+						batch = queues[name].get_nowait()
+					except queue.Empty:
+						break
+					take(name, batch)
+					taken += 1
+					if name not in newest:
+						break
+
+			now = time.monotonic()
+			for name in newest:
+				if now - last_heard[name] > stall_seconds:
+					stalled.add(name)
+
+			if not taken:
+				waiting = [name for name in newest if name not in stalled]
+				if waiting:
+					# Furthest behind first, sources with nothing yet before anyone
+					behind = min(waiting, key=lambda name: -1 if newest[name] is None
+								 else newest[name])
+					try:
+						take(behind, queues[behind].get(
+							timeout=max(0.001, last_heard[behind] + stall_seconds - now)))
+					except queue.Empty:
+						stalled.add(behind)
+				else:
+					# Every source left is stalled, look again shortly
+					time.sleep(min(stall_seconds, 0.05))
+
+			active = [msg_ms for name, msg_ms in newest.items() if name not in stalled]
+			if not newest:
+				break
+			elif not active:
+				# Nobody is holding the rest back, only the reorder window applies
+				merged_lines = merger.ready()
+			elif all(msg_ms is not None for msg_ms in active):
+				merged_lines = merger.ready(min(active))
+			else:
+				# Still waiting to hear from a source, only the buffer limit applies
+				merged_lines = merger.ready(-1)
+			if merged_lines:
+				merged_out.put(''.join(merged_lines))
+		merged_lines = merger.flush()
+		if merged_lines:
+			merged_out.put(''.join(merged_lines))
+	finally:
+		merged_out.close()
+
+	return(merger)
+
+
+######## Entry #########
+if __name__ == "__main__":
+	arg_parser = argparse.ArgumentParser(description="Merge several receivers' feeds")
+	arg_parser.add_argument('sources', nargs='+')
+	arg_parser.add_argument('--output', required=True)
+	arg_parser.add_argument('--reorder', type=float, default=2.0)
+	arg_parser.add_argument('--max-buffer', type=int, default=50000)
+	arg_parser.add_argument('--dedupe', type=float, default=1.0)
+	arg_parser.add_argument('--session-gap', type=float, default=30)
+	arg_parser.add_argument('--stats', default=None)
+	args = arg_parser.parse_args()
+
+	feed_sources = [parse_source(spec, "rx{}".format(num)) for num, spec in
+					enumerate(args.sources)]
+	feed_merger = merge_feeds(feed_sources, args.output, FeedMerger(
+		args.reorder, args.max_buffer, args.dedupe, args.session_gap))
+
+	merge_stats = feed_merger.stats()
+	if args.stats:
+		with open(args.stats, 'w') as json_out:
+			json.dump(merge_stats, json_out, indent=2)
+	json.dump(merge_stats, sys.stdout, indent=2)
+	print()
@@ -0,0 +1,104 @@
+################################################################################
+# MultiFeedCheck.py
+# @author: Ryan Herrin
+#
+# Check that a receiver with no traffic doesn't hold up the merged feed. One
+# source is a local SBS port that accepts the connection and never sends
+# anything, the other is the sample feed. The merged file has to fill up
+# while the quiet receiver is still connected, and end up with the same
+# lines as merging the sample feed on its own.
+################################################################################
+
+'''
+Usage:
+------------------
+python MultiFeedCheck.py
+python MultiFeedCheck.py --stall 0.5 --sample ../data/adsb_sample_data/30003_Sample_Data.csv
+'''
+
+import os
+import sys
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+
+from MultiFeed import FeedMerger, merge_feeds
+
+
+def _line_count(file_path):
+	if not os.path.exists(file_path):
+		return(0)
+	with open(file_path, 'r', encoding='latin-1') as file_in:
+		return(sum(1 for line in file_in))
+
+
+def check_idle_source(work_dir, sample_path, stall_seconds=0.5):
+	'''Returns a list of what went wrong, empty if it all checked out'''
+	problems = []
+	alone_path = os.path.join(work_dir, 'alone.csv')
+	merge_feeds([('busy', sample_path)], alone_path, FeedMerger(), stall_seconds=stall_seconds)
+	expected = _line_count(alone_path)
+
+	# A receiver that connects and has nothing to say
+	idle_server = socket.create_server(('localhost', 0))
+	port = idle_server.getsockname()[1]
+	idle_conns = []
+	accepting = threading.Thread(target=lambda: idle_conns.append(idle_server.accept()[0]),
+								 daemon=True)
+	accepting.start()
+
+	merged_path = os.path.join(work_dir, 'merged.csv')
+	merging = threading.Thread(target=merge_feeds, args=(
+		[('quiet', 'tcp://localhost:{}'.format(port)), ('busy', sample_path)], merged_path,
+		FeedMerger(), 64, stall_seconds), daemon=True)
+	started = time.monotonic()
+	merging.start()
+
+	# Everything but the last reorder window should come out while the quiet
+	# receiver is still connected
+	deadline = started + stall_seconds * 4 + 2.0
+	while time.monotonic() < deadline and _line_count(merged_path) < expected * 0.9:
+		time.sleep(0.05)
+	written = _line_count(merged_path)
+	if written < expected * 0.9:
+		problems.append("{} of {} lines written {:.1f}s in, with the quiet receiver "
+						"connected".format(written, expected, time.monotonic() - started))
+
+	accepting.join(5.0)
+	for conn in idle_conns:
+		conn.close()
+	idle_server.close()
+	merging.join(30.0)
+	if merging.is_alive():
+		problems.append("merge didn't finish after the quiet receiver closed")
+	elif _line_count(merged_path) != expected:
+		problems.append("{} lines merged, {} from the sample feed alone".format(
+			_line_count(merged_path), expected))
+	return(problems)
+
+
+######## Entry #########
+if __name__ == "__main__":
+	arg_parser = argparse.ArgumentParser(description="Check a quiet receiver doesn't stall the merge")
+	arg_parser.add_argument('--stall', type=float, default=0.5,
+							help="Seconds before a quiet source is passed over")
+	arg_parser.add_argument('--sample', default=os.path.join(
+		os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'adsb_sample_data',
+		'30003_Sample_Data.csv'), help="Feed for the busy source")
+	args = arg_parser.parse_args()
+
+	work_dir = tempfile.mkdtemp(prefix='multifeed_check_')
+	try:
+		check_problems = check_idle_source(work_dir, args.sample, args.stall)
+	finally:
+		shutil.rmtree(work_dir, ignore_errors=True)
+	if check_problems:
+		print("Idle source FAILED:")
+		for problem in check_problems:
+			print("  " + problem)
+		sys.exit(1)
+	print("Idle source OK")
+	sys.exit(0)
@@ -0,0 +1,369 @@
+################################################################################
+# Partitions.py
+# @author: Ryan Herrin
+#
+# Date/hour partitioned layout for the processed and combined data:
+#   <root>/year=2022/month=06/day=20/hour=23/2022_06_20_233206_log.csv
+# Rows go in the partition of their own Date and Time, so a reader asking for
+# a time range only opens the directories that can hold it instead of listing
+# everything and matching on file names.
+################################################################################
+
+'''
+Usage:
+------------------
+python Partitions.py migrate <flat dir> <partition root>   # copy flat files over
+python Partitions.py migrate <flat dir> <root> --remove    # ...and delete them
+python Partitions.py list <root> --start "2022-06-20 22" --end "2022-06-21"
+
+Times for start / end can be a datetime or "YYYY-MM-DD[ HH[:MM[:SS]]]" (a "_"
+or "/" between the date parts works too). Both ends are inclusive, and a date
+on its own for end means the whole day.
+
+Every file keeps the header of the flat file it came from, so a partition
+file reads the same as the flat files always have.
+
+Files are only replaced when what would be written is different, so a file
+that comes out the same keeps its modified time and later stages skip it.
+upsert_csv / upsert_partitioned merge rows into what is there by flight key
+(see FlightKeys) instead of writing the file from scratch.
+'''
+
+import os
+import csv
+import sys
+import argparse
+import datetime
+
+from FlightKeys import merge_rows
+
+
+def _parse_time(when, end=False):
+	'''datetime for a start or end bound. A bare date as an end bound means
+	the end of that day, a bare hour the end of that hour.'''
+	if when is None or isinstance(when, datetime.datetime):
+		return(when)
+	when = str(when).strip().replace('_', '-').replace('/', '-')
+	for fmt, last in [("%Y-%m-%d %H:%M:%S", datetime.timedelta(0)),
+					  ("%Y-%m-%d %H:%M", datetime.timedelta(seconds=59)),
+					  ("%Y-%m-%d %H", datetime.timedelta(minutes=59, seconds=59)),
+					  ("%Y-%m-%d", datetime.timedelta(hours=23, minutes=59, seconds=59))]:
+		try:
+			parsed = datetime.datetime.strptime(when, fmt)
+		except ValueError:
+			continue
+		return(parsed + last if end else parsed)
+	raise ValueError("Can't read the time {}".format(when))
+
+
+def partition_path(root, hour_start):
+	'''Directory for the hour a datetime falls in'''
+	return(os.path.join(root, "year={:04d}".format(hour_start.year),
+						"month={:02d}".format(hour_start.month),
+						"day={:02d}".format(hour_start.day),
+						"hour={:02d}".format(hour_start.hour)))
+
+
+def hour_dir(root, hour_start):
+	'''Partition directory for an hour, made if needed. Rows without a usable
+	time (hour_start None) go in <root>/unknown.'''
+	out_dir = partition_path(root, hour_start) if hour_start is not None else \
+		os.path.join(root, 'unknown')
+	os.makedirs(out_dir, exist_ok=True)
+	return(out_dir)
+
+
+def row_hour(row, date_col=1, time_col=2):
+	'''Start of the hour for a processed / combined row ("YYYY-MM-DD",
+	"HH:MM:SS"), None if it doesn't have a usable time'''
+	try:
+		date_parts = row[date_col].replace('/', '-').split('-')
+		return(datetime.datetime(int(date_parts[0]), int(date_parts[1]),
+								 int(date_parts[2]), int(row[time_col][:2])))
+	except (ValueError, IndexError):
+		return(None)
+
+
+def _value(name):
+	'''"year=2022" -> 2022, None for anything that isn't a partition dir'''
+	if '=' not in name:
+		return(None)
+	try:
+		return(int(name.split('=', 1)[1]))
+	except ValueError:
+		return(None)
+
+
+def _sorted_values(dir_path, prefix):
+	found = []
+	if not os.path.isdir(dir_path):
+		return(found)
+	for name in os.listdir(dir_path):
+		value = _value(name)
+		if name.startswith(prefix + '=') and value is not None:
+			found.append((value, os.path.join(dir_path, name)))
+	return(sorted(found))
+
+
+def iter_partitions(root, start=None, end=None):
+	'''Yield (hour start, directory) for every hour partition that can hold
+	rows between start and end, oldest first. Whole years, months and days
+	outside the range are skipped without being listed.'''
+	start = _parse_time(start)
+	end = _parse_time(end, end=True)
+	start_hour = None if start is None else start.replace(minute=0, second=0, microsecond=0)
+
+	for year, year_dir in _sorted_values(root, 'year'):
+		if (start is not None and year < start.year) or (end is not None and year > end.year):
+			continue
+		for month, month_dir in _sorted_values(year_dir, 'month'):
+			if start is not None and (year, month) < (start.year, start.month):
+				continue
+			if end is not None and (year, month) > (end.year, end.month):
+				continue
+			for day, day_dir in _sorted_values(month_dir, 'day'):
+				day_start = datetime.datetime(year, month, day)
+				if start is not None and day_start < start_hour.replace(hour=0):
+					continue
+				if end is not None and day_start > end:
+					continue
+				for hour, hour_dir in _sorted_values(day_dir, 'hour'):
+					hour_start = day_start.replace(hour=hour)
+					if start_hour is not None and hour_start < start_hour:
+						continue
+					if end is not None and hour_start > end:
+						continue
+					yield((hour_start, hour_dir))
+
+
+def list_files(root, start=None, end=None, suffix='.csv'):
+	'''Every file in the partitions between start and end, oldest hour first'''
+	found = []
+	for hour_start, hour_dir in iter_partitions(root, start, end):
+		found.extend(os.path.join(hour_dir, name) for name in sorted(os.listdir(hour_dir))
+					 if name.endswith(suffix))
+	return(found)
+
+
+def active_days(root, start=None, end=None):
+	'''"YYYY_MM_DD" for every day with a partition, the same format the flat
+	file names start with'''
+	days = []
+	for hour_start, hour_dir in iter_partitions(root, start, end):
+		day = hour_start.strftime("%Y_%m_%d")
+		if not days or days[-1] != day:
+			days.append(day)
+	return(days)
+
+
+def is_partitioned(root):
+	'''True if a directory uses the partitioned layout'''
+	return(os.path.isdir(root) and any(name.startswith('year=') for name in os.listdir(root)))
+
+
+def read_rows(root, start=None, end=None, date_col=1, time_col=2):
+	'''Yield the rows between start and end (headers skipped). Only the first
+	and last hour partitions need checking row by row.'''
+	start = _parse_time(start)
+	end = _parse_time(end, end=True)
+	for hour_start, hour_dir in iter_partitions(root, start, end):
+		edge = ((start is not None and hour_start < start) or
+				(end is not None and hour_start + datetime.timedelta(hours=1) > end))
+		for name in sorted(os.listdir(hour_dir)):
+			if not name.endswith('.csv'):
+				continue
+			with open(os.path.join(hour_dir, name), newline='') as csvfile:
+				csv_reader = csv.reader(csvfile, delimiter=',')
+				csv_reader.__next__() # Skip the header
+				for row in csv_reader:
+					if edge:
+						row_time = _parse_time("{} {}".format(row[date_col],
+															  row[time_col][:8]))
+						if (start is not None and row_time < start) or \
+								(end is not None and row_time > end):
+							continue
+					yield(row)
+
+
+def _read_csv(csv_path):
+	if not os.path.exists(csv_path):
+		return(None)
+	with open(csv_path, newline='') as csvfile:
+		return(list(csv.reader(csvfile, delimiter=',')))
+
+
+def replace_if_changed(tmp_path, csv_path):
+	'''Move a freshly written tmp file over csv_path, unless they are the same,
+	in which case csv_path is left alone. Returns True if it was replaced.'''
+	if os.path.exists(csv_path) and os.path.getsize(csv_path) == os.path.getsize(tmp_path):
+		with open(tmp_path, 'rb') as new_in, open(csv_path, 'rb') as old_in:
+			if new_in.read() == old_in.read():
+				os.remove(tmp_path)
+				return(False)
+	os.replace(tmp_path, csv_path)
+	return(True)
+
+
+def _write_rows(csv_path, rows):
+	'''Write rows (header included) to csv_path if they changed'''
+	tmp_path = csv_path + '.tmp'
+	with open(tmp_path, 'w', newline='') as csv_out:
+		csv.writer(csv_out, delimiter=',').writerows(rows)
+	return(replace_if_changed(tmp_path, csv_path))
+
+
+def _split_header(rows):
+	'''(header or None, rows) for the rows of a processed / combined file'''
+	if rows and rows[0] and rows[0][0] == 'HexCode':
+		return(rows[0], rows[1:])
+	return(None, rows)
+
+
+def _upsert(existing, rows, key_col, keep):
+	'''Merge rows into existing rows by key. Rows without a key (written
+	before there were flight keys) and keys keep says no to are dropped.
+	Returns (merged rows in order, rows added, changed or dropped).'''
+	merged = dict()
+	changed = 0
+	for row in existing:
+		if len(row) <= key_col or (keep is not None and not keep(row[key_col])):
+			changed += 1
+			continue
+		merged[row[key_col]] = row
+	for row in rows:
+		old = merged.get(row[key_col])
+		new = row if old is None else merge_rows(old, row)
+		if new != old:
+			changed += 1
+			merged[row[key_col]] = new
+	return(list(merged.values()), changed)
+
+
+def upsert_csv(csv_path, rows, header=None, key_col=-1, keep=None):
+	'''Upsert rows into a CSV by the key in key_col. keep(key) can drop rows
+	that shouldn't be in the file any more. The file is only written if
+	something changed. Returns (every row now in the file, rows changed).'''
+	old_header, existing = _split_header(_read_csv(csv_path) or [])
+	header = header or old_header
+	key_col = key_col % len(header) if header is not None and key_col < 0 else key_col
+	merged, changed = _upsert(existing, rows, key_col, keep)
+	if changed or not os.path.exists(csv_path):
+		_write_rows(csv_path, ([header] if header is not None else []) + merged)
+	return(merged, changed)
+
+
+def upsert_partitioned(root, file_name, rows, header=None, key_col=-1, keep=None,
+					   date_col=1, time_col=2):
+	'''upsert_csv for a file split across the hour partitions. The copies of
+	file_name from a day either side of the rows are merged, so a row whose
+	time moved is taken out of its old hour. Returns the same as upsert_csv.'''
+	hours = [hour for hour in (row_hour(row, date_col, time_col) for row in rows)
+			 if hour is not None]
+	old_files = dict()
+	if hours:
+		for hour_start, dir_path in iter_partitions(root, min(hours) - datetime.timedelta(days=1),
+													max(hours) + datetime.timedelta(days=1)):
+			old_rows = _read_csv(os.path.join(dir_path, file_name))
+			if old_rows is not None:
+				old_files[os.path.join(dir_path, file_name)] = old_rows
+	unknown_rows = _read_csv(os.path.join(root, 'unknown', file_name))
+	if unknown_rows is not None:
+		old_files[os.path.join(root, 'unknown', file_name)] = unknown_rows
+
+	existing = []
+	for old_rows in old_files.values():
+		old_header, old_rows = _split_header(old_rows)
+		header = header or old_header
+		existing.extend(old_rows)
+	key_col = key_col % len(header) if header is not None and key_col < 0 else key_col
+	merged, changed = _upsert(existing, rows, key_col, keep)
+	if not changed:
+		return(merged, changed)
+
+	new_files = dict()
+	for row in merged:
+		out_path = os.path.join(hour_dir(root, row_hour(row, date_col, time_col)), file_name)
+		new_files.setdefault(out_path, []).append(row)
+	for out_path, out_rows in new_files.items():
+		_write_rows(out_path, ([header] if header is not None else []) + out_rows)
+	for old_path in old_files:
+		if old_path not in new_files:
+			os.remove(old_path)
+	return(merged, changed)
+
+
+def write_partitioned(root, file_name, rows, header=None, date_col=1, time_col=2):
+	'''Split rows by their hour and write each group to
+	<root>/year=/month=/day=/hour=/<file_name>. If the first row is a header
+	(or header is given) every file gets it. Rows without a usable time go to
+	<root>/unknown/. Returns the paths written.'''
+	rows = list(rows)
+	if header is None and rows and not rows[0][date_col][:1].isdigit():
+		header = rows[0]
+		rows = rows[1:]
+
+	by_hour = dict()
+	for row in rows:
+		by_hour.setdefault(row_hour(row, date_col, time_col), []).append(row)
+
+	written = []
+	for hour_start, hour_rows in sorted(by_hour.items(), key=lambda item: (item[0] is None,
+																			item[0])):
+		out_path = os.path.join(hour_dir(root, hour_start), file_name)
+		_write_rows(out_path, ([header] if header is not None else []) + hour_rows)
+		written.append(out_path)
+	return(written)
+
+
+def migrate_flat(flat_dir, root, remove=False):
+	'''Copy every flat CSV into the partitioned layout under root. With remove
+	the flat file is deleted once its rows are all written. Returns the number
+	of files migrated.'''
+	migrated = 0
+	for file_name in sorted(os.listdir(flat_dir)):
+		flat_path = os.path.join(flat_dir, file_name)
+		if not file_name.endswith('.csv') or not os.path.isfile(flat_path):
+			continue
+		with open(flat_path, newline='') as csvfile:
+			rows = list(csv.reader(csvfile, delimiter=','))
+		written = write_partitioned(root, file_name, rows)
+
+		# Make sure nothing was lost before removing the flat file
+		count = 0
+		for out_path in written:
+			with open(out_path, newline='') as csvfile:
+				count += sum(1 for row in csv.reader(csvfile, delimiter=',')) - 1
+		expected = len(rows) - 1 if rows and not rows[0][1][:1].isdigit() else len(rows)
+		if count != expected:
+			print("Row count mismatch for {}, {} != {}. Keeping it.".format(
+				file_name, count, expected))
+			continue
+
+		if remove:
+			os.remove(flat_path)
+		migrated += 1
+	return(migrated)
+
+
+######## Entry #########
+if __name__ == "__main__":
+	arg_parser = argparse.ArgumentParser(description="Partitioned data layout")
+	sub = arg_parser.add_subparsers(dest='command', required=True)
+	migrate = sub.add_parser('migrate', help="Move flat CSVs into partitions")
+	migrate.add_argument('flat_dir')
+	migrate.add_argument('root')
+	migrate.add_argument('--remove', action='store_true',
+						 help="Delete each flat file once it is migrated")
+	listing = sub.add_parser('list', help="List the files for a time range")
+	listing.add_argument('root')
+	listing.add_argument('--start', default=None)
+	listing.add_argument('--end', default=None)
+	args = arg_parser.parse_args()
+
+	if args.command == 'migrate':
+		print("Migrated {} file(s)".format(migrate_flat(args.flat_dir, args.root,
+														args.remove)))
+	else:
+		for partition_file in list_files(args.root, args.start, args.end):
+			print(partition_file)
+	sys.exit(0)
@@ -0,0 +1,174 @@
+################################################################################
+# QueryCache.py
+# @author: Ryan Herrin
+#
+# Cache for the results of the pre-defined Astra queries. The dashboard counts
+# scan the whole table, so their results are kept in memory and (optionally)
+# a JSON file on disk, keyed by the query and the version of the table it
+# reads. The bulk loader bumps the version, so nothing cached before a load
+# is served after it, even by another process sharing the file.
+################################################################################
+
+'''
+Cache file:
+------------------
+{"versions": {"flights.f_data": 3},
+ "entries": {"<table>|<version>|<query>": {"value": 1234, "stored": 1656000000.0}}}
+
+Only JSON friendly values (counts, dicts of counts) are cached, not result
+sets. ttl_seconds also expires entries, for data loaded by something other
+than bulk_load_csv. There is no cap on the number of entries (a Demo run
+asks for several hundred counts), instead a table's entries are dropped when
+its version is bumped.
+
+Results are written to the file by flush() (or leaving a with block), once
+per run. A version bump is written straight away so other processes see it.
+
+Versions only ever go up. Every save takes the highest version of each
+table from memory and the file, so a process that was running a slow query
+can't put back a version another process already bumped. A result is only
+stored if its table's version is still the one it was when get() missed.
+'''
+
+import os
+import json
+import time
+
+
+def normalize_cql(query):
+	'''Same key for the same query however it was spaced or terminated.
+	Whitespace inside quotes is left alone.'''
+	parts = query.strip().rstrip(';').split("'")
+	# Even parts are outside quotes
+	for pos in range(0, len(parts), 2):
+		parts[pos] = ' '.join(parts[pos].split())
+	return("'".join(parts).strip())
+
+
+class QueryCache:
+	'''Query results in memory with an optional JSON file behind it'''
+	def __init__(self, disk_path=None, ttl_seconds=3600):
+		self.disk_path = disk_path
+		self.ttl_seconds = ttl_seconds
+		self.versions = dict()
+		self.entries = dict()
+		self.hits = 0
+		self.misses = 0
+		self._missed = dict() # (table, query) -> table version when get() missed
+		self._dirty = False # entries not written to the file yet
+		self._disk_mtime = None
+		self._sync()
+
+	def __enter__(self):
+		return(self)
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.flush()
+
+	def _read_disk(self):
+		'''What is in the cache file right now, None if there isn't one'''
+		if self.disk_path is None or not os.path.exists(self.disk_path):
+			return(None)
+		try:
+			mtime = os.path.getmtime(self.disk_path)
+			with open(self.disk_path, 'r') as json_in:
+				stored = json.load(json_in)
+		except (OSError, ValueError) as err:
+			print("Could not read the query cache, ignoring it: " + str(err))
+			return(None)
+		self._disk_mtime = mtime
+		return(stored)
+
+	def _sync(self):
+		'''Merge the file into memory: the highest version of each table and
+		any entries another process stored that we don't have'''
+		stored = self._read_disk()
+		if stored is None:
+			return
+		for table, version in stored.get('versions', dict()).items():
+			if version > self.versions.get(table, 0):
+				self.versions[table] = version
+		for key, entry in stored.get('entries', dict()).items():
+			self.entries.setdefault(key, entry)
+		self._drop_stale()
+
+	def _sync_if_changed(self):
+		if self.disk_path is not None and os.path.exists(self.disk_path) and \
+				os.path.getmtime(self.disk_path) != self._disk_mtime:
+			self._sync()
+
+	def _drop_stale(self):
+		'''Drop entries for an old version of their table, or past ttl_seconds'''
+		now = time.time()
+		for key in list(self.entries):
+			table, version, query = key.split('|', 2)
+			if version != str(self.versions.get(table, 0)) or \
+					(self.ttl_seconds is not None and
+					 now - self.entries[key]['stored'] > self.ttl_seconds):
+				del self.entries[key]
+
+	def _save(self):
+		if self.disk_path is None:
+			return
+		self._sync()
+		os.makedirs(os.path.dirname(os.path.abspath(self.disk_path)), exist_ok=True)
+		tmp_path = self.disk_path + '.tmp'
+		with open(tmp_path, 'w') as json_out:
+			json.dump({'versions': self.versions, 'entries': self.entries}, json_out)
+		os.replace(tmp_path, self.disk_path)
+		self._disk_mtime = os.path.getmtime(self.disk_path)
+		self._dirty = False
+
+	def _key(self, table, query):
+		return("{}|{}|{}".format(table, self.versions.get(table, 0), normalize_cql(query)))
+
+	def get(self, table, query):
+		'''Cached value for a query on table, None on a miss'''
+		# Pick up loads (version bumps) made by other processes
+		self._sync_if_changed()
+		key = self._key(table, query)
+		entry = self.entries.get(key)
+		if entry is not None and self.ttl_seconds is not None and \
+				time.time() - entry['stored'] > self.ttl_seconds:
+			del self.entries[key]
+			entry = None
+		if entry is None:
+			self.misses += 1
+			self._missed[(table, normalize_cql(query))] = self.versions.get(table, 0)
+			return(None)
+		self.hits += 1
+		return(entry['value'])
+
+	def put(self, table, query, value):
+		'''Store a result (written to the file by flush). Skipped if the table
+		was loaded since the get() that missed, as the result may be from
+		before the load.'''
+		missed_at = self._missed.pop((table, normalize_cql(query)), None)
+		self._sync_if_changed()
+		if missed_at is not None and self.versions.get(table, 0) != missed_at:
+			return
+		self.entries[self._key(table, query)] = {'value': value, 'stored': time.time()}
+		self._dirty = True
+
+	def cached(self, table, query, run):
+		'''Value of a query, calling run() only on a miss'''
+		value = self.get(table, query)
+		if value is None:
+			value = run()
+			if value is not None:
+				self.put(table, query, value)
+		return(value)
+
+	def flush(self):
+		'''Write the results stored since the last flush to the file'''
+		if self._dirty:
+			self._save()
+
+	def invalidate(self, table):
+		'''New rows were written to table. Bumps its version, which drops its
+		entries, and writes it straight away. The file is read first so another
+		process's bump isn't lost.'''
+		self._sync()
+		self.versions[table] = self.versions.get(table, 0) + 1
+		self._drop_stale()
+		self._save()
@@ -0,0 +1,112 @@
+################################################################################
+# QueryCacheCheck.py
+# @author: Ryan Herrin
+#
+# Check for QueryCache without a cluster. Demo's whole query set is run
+# against a fake session that counts what it executes, as separate runs
+# sharing one cache file. The second run must not execute anything, and a
+# load in between must make the next run ask the database again.
+################################################################################
+
+'''
+Usage:
+------------------
+python QueryCacheCheck.py
+python QueryCacheCheck.py --catalog ../data/callsign_catalog.csv
+'''
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+
+from Demo import run_queries, KEYSPACE_NAME, TABLE
+from TenNinty import Callsigns
+from QueryCache import QueryCache
+from DStaxAstraControl import DataStaxAstra
+
+
+class FakeResult:
+	def __init__(self, value):
+		self.value = value
+
+	def all(self):
+		return([[self.value]])
+
+
+class FakeSession:
+	'''Answers every COUNT(*) with the length of the query and counts them'''
+	def __init__(self):
+		self.executed = 0
+
+	def execute(self, query):
+		self.executed += 1
+		return(FakeResult(len(query)))
+
+
+def demo_run(cache_path, callsigns, load=False):
+	'''One Demo run with its own cache object, flushed at the end like Demo
+	does. With load, a bulk load happens first. Returns (queries executed,
+	results).'''
+	session = FakeSession()
+	db_conn = DataStaxAstra(cache=QueryCache(cache_path))
+	db_conn.set_keyspace(KEYSPACE_NAME)
+	if load:
+		db_conn.cache.invalidate(db_conn._table_name(TABLE))
+	try:
+		results = run_queries(db_conn, session, callsigns)
+	finally:
+		db_conn.cache.flush()
+	return(session.executed, results)
+
+
+def check_cache(work_dir, callsigns):
+	'''Returns a list of what went wrong, empty if it all checked out'''
+	problems = []
+	cache_path = os.path.join(work_dir, 'query_cache.json')
+	expected = 1 + 7 + 10 + len(set(callsigns))
+
+	executed, first = demo_run(cache_path, callsigns)
+	if executed != expected:
+		problems.append("first run executed {} queries, not {}".format(executed, expected))
+
+	executed, second = demo_run(cache_path, callsigns)
+	if executed != 0:
+		problems.append("second run executed {} of {} queries".format(executed, expected))
+	if second != first:
+		problems.append("second run's results differ from the first's")
+
+	executed, third = demo_run(cache_path, callsigns, load=True)
+	if executed != expected:
+		problems.append("run after a load executed {} queries, not {}".format(
+			executed, expected))
+
+	# Results are only written by flush, not on every query
+	db_conn = DataStaxAstra(cache=QueryCache(os.path.join(work_dir, 'unflushed.json')))
+	db_conn.set_keyspace(KEYSPACE_NAME)
+	run_queries(db_conn, FakeSession(), callsigns)
+	if os.path.exists(db_conn.cache.disk_path):
+		problems.append("cache file written before flush()")
+	return(problems)
+
+
+######## Entry #########
+if __name__ == "__main__":
+	arg_parser = argparse.ArgumentParser(description="Check the Demo query cache")
+	arg_parser.add_argument('--catalog', default='../data/callsign_catalog.csv',
+							help="Callsign catalog to take Demo's airline queries from")
+	args = arg_parser.parse_args()
+
+	work_dir = tempfile.mkdtemp(prefix='cache_check_')
+	try:
+		check_problems = check_cache(work_dir, Callsigns().get_catalog_callsigns(args.catalog))
+	finally:
+		shutil.rmtree(work_dir, ignore_errors=True)
+	if check_problems:
+		print("Query cache FAILED:")
+		for problem in check_problems:
+			print("  " + problem)
+		sys.exit(1)
+	print("Query cache OK")
+	sys.exit(0)
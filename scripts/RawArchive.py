@@ -0,0 +1,243 @@
+################################################################################
+# RawArchive.py
+# @author: Ryan Herrin
+#
+# Compact on-disk archive for the raw SBS-1 feed. The live_raw_* snapshots are
+# plain text with a lot of repeated values, so they are stored here as zlib
+# compressed blocks of lines with an index of every block at the end of the
+# file. Range queries only read and decompress the blocks they need.
+################################################################################
+
+'''
+Archive layout:
+------------------
+[8 bytes]  Magic b'ADSBZ01\n'
+[n bytes]  Blocks. Each block is the raw bytes of up to block_lines lines
+           (line endings kept) compressed with zlib
+[n bytes]  JSON index, one entry per block:
+           offset, length, lines, min_time, max_time, hex (sorted list)
+[16 bytes] Offset of the JSON index (little endian u64) + the magic again
+
+Times in the index are "YYYY/MM/DD HH:MM:SS.fff" strings built from the
+message date and time columns, so they sort the same way as the times do.
+'''
+
+import os
+import csv
+import sys
+import json
+import zlib
+import struct
+import datetime
+
+
+ARCHIVE_EXT = '.adsbz'
+_MAGIC = b'ADSBZ01\n'
+_FOOTER = struct.Struct('<Q8s')
+
+
+def is_archive(file_path):
+	'''Check if a file is a raw archive by looking at the magic bytes'''
+	try:
+		with open(file_path, 'rb') as arc_file:
+			return(arc_file.read(len(_MAGIC)) == _MAGIC)
+	except OSError:
+		return(False)
+
+
+def is_complete(file_path):
+	'''Check that an archive was finished: the magic at the start and the
+	footer at the end. A conversion that was killed leaves neither footer nor
+	index.'''
+	try:
+		with open(file_path, 'rb') as arc_file:
+			if arc_file.read(len(_MAGIC)) != _MAGIC:
+				return(False)
+			arc_file.seek(0, os.SEEK_END)
+			if arc_file.tell() < len(_MAGIC) + _FOOTER.size:
+				return(False)
+			arc_file.seek(-_FOOTER.size, os.SEEK_END)
+			return(_FOOTER.unpack(arc_file.read(_FOOTER.size))[1] == _MAGIC)
+	except OSError:
+		return(False)
+
+
+def time_key(msg_time):
+	'''Turn a datetime (or an already formatted string) into an index time'''
+	if isinstance(msg_time, datetime.datetime):
+		return(msg_time.strftime("%Y/%m/%d %H:%M:%S.%f")[:-3])
+	return(str(msg_time))
+
+
+class RawArchiveWriter:
+	'''Writes raw feed lines into a block archive. Use as a context manager or
+	call close() so the index gets written. As a context manager an exception
+	removes the archive, so a failed conversion doesn't look finished.'''
+	def __init__(self, archive_path, block_lines=4096, level=6):
+		self.archive_path = archive_path
+		self.block_lines = block_lines
+		self.level = level
+		self.index = []
+		self._arc_file = open(archive_path, 'wb')
+		self._arc_file.write(_MAGIC)
+		self._reset_block()
+
+	def __enter__(self):
+		return(self)
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		if exc_type is not None:
+			self._arc_file.close()
+			os.remove(self.archive_path)
+			return
+		self.close()
+
+	def _reset_block(self):
+		self._lines = []
+		self._hex = set()
+		self._min_time = None
+		self._max_time = None
+
+	def add_line(self, raw_line):
+		'''Add one raw line (bytes, including its line ending)'''
+		self._lines.append(raw_line)
+
+		fields = raw_line.split(b',', 8)
+		# Putty headers and short lines are kept but not indexed
+		if len(fields) > 7 and b'=~' not in fields[0]:
+			self._hex.add(fields[4].decode('ascii', 'replace'))
+			msg_time = (fields[6] + b' ' + fields[7]).decode('ascii', 'replace')
+			if self._min_time is None or msg_time < self._min_time:
+				self._min_time = msg_time
+			if self._max_time is None or msg_time > self._max_time:
+				self._max_time = msg_time
+
+		if len(self._lines) >= self.block_lines:
+			self._flush_block()
+
+	def _flush_block(self):
+		'''Compress the current block and add it to the index'''
+		if not self._lines:
+			return
+
+		payload = zlib.compress(b''.join(self._lines), self.level)
+		self.index.append({
+			'offset': self._arc_file.tell(),
+			'length': len(payload),
+			'lines': len(self._lines),
+			'min_time': self._min_time,
+			'max_time': self._max_time,
+			'hex': sorted(self._hex),
+			})
+		self._arc_file.write(payload)
+		self._reset_block()
+
+	def close(self):
+		'''Write the last block, the index and the footer'''
+		if self._arc_file.closed:
+			return
+		self._flush_block()
+		index_offset = self._arc_file.tell()
+		self._arc_file.write(json.dumps(self.index).encode('utf-8'))
+		self._arc_file.write(_FOOTER.pack(index_offset, _MAGIC))
+		self._arc_file.close()
+
+
+class RawArchiveReader:
+	'''Reads a block archive. Queries only touch the blocks whose time range and
+	hex set can match.'''
+	def __init__(self, archive_path):
+		self.archive_path = archive_path
+		self.index = self._read_index()
+
+	def _read_index(self):
+		with open(self.archive_path, 'rb') as arc_file:
+			arc_file.seek(-_FOOTER.size, os.SEEK_END)
+			index_offset, magic = _FOOTER.unpack(arc_file.read(_FOOTER.size))
+			if magic != _MAGIC:
+				raise ValueError("Not a raw archive: {}".format(self.archive_path))
+			arc_file.seek(index_offset)
+			index_len = os.path.getsize(self.archive_path) - _FOOTER.size - index_offset
+			return(json.loads(arc_file.read(index_len).decode('utf-8')))
+
+	def find_blocks(self, start=None, end=None, hex_codes=None):
+		'''Return the numbers of the blocks that may hold matching messages'''
+		start = None if start is None else time_key(start)
+		end = None if end is None else time_key(end)
+		block_nums = []
+
+		for block_num, block in enumerate(self.index):
+			if block['min_time'] is None:
+				continue
+			if start is not None and block['max_time'] < start:
+				continue
+			if end is not None and block['min_time'] > end:
+				continue
+			if hex_codes is not None and not set(block['hex']) & set(hex_codes):
+				continue
+			block_nums.append(block_num)
+
+		return(block_nums)
+
+	def read_block(self, block_num, arc_file=None):
+		'''Return the raw bytes of one block'''
+		block = self.index[block_num]
+		if arc_file is None:
+			with open(self.archive_path, 'rb') as arc_file:
+				arc_file.seek(block['offset'])
+				return(zlib.decompress(arc_file.read(block['length'])))
+		arc_file.seek(block['offset'])
+		return(zlib.decompress(arc_file.read(block['length'])))
+
+	def iter_lines(self, block_nums=None):
+		'''Yield the decoded text lines of the given blocks (all by default)'''
+		if block_nums is None:
+			block_nums = range(len(self.index))
+		with open(self.archive_path, 'rb') as arc_file:
+			for block_num in block_nums:
+				raw_block = self.read_block(block_num, arc_file)
+				for line in raw_block.decode('utf-8').splitlines():
+					yield line
+
+	def iter_rows(self, start=None, end=None, hex_codes=None):
+		'''Yield the csv rows that match the time range and hex codes'''
+		start = None if start is None else time_key(start)
+		end = None if end is None else time_key(end)
+		block_nums = self.find_blocks(start, end, hex_codes)
+
+		for row in csv.reader(self.iter_lines(block_nums), delimiter=','):
+			if start is None and end is None and hex_codes is None:
+				yield row
+				continue
+			if len(row) < 8 or "=~" in row[0]:
+				continue
+			if hex_codes is not None and row[4] not in hex_codes:
+				continue
+			msg_time = row[6] + ' ' + row[7]
+			if start is not None and msg_time < start:
+				continue
+			if end is not None and msg_time > end:
+				continue
+			yield row
+
+
+def archive_raw_file(raw_path, archive_path=None, block_lines=4096):
+	'''Convert a live_raw_* text file into an archive next to it. Returns the
+	path of the archive.'''
+	if archive_path is None:
+		archive_path = raw_path + ARCHIVE_EXT
+
+	with open(raw_path, 'rb') as raw_file, \
+			RawArchiveWriter(archive_path, block_lines) as arc_writer:
+		for raw_line in raw_file:
+			arc_writer.add_line(raw_line)
+
+	return(archive_path)
+
+
+# Convert existing raw files: python RawArchive.py <live_raw files...>
+if __name__ == "__main__":
+	for raw_arg in sys.argv[1:]:
+		arc_path = archive_raw_file(raw_arg)
+		print("{} -> {} ({} -> {} bytes)".format(
+			raw_arg, arc_path, os.path.getsize(raw_arg), os.path.getsize(arc_path)))
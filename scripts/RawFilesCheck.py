@@ -0,0 +1,102 @@
+################################################################################
+# RawFilesCheck.py
+# @author: Ryan Herrin
+#
+# Check that a raw snapshot kept as text and as an archive is only read once.
+# A snapshot made from the sample feed is queried as text, after it is
+# archived next to itself, with the archive cut short and as an archive on its
+# own. Every query has to return the same rows.
+################################################################################
+
+'''
+Usage:
+------------------
+python RawFilesCheck.py
+python RawFilesCheck.py --sample ../data/adsb_sample_data/30003_Sample_Data.csv
+'''
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+from collections import Counter
+
+import RawArchive
+from RawIndex import iter_raw_files, query_raw, load_raw_index
+
+
+SNAPSHOT = 'live_raw_2022_06_20_12_00_00'
+
+
+def check_raw_files(work_dir, sample_path):
+	'''Returns a list of what went wrong, empty if it all checked out'''
+	problems = []
+	raw_dir = os.path.join(work_dir, 'raw')
+	os.makedirs(raw_dir)
+	raw_path = os.path.join(raw_dir, SNAPSHOT)
+	archive_path = raw_path + RawArchive.ARCHIVE_EXT
+	shutil.copyfile(sample_path, raw_path)
+	load_raw_index(raw_path)
+	with open(raw_path, 'r', encoding='latin-1') as raw_in:
+		busiest = Counter(line.split(',')[4] for line in raw_in
+						  if line.startswith('MSG')).most_common(1)[0][0]
+
+	def check(how, expected_files):
+		files = [os.path.basename(path) for path in iter_raw_files(raw_dir)]
+		if files != expected_files:
+			problems.append("{}: read {} instead of {}".format(how, files, expected_files))
+		rows = len(query_raw(raw_dir, busiest))
+		if rows != text_rows:
+			problems.append("{}: {} rows for {} instead of {}".format(how, rows, busiest,
+																	  text_rows))
+
+	text_rows = len(query_raw(raw_dir, busiest))
+	if text_rows == 0:
+		problems.append("no rows for {} in the text snapshot".format(busiest))
+
+	RawArchive.archive_raw_file(raw_path)
+	check("text and archive", [SNAPSHOT + RawArchive.ARCHIVE_EXT])
+
+	# A conversion that was killed leaves no footer, so the text is used
+	with open(archive_path, 'r+b') as arc_file:
+		arc_file.truncate(os.path.getsize(archive_path) // 2)
+	check("text and a cut short archive", [SNAPSHOT])
+
+	# A conversion that failed removes its archive
+	try:
+		with RawArchive.RawArchiveWriter(archive_path) as arc_writer:
+			arc_writer.add_line(b'MSG,3,1,1,ABCDEF,1,2022/06/20,12:00:00.000,,,\r\n')
+			raise RuntimeError("Disk full")
+	except RuntimeError:
+		pass
+	if os.path.exists(archive_path):
+		problems.append("a failed conversion left its archive behind")
+
+	RawArchive.archive_raw_file(raw_path)
+	os.remove(raw_path)
+	os.remove(raw_path + '.idx')
+	check("archive on its own", [SNAPSHOT + RawArchive.ARCHIVE_EXT])
+	return(problems)
+
+
+######## Entry #########
+if __name__ == "__main__":
+	arg_parser = argparse.ArgumentParser(description="Check raw snapshots are only read once")
+	arg_parser.add_argument('--sample', default=os.path.join(
+		os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'adsb_sample_data',
+		'30003_Sample_Data.csv'), help="SBS feed to make the snapshot from")
+	args = arg_parser.parse_args()
+
+	work_dir = tempfile.mkdtemp(prefix='raw_files_check_')
+	try:
+		check_problems = check_raw_files(work_dir, args.sample)
+	finally:
+		shutil.rmtree(work_dir, ignore_errors=True)
+	if check_problems:
+		print("Raw files FAILED:")
+		for problem in check_problems:
+			print("  " + problem)
+		sys.exit(1)
+	print("Raw files OK")
+	sys.exit(0)
@@ -0,0 +1,274 @@
+################################################################################
+# RawIndex.py
+# @author: Ryan Herrin
+#
+# Sidecar index for live_raw_* files so a question like "every message from
+# A8FDA9 between 14:00 and 15:00" only reads the lines it needs instead of
+# reparsing every raw file.
+################################################################################
+
+'''
+Index file (<raw file>.idx, JSON):
+------------------
+base_ms   : Epoch ms of midnight on the first date in the file. All other
+            times are ms after this to keep the file small
+min_ms    : First message time
+max_ms    : Last message time
+lines     : Number of lines in the raw file
+hex       : {hex: [[offset, ...], [time, ...]]} byte offset and time of every
+            line for that aircraft, in file order
+blocks    : [[offset, end, min_time, max_time], ...] one per block_lines lines,
+            used for queries with only a time range
+
+Archives written by RawArchive already have a block index, so queries on them
+go through RawArchiveReader instead.
+'''
+
+import os
+import csv
+import sys
+import json
+import bisect
+import datetime
+
+import RawArchive
+
+
+INDEX_EXT = '.idx'
+_EPOCH = datetime.datetime(1970, 1, 1)
+_day_ms_cache = dict()
+
+
+def _date_ms(msg_date):
+	'''Epoch ms for midnight of a "YYYY/MM/DD" date'''
+	day_ms = _day_ms_cache.get(msg_date)
+	if day_ms is None:
+		year, month, day = msg_date.split('/')
+		day_ms = int((datetime.datetime(int(year), int(month), int(day)) -
+					  _EPOCH).total_seconds()) * 1000
+		_day_ms_cache[msg_date] = day_ms
+	return(day_ms)
+
+
+def message_ms(msg_date, msg_time):
+	'''Epoch ms for the message date and "HH:MM:SS.fff" time columns'''
+	hms = msg_time.split(':')
+	return(_date_ms(msg_date) + int(hms[0]) * 3600000 + int(hms[1]) * 60000 +
+		   int(round(float(hms[2]) * 1000)))
+
+
+def to_ms(query_time):
+	'''Turn a datetime or "YYYY/MM/DD HH:MM:SS[.fff]" string into epoch ms'''
+	if isinstance(query_time, datetime.datetime):
+		return(int((query_time - _EPOCH).total_seconds() * 1000))
+	msg_date, msg_time = str(query_time).split(' ')
+	return(message_ms(msg_date, msg_time))
+
+
+def index_path(raw_path):
+	return(raw_path + INDEX_EXT)
+
+
+def build_raw_index(raw_path, block_lines=256):
+	'''Scan a raw text file and write its sidecar index. Returns the index.'''
+	hex_index = dict()
+	blocks = []
+	base_ms = None
+	min_ms = None
+	max_ms = None
+	line_count = 0
+	block_start = 0
+	block_min = None
+	block_max = None
+
+	with open(raw_path, 'rb') as raw_file:
+		offset = 0
+		for raw_line in raw_file:
+			line_count += 1
+			fields = raw_line.split(b',', 8)
+
+			# Putty headers and short lines take up space but are not indexed
+			if len(fields) > 7 and b'=~' not in fields[0]:
+				try:
+					msg_date = fields[6].decode('ascii')
+					msg_ms = message_ms(msg_date, fields[7].decode('ascii'))
+				except (ValueError, IndexError, UnicodeDecodeError):
+					msg_ms = None
+
+				if msg_ms is not None:
+					if base_ms is None:
+						base_ms = _date_ms(msg_date)
+					rel_ms = msg_ms - base_ms
+					if min_ms is None or rel_ms < min_ms:
+						min_ms = rel_ms
+					if max_ms is None or rel_ms > max_ms:
+						max_ms = rel_ms
+					if block_min is None or rel_ms < block_min:
+						block_min = rel_ms
+					if block_max is None or rel_ms > block_max:
+						block_max = rel_ms
+
+					hex_entry = hex_index.setdefault(fields[4].decode('ascii'), [[], []])
+					hex_entry[0].append(offset)
+					hex_entry[1].append(rel_ms)
+
+			offset += len(raw_line)
+			if line_count % block_lines == 0:
+				blocks.append([block_start, offset, block_min, block_max])
+				block_start = offset
+				block_min = None
+				block_max = None
+
+		if offset > block_start:
+			blocks.append([block_start, offset, block_min, block_max])
+
+	raw_index = {
+		'base_ms': base_ms if base_ms is not None else 0,
+		'min_ms': min_ms,
+		'max_ms': max_ms,
+		'lines': line_count,
+		'hex': dict(sorted(hex_index.items())),
+		'blocks': blocks,
+		}
+
+	with open(index_path(raw_path), 'w') as idx_file:
+		json.dump(raw_index, idx_file, separators=(',', ':'))
+
+	return(raw_index)
+
+
+def load_raw_index(raw_path, build=True):
+	'''Load the sidecar index for a raw file, building it if it is missing or
+	older than the raw file'''
+	idx_path = index_path(raw_path)
+	if (not os.path.exists(idx_path) or
+			os.path.getmtime(idx_path) < os.path.getmtime(raw_path)):
+		if not build:
+			return(None)
+		return(build_raw_index(raw_path))
+
+	with open(idx_path, 'r') as idx_file:
+		return(json.load(idx_file))
+
+
+def _read_lines_at(raw_path, offsets):
+	'''Read the lines that start at the given byte offsets'''
+	lines = []
+	with open(raw_path, 'rb') as raw_file:
+		for offset in offsets:
+			raw_file.seek(offset)
+			lines.append(raw_file.readline().decode('utf-8'))
+	return(lines)
+
+
+def _read_ranges(raw_path, ranges):
+	'''Read the lines in the given (start, end) byte ranges'''
+	lines = []
+	with open(raw_path, 'rb') as raw_file:
+		for start, end in ranges:
+			raw_file.seek(start)
+			lines.extend(raw_file.read(end - start).decode('utf-8').splitlines())
+	return(lines)
+
+
+def query_raw_file(raw_path, hex_code=None, start=None, end=None):
+	'''Return the raw rows of one file for an aircraft and/or a time range.
+	start and end are inclusive and can be datetimes or
+	"YYYY/MM/DD HH:MM:SS[.fff]" strings.'''
+	start_ms = None if start is None else to_ms(start)
+	end_ms = None if end is None else to_ms(end)
+	hex_codes = None if hex_code is None else [hex_code]
+
+	if RawArchive.is_archive(raw_path):
+		arc_reader = RawArchive.RawArchiveReader(raw_path)
+		return(list(arc_reader.iter_rows(start, end, hex_codes)))
+
+	raw_index = load_raw_index(raw_path)
+	if raw_index['min_ms'] is None:
+		return([])
+	base_ms = raw_index['base_ms']
+	rel_start = None if start_ms is None else start_ms - base_ms
+	rel_end = None if end_ms is None else end_ms - base_ms
+
+	# Skip the whole file if it does not overlap the time range
+	if rel_start is not None and raw_index['max_ms'] < rel_start:
+		return([])
+	if rel_end is not None and raw_index['min_ms'] > rel_end:
+		return([])
+
+	if hex_code is not None:
+		hex_entry = raw_index['hex'].get(hex_code)
+		if hex_entry is None:
+			return([])
+		offsets, times = hex_entry
+		# Times only go down if the feed clock did, so fall back to a filter
+		if times == sorted(times):
+			first = 0 if rel_start is None else bisect.bisect_left(times, rel_start)
+			last = len(times) if rel_end is None else bisect.bisect_right(times, rel_end)
+			offsets = offsets[first:last]
+		else:
+			offsets = [offsets[pos] for pos in range(len(times)) if
+					   (rel_start is None or times[pos] >= rel_start) and
+					   (rel_end is None or times[pos] <= rel_end)]
+		rows = csv.reader(_read_lines_at(raw_path, offsets), delimiter=',')
+		return(list(rows))
+
+	# Time range only: read the blocks that overlap it and filter the lines
+	ranges = [(blk[0], blk[1]) for blk in raw_index['blocks'] if blk[2] is not None and
+			  (rel_start is None or blk[3] >= rel_start) and
+			  (rel_end is None or blk[2] <= rel_end)]
+	matched = []
+	for row in csv.reader(_read_ranges(raw_path, ranges), delimiter=','):
+		if len(row) < 8 or "=~" in row[0]:
+			continue
+		try:
+			msg_ms = message_ms(row[6], row[7])
+		except (ValueError, IndexError):
+			continue
+		if start_ms is not None and msg_ms < start_ms:
+			continue
+		if end_ms is not None and msg_ms > end_ms:
+			continue
+		matched.append(row)
+
+	return(matched)
+
+
+def iter_raw_files(raw_dir):
+	'''Paths of the raw snapshots in a directory, text or archive, in time
+	order. RawArchive.py leaves a snapshot's text file next to its archive, so
+	only the archive is used unless it wasn't finished.'''
+	raw_files = set(os.listdir(raw_dir))
+	for raw_file in sorted(raw_files):
+		if raw_file == ".init" or raw_file.endswith(INDEX_EXT):
+			continue
+		raw_path = os.path.join(raw_dir, raw_file)
+		if raw_file.endswith(RawArchive.ARCHIVE_EXT):
+			# A cut short archive is left for its text file, if there is one
+			if raw_file[:-len(RawArchive.ARCHIVE_EXT)] in raw_files and \
+					not RawArchive.is_complete(raw_path):
+				continue
+		elif raw_file + RawArchive.ARCHIVE_EXT in raw_files and \
+				RawArchive.is_complete(raw_path + RawArchive.ARCHIVE_EXT):
+			continue
+		yield(raw_path)
+
+
+def query_raw(raw_dir, hex_code=None, start=None, end=None):
+	'''Query every raw snapshot (text or archive, see iter_raw_files) in a
+	directory. Files are only opened past their index if their time range
+	overlaps the query.'''
+	matched = []
+	for raw_path in iter_raw_files(raw_dir):
+		matched.extend(query_raw_file(raw_path, hex_code, start, end))
+	return(matched)
+
+
+# python RawIndex.py <raw dir> <hex|-> [start] [end]
+# e.g. python RawIndex.py ../data/adsb_raw_data A8FDA9 "2022/06/22 14:00:00" "2022/06/22 15:00:00"
+if __name__ == "__main__":
+	q_hex = None if sys.argv[2] == '-' else sys.argv[2]
+	q_start = sys.argv[3] if len(sys.argv) > 3 else None
+	q_end = sys.argv[4] if len(sys.argv) > 4 else None
+	for q_row in query_raw(sys.argv[1], q_hex, q_start, q_end):
+		print(','.join(q_row))
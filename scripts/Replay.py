@@ -0,0 +1,324 @@
+################################################################################
+# Replay.py
+# @author: Ryan Herrin
+#
+# Replays recorded feeds (live_raw_* snapshots, archives, 30003_Sample_Data.csv)
+# so a busy day's load can be put on the Pi whenever we want it. Lines go out
+# on a local SBS port (30003) for the ingest to connect to, or are appended to
+# a live feed file, either following the original message times sped up or as
+# fast as possible. Whatever the downstream writes is watched so the run ends
+# with the rate it kept up and how far behind it got.
+################################################################################
+
+'''
+Usage:
+------------------
+python Replay.py live_raw_2022_06_20.csv --speed 100              # serve on :30003
+python Replay.py live_raw_*.csv --speed 0 --watch 30003_LiveFeed.csv
+python Replay.py 30003_Sample_Data.csv --speed 0 --repeat 200 --ingest /tmp/live.csv
+python Replay.py 30003_Sample_Data.csv --append 30003_LiveFeed.csv --speed 1000
+python Replay.py 30003_Sample_Data.csv --speed 0 --ingest /tmp/live.csv --profile --metrics-dir /tmp/m
+
+--speed is 1 to 1000 times real time, 0 for flat out. --repeat sends the
+files again that many times, later passes carrying on from where the last
+one's times ended. --ingest runs IngestPipeline here as the downstream
+(writing to the given file), otherwise --watch names the file that the
+downstream writes.
+
+Report:
+------------------
+sent_per_sec       rate the lines went out at
+sustained_per_sec  rate the downstream wrote them at, first send to last line
+latency_ms         p50 / p95 / p99 / max from a line being sent to it showing
+                   up in the watched file. Lines are matched up by count, so
+                   the downstream has to pass every line through (the SBS
+                   ingest does), and the poll interval is included.
+backlog            lines sent but not written yet when sending finished
+'''
+
+import os
+import sys
+import time
+import bisect
+import argparse
+import threading
+
+from Metrics import Metrics
+from RawIndex import message_ms
+
+
+MAX_SPEED = 1000.0
+_POLL_SECONDS = 0.005
+
+
+def iter_raw_lines(raw_path):
+	'''Lines of a raw text file or archive, with their line endings'''
+	from RawArchive import is_archive, RawArchiveReader
+	if is_archive(raw_path):
+		for line in RawArchiveReader(raw_path).iter_lines():
+			yield(line + '\r\n')
+		return
+	with open(raw_path, 'r', newline='', encoding='latin-1') as raw_in:
+		for line in raw_in:
+			yield(line)
+
+
+def _line_ms(line):
+	'''Message time of an SBS line in epoch ms, None if it hasn't got one'''
+	fields = line.split(',', 8)
+	if len(fields) < 8 or fields[0] != 'MSG':
+		return(None)
+	try:
+		return(message_ms(fields[6], fields[7]))
+	except (ValueError, IndexError):
+		return(None)
+
+
+def paced_batches(raw_paths, speed=0.0, repeat=1, batch_lines=512):
+	'''Yield (seconds from the start it is due at, lines). Lines due within a
+	few ms of each other go together. With speed 0 everything is due at once
+	and the batches are just batch_lines long.'''
+	first_ms = None
+	offset_ms = 0
+	for num in range(repeat):
+		last_ms = None
+		due = 0.0
+		batch = []
+		for raw_path in raw_paths:
+			for line in iter_raw_lines(raw_path):
+				if speed > 0:
+					msg_ms = _line_ms(line)
+					# Lines without a time go out with the line before them
+					if msg_ms is not None:
+						if first_ms is None:
+							first_ms = msg_ms
+						last_ms = msg_ms if last_ms is None else max(last_ms, msg_ms)
+						msg_due = (msg_ms + offset_ms - first_ms) / speed / 1000.0
+						if batch and msg_due - due > 0.002:
+							yield((due, batch))
+							batch = []
+						if not batch:
+							due = msg_due
+				batch.append(line)
+				if len(batch) >= batch_lines:
+					yield((due, batch))
+					batch = []
+		if batch:
+			yield((due, batch))
+		if last_ms is not None:
+			# The next pass starts a second after this one ended
+			offset_ms = last_ms + 1000 - first_ms
+
+
+class LineWatcher:
+	'''Thread that polls a file the downstream writes and notes when each
+	newline turns up. Only what's written after it starts is counted.'''
+	def __init__(self, watch_path):
+		self.watch_path = watch_path
+		self.seen = [] # (monotonic time, lines so far)
+		self.total = 0
+		self._stop = threading.Event()
+		self._start_size = os.path.getsize(watch_path) if os.path.exists(watch_path) else 0
+		self._thread = threading.Thread(target=self._run, daemon=True)
+		self._thread.start()
+
+	def _run(self):
+		position = self._start_size
+		while not self._stop.is_set():
+			try:
+				with open(self.watch_path, 'rb') as watch_in:
+					watch_in.seek(position)
+					data = watch_in.read()
+			except OSError:
+				data = b''
+			if data:
+				position += len(data)
+				lines = data.count(b'\n')
+				if lines:
+					self.total += lines
+					self.seen.append((time.monotonic(), self.total))
+			else:
+				time.sleep(_POLL_SECONDS)
+
+	def wait_for(self, lines, idle_seconds=5.0):
+		'''Wait for lines to have been written, giving up once nothing new has
+		turned up for idle_seconds'''
+		last_total = -1
+		last_change = time.monotonic()
+		while self.total < lines:
+			if self.total != last_total:
+				last_total = self.total
+				last_change = time.monotonic()
+			elif time.monotonic() - last_change > idle_seconds:
+				break
+			time.sleep(_POLL_SECONDS)
+
+	def stop(self):
+		self._stop.set()
+		self._thread.join()
+
+
+def _percentile(values, fraction):
+	if not values:
+		return(None)
+	return(values[min(len(values) - 1, int(fraction * len(values)))])
+
+
+def send_lines(batches, send, metrics):
+	'''Send each batch when it is due. Returns [(time sent, lines so far)].'''
+	sent = []
+	total = 0
+	start = time.monotonic()
+	for due, lines in batches:
+		wait = start + due - time.monotonic()
+		if wait > 0:
+			time.sleep(wait)
+		with metrics.stage('send'):
+			send(''.join(lines).encode('latin-1'))
+		total += len(lines)
+		sent.append((time.monotonic(), total))
+	metrics.count('lines_sent', total)
+	return(sent)
+
+
+def report(sent, watcher, metrics):
+	'''Rates and latency for a finished run, also kept in the metrics counters'''
+	result = {'lines_sent': sent[-1][1] if sent else 0}
+	if sent:
+		send_seconds = sent[-1][0] - sent[0][0]
+		result['sent_per_sec'] = result['lines_sent'] / send_seconds if send_seconds else None
+
+	if watcher is not None and sent:
+		first_sent = sent[0][0]
+		sent_counts = [count for when, count in sent]
+		latencies = []
+		backlog = result['lines_sent']
+		for seen_time, seen_total in watcher.seen:
+			# The batch that line number seen_total went out in
+			pos = bisect.bisect_left(sent_counts, seen_total)
+			if pos < len(sent):
+				latencies.append(seen_time - sent[pos][0])
+			if seen_time <= sent[-1][0]:
+				backlog = result['lines_sent'] - seen_total
+		latencies.sort()
+		result['lines_written'] = watcher.total
+		result['backlog'] = max(0, backlog) if watcher.seen else result['lines_sent']
+		if watcher.seen and watcher.seen[-1][0] > first_sent:
+			result['sustained_per_sec'] = watcher.total / (watcher.seen[-1][0] - first_sent)
+		result['latency_ms'] = {name: round(_percentile(latencies, fraction) * 1000.0, 2)
+								for name, fraction in [('p50', 0.5), ('p95', 0.95),
+													   ('p99', 0.99), ('max', 1.0)]} \
+			if latencies else None
+
+	for name, value in result.items():
+		if name == 'latency_ms':
+			for stat, ms in (value or {}).items():
+				metrics.counters['latency_' + stat + '_ms'] = ms
+		elif name != 'lines_sent' and value is not None:
+			metrics.counters[name] = round(value, 2)
+	return(result)
+
+
+def _ingest_downstream(port, output_path):
+	'''Run the SBS ingest pipeline here, connected to our own port'''
+	import socket
+	from IngestPipeline import IngestPipeline, sbs_line_parser
+
+	def run():
+		with socket.create_connection(('localhost', port)) as feed_sock:
+			IngestPipeline(lambda: feed_sock.recv(65536), sbs_line_parser(),
+						   output_path, Metrics('ingest')).run()
+	ingest = threading.Thread(target=run, daemon=True)
+	ingest.start()
+	return(ingest)
+
+
+def replay(raw_paths, speed=0.0, repeat=1, port=30003, append_path=None, watch_path=None,
+		   ingest_path=None, metrics=None):
+	'''Replay raw files over a local SBS port (the downstream connects to us)
+	or onto the end of append_path. Returns the report.'''
+	import socket
+	if speed != 0 and not 1 <= speed <= MAX_SPEED:
+		raise ValueError("Speed has to be 0 (flat out) or 1 to {:.0f}".format(MAX_SPEED))
+	metrics = metrics if metrics is not None else Metrics('replay')
+	watch_path = ingest_path or watch_path
+	watcher = LineWatcher(watch_path) if watch_path is not None else None
+	batches = paced_batches(raw_paths, speed, repeat)
+
+	try:
+		if append_path is not None:
+			with open(append_path, 'ab') as live_out:
+				def append(data):
+					live_out.write(data)
+					live_out.flush()
+				sent = send_lines(batches, append, metrics)
+		else:
+			with socket.create_server(('localhost', port)) as server:
+				if ingest_path is not None:
+					ingest = _ingest_downstream(port, ingest_path)
+				else:
+					print("Waiting for the downstream to connect on port {}".format(port))
+				conn, addr = server.accept()
+				with conn:
+					sent = send_lines(batches, conn.sendall, metrics)
+			if ingest_path is not None:
+				ingest.join()
+		if watcher is not None and sent:
+			watcher.wait_for(sent[-1][1])
+	finally:
+		if watcher is not None:
+			watcher.stop()
+	return(report(sent, watcher, metrics))
+
+
+def print_report(result):
+	print("sent        {:>12,} lines at {:>12,.0f}/sec".format(
+		result['lines_sent'], result.get('sent_per_sec') or 0))
+	if 'lines_written' not in result:
+		return
+	print("written     {:>12,} lines at {:>12,.0f}/sec sustained".format(
+		result['lines_written'], result.get('sustained_per_sec') or 0))
+	print("backlog     {:>12,} lines when sending finished".format(result['backlog']))
+	if result['latency_ms']:
+		print("latency ms  " + "  ".join("{} {}".format(name, ms) for name, ms in
+										 result['latency_ms'].items()))
+
+
+######## Entry #########
+if __name__ == "__main__":
+	arg_parser = argparse.ArgumentParser(description="Replay recorded feeds for load testing")
+	arg_parser.add_argument('raw_files', nargs='+', help="live_raw_* files, archives or samples")
+	arg_parser.add_argument('--speed', type=float, default=1.0,
+							help="Times real time (1 to 1000), 0 for as fast as possible")
+	arg_parser.add_argument('--repeat', type=int, default=1, help="Send the files this many times")
+	arg_parser.add_argument('--port', type=int, default=30003, help="Local SBS port to serve on")
+	arg_parser.add_argument('--append', default=None,
+							help="Append to this live feed file instead of serving")
+	arg_parser.add_argument('--watch', default=None,
+							help="File the downstream writes, for its rate and latency")
+	arg_parser.add_argument('--ingest', default=None,
+							help="Run the ingest pipeline here, writing to this file")
+	arg_parser.add_argument('--metrics-dir', default=None, help="Also write the metrics JSON")
+	arg_parser.add_argument('--profile', action='store_true',
+							help="cProfile the replay, saved as a .prof in --metrics-dir")
+	arg_parser.add_argument('--trace-memory', action='store_true',
+							help="Record peak memory with tracemalloc")
+	args = arg_parser.parse_args()
+
+	if args.speed != 0 and not 1 <= args.speed <= MAX_SPEED:
+		arg_parser.error("--speed has to be 0 or between 1 and {:.0f}".format(MAX_SPEED))
+	if args.append is not None and args.ingest is not None:
+		arg_parser.error("--ingest reads from the port, it can't be used with --append")
+	if (args.profile or args.trace_memory) and args.metrics_dir is None:
+		arg_parser.error("--profile and --trace-memory are written to --metrics-dir")
+
+	replay_metrics = Metrics('replay', profile=args.profile, trace_memory=args.trace_memory)
+	replay_metrics.start_capture()
+	try:
+		print_report(replay(args.raw_files, args.speed, args.repeat, args.port, args.append,
+							args.watch, args.ingest, replay_metrics))
+	except KeyboardInterrupt:
+		sys.exit(1)
+	if args.metrics_dir is not None:
+		replay_metrics.write_json(args.metrics_dir)
+	sys.exit(0)
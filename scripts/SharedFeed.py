@@ -0,0 +1,362 @@
+################################################################################
+# SharedFeed.py
+# @author: Ryan Herrin
+#
+# One process reads the dump1090 feed, decodes each SBS message once into a
+# fixed size record and writes it into a ring buffer in shared memory. Any
+# number of local processes (snapshot parser, live counters, alerting...)
+# read the ring with their own cursor, so none of them needs its own
+# connection to dump1090 or to re-read the live file. The ring never waits
+# on a slow reader: a reader that falls more than a ring behind is told how
+# many records it missed and skips ahead.
+################################################################################
+
+'''
+Usage:
+------------------
+python SharedFeed.py serve --port 30003 [--name adsb_feed --capacity 65536]
+python SharedFeed.py serve --file 30003_Sample_Data.csv      # a recorded feed
+python SharedFeed.py tail [--name adsb_feed]                  # print what comes in
+python SharedFeed.py bench --consumers 4 --records 2000000
+
+Layout (little endian):
+------------------
+header  [0:64)   sequence (u64, records ever written), capacity (u32),
+                 record size (u32), writing (u64, what sequence will be
+                 once the batch being written is done)
+records [64:)    capacity records of RECORD, record n is in slot n % capacity
+
+The writer moves writing on before it touches a slot and sequence after,
+so a reader compares what it copied against writing to know if any of it
+could have been overwritten while it was copying.
+
+RECORD: time ms (i64), hex (u32), message type (u8), flight (8 bytes),
+altitude (i32), ground speed (i16), squawk (4 bytes). Missing numbers are
+stored as MISSING.
+'''
+
+import sys
+import time
+import struct
+import argparse
+import datetime
+
+from RawIndex import message_ms
+
+
+RECORD = struct.Struct('<qIB8sih4sx')
+HEADER = struct.Struct('<QII')
+HEADER_SIZE = 64
+_WRITING = 16 # Offset of the writing counter in the header
+MISSING = -32768 # Fits in the ground speed's i16 too
+DEFAULT_NAME = 'adsb_feed'
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+# Rings made by this process, see _untrack
+_OWNED = set()
+
+
+def encode_sbs(fields):
+	'''RECORD values for an SBS MSG row (already split on commas), None for
+	anything that isn't one'''
+	if len(fields) < 18 or fields[0] != 'MSG' or fields[4] in ('', '000000'):
+		return(None)
+	try:
+		return((message_ms(fields[6], fields[7]), int(fields[4], 16), int(fields[1]),
+				fields[10].strip().encode('latin-1')[:8],
+				int(fields[11]) if fields[11] != '' else MISSING,
+				int(float(fields[12])) if fields[12] != '' else MISSING,
+				fields[17].encode('latin-1')[:4]))
+	except (ValueError, IndexError):
+		return(None)
+
+
+def record_to_row(record):
+	'''An SBS shaped row (22 fields) for a record, for code that works on the
+	raw feed like LiveCounters.update'''
+	msg_ms, hex_code, msg_type, flight, alt, gs, squawk = record
+	when = _EPOCH + datetime.timedelta(milliseconds=msg_ms)
+	row = [''] * 22
+	row[0] = 'MSG'
+	row[1] = str(msg_type)
+	row[4] = "{:06X}".format(hex_code)
+	row[6] = row[8] = when.strftime("%Y/%m/%d")
+	row[7] = row[9] = when.strftime("%H:%M:%S.") + "{:03d}".format(when.microsecond // 1000)
+	row[10] = flight.rstrip(b'\x00').decode('latin-1')
+	row[11] = '' if alt == MISSING else str(alt)
+	row[12] = '' if gs == MISSING else str(gs)
+	row[17] = squawk.rstrip(b'\x00').decode('latin-1')
+	return(row)
+
+
+class FeedRing:
+	'''The writer's side of the ring. There should only be one writer.'''
+	def __init__(self, name=DEFAULT_NAME, capacity=65536):
+		from multiprocessing import shared_memory
+		self.capacity = capacity
+		self.shm = shared_memory.SharedMemory(name=name, create=True,
+											  size=HEADER_SIZE + capacity * RECORD.size)
+		self.buf = self.shm.buf
+		self.sequence = 0
+		HEADER.pack_into(self.buf, 0, 0, capacity, RECORD.size)
+		struct.pack_into('<Q', self.buf, _WRITING, 0)
+		_OWNED.add(name)
+
+	def publish(self, records):
+		'''Write a batch of RECORD tuples, then move the sequence on so readers
+		only ever see whole records. writing is moved on first so readers
+		know which slots are about to change.'''
+		records = records if isinstance(records, list) else list(records)
+		# A batch can't be bigger than the ring or it would wrap onto itself
+		for start in range(0, len(records), self.capacity):
+			batch = records[start:start + self.capacity]
+			sequence = self.sequence
+			struct.pack_into('<Q', self.buf, _WRITING, sequence + len(batch))
+			for record in batch:
+				RECORD.pack_into(self.buf, HEADER_SIZE + (sequence % self.capacity) *
+								 RECORD.size, *record)
+				sequence += 1
+			self.sequence = sequence
+			struct.pack_into('<Q', self.buf, 0, sequence)
+
+	def publish_lines(self, lines):
+		'''Decode raw SBS lines and publish them. Returns how many went in.'''
+		records = []
+		for line in lines:
+			record = encode_sbs(line.rstrip('\r\n').split(','))
+			if record is not None:
+				records.append(record)
+		if records:
+			self.publish(records)
+		return(len(records))
+
+	def close(self, unlink=True):
+		self.buf.release()
+		self.shm.close()
+		if unlink:
+			self.shm.unlink()
+			_OWNED.discard(self.shm.name)
+
+
+class RingCursor:
+	'''A reader's side of the ring. start is 'latest' (only new records) or
+	'oldest' (everything still in the ring).'''
+	def __init__(self, name=DEFAULT_NAME, start='latest'):
+		from multiprocessing import shared_memory
+		self.shm = shared_memory.SharedMemory(name=name, create=False)
+		_untrack(name, self.shm)
+		self.buf = self.shm.buf
+		sequence, self.capacity, record_size = HEADER.unpack_from(self.buf, 0)
+		if record_size != RECORD.size:
+			raise ValueError("Ring has {} byte records, expected {}".format(
+				record_size, RECORD.size))
+		self.position = sequence if start == 'latest' else max(0, sequence - self.capacity)
+		self.lost = 0
+
+	def _writer_sequence(self):
+		return(struct.unpack_from('<Q', self.buf, 0)[0])
+
+	def _writer_writing(self):
+		return(struct.unpack_from('<Q', self.buf, _WRITING)[0])
+
+	def read_views(self, max_records=4096):
+		'''Memoryviews over the next records (one, or two if they wrap), without
+		copying them out. Returns (views, records lost to an overrun). Check
+		still_valid once done with the views.'''
+		sequence = self._writer_sequence()
+		# Slots the batch being written is going over are already lost
+		oldest = self._writer_writing() - self.capacity
+		lost = 0
+		if oldest > self.position:
+			lost = oldest - self.position
+			self.position = oldest
+		count = min(max(0, sequence - self.position), max_records)
+		views = []
+		start = self.position
+		while count > 0:
+			slot = start % self.capacity
+			run = min(count, self.capacity - slot)
+			offset = HEADER_SIZE + slot * RECORD.size
+			views.append(self.buf[offset:offset + run * RECORD.size])
+			start += run
+			count -= run
+		self._view_start = self.position
+		self.position = start
+		self.lost += lost
+		return(views, lost)
+
+	def still_valid(self):
+		'''How many of the records from the last read_views were (or are being)
+		overwritten while they were read (0 if none). Those should be thrown
+		away.'''
+		overwritten = self._writer_writing() - self._view_start - self.capacity
+		return(max(0, min(overwritten, self.position - self._view_start)))
+
+	def read(self, max_records=4096):
+		'''The next records as tuples. Returns (records, records lost). Records
+		overwritten while being copied are dropped and counted as lost.'''
+		views, lost = self.read_views(max_records)
+		records = []
+		for view in views:
+			records.extend(RECORD.iter_unpack(view))
+			view.release()
+		torn = self.still_valid()
+		if torn:
+			records = records[torn:]
+			self.lost += torn
+			lost += torn
+		return(records, lost)
+
+	def close(self):
+		self.buf.release()
+		self.shm.close()
+
+
+def _untrack(name, shm):
+	'''A reader that isn't the owner mustn't have the resource tracker remove
+	the ring when it exits. Processes started from the owner share its
+	tracker, so only separate processes need taking off it.'''
+	import multiprocessing
+	if name in _OWNED or multiprocessing.parent_process() is not None:
+		return
+	from multiprocessing import resource_tracker
+	resource_tracker.unregister(shm._name, 'shared_memory')
+
+
+def serve(ring, host='localhost', port=30003, file_path=None):
+	'''Fill the ring from the dump1090 SBS feed, or from a recorded file'''
+	import socket
+	if file_path is not None:
+		with open(file_path, 'r', newline='', encoding='latin-1') as raw_in:
+			batch = []
+			for line in raw_in:
+				batch.append(line)
+				if len(batch) >= 512:
+					ring.publish_lines(batch)
+					batch = []
+			ring.publish_lines(batch)
+		return
+
+	with socket.create_connection((host, port)) as sbs_sock:
+		left_over = ''
+		while True:
+			data = sbs_sock.recv(65536)
+			if not data:
+				break
+			lines = (left_over + data.decode('latin-1')).split('\n')
+			left_over = lines.pop()
+			ring.publish_lines(lines)
+
+
+######## Benchmark #########
+def _bench_consumer(name, total, results):
+	'''Read until total records have been seen (read or lost)'''
+	cursor = RingCursor(name, start='oldest')
+	seen = 0
+	checksum = 0
+	start = time.perf_counter()
+	while seen < total:
+		records, lost = cursor.read()
+		if not records and not lost:
+			time.sleep(0.0005)
+			continue
+		seen += len(records) + lost
+		for record in records:
+			checksum += record[1]
+	results.put((time.perf_counter() - start, seen - cursor.lost, cursor.lost, checksum))
+	cursor.close()
+
+
+def bench_fanout(consumers=4, records=1000000, capacity=65536, name='adsb_feed_bench'):
+	'''One writer publishing made up records as fast as it can while every
+	consumer reads them all. Returns a dict of writer and per consumer rates.'''
+	import multiprocessing
+
+	sample = [(1655769600000 + pos * 10, 0xA00000 + pos % 4000, 3, b'SWA1234', 35000,
+			   450, b'1200') for pos in range(4096)]
+	ring = FeedRing(name, capacity)
+	results = multiprocessing.Queue()
+	procs = [multiprocessing.Process(target=_bench_consumer, args=(name, records, results))
+			 for num in range(consumers)]
+	try:
+		for proc in procs:
+			proc.start()
+		# Give the consumers a moment to attach before anything can wrap
+		time.sleep(0.5)
+		start = time.perf_counter()
+		published = 0
+		while published < records:
+			batch = sample[:min(len(sample), records - published)]
+			ring.publish(batch)
+			published += len(batch)
+		writer_seconds = time.perf_counter() - start
+		outcome = [results.get() for proc in procs]
+		for proc in procs:
+			proc.join()
+	finally:
+		ring.close()
+
+	return({
+		'records': records,
+		'writer_per_sec': records / writer_seconds,
+		'consumers': [{'per_sec': read / seconds if seconds else 0.0, 'read': read,
+					   'lost': lost} for seconds, read, lost, checksum in outcome],
+		})
+
+
+######## Entry #########
+if __name__ == "__main__":
+	arg_parser = argparse.ArgumentParser(description="Shared memory feed ring")
+	sub = arg_parser.add_subparsers(dest='command', required=True)
+	serve_cmd = sub.add_parser('serve', help="Fill the ring from the feed")
+	serve_cmd.add_argument('--host', default='localhost')
+	serve_cmd.add_argument('--port', type=int, default=30003)
+	serve_cmd.add_argument('--file', default=None, help="Read a recorded feed instead")
+	serve_cmd.add_argument('--name', default=DEFAULT_NAME)
+	serve_cmd.add_argument('--capacity', type=int, default=65536)
+	tail_cmd = sub.add_parser('tail', help="Print records as they come in")
+	tail_cmd.add_argument('--name', default=DEFAULT_NAME)
+	bench_cmd = sub.add_parser('bench', help="Multi-consumer throughput")
+	bench_cmd.add_argument('--consumers', type=int, default=4)
+	bench_cmd.add_argument('--records', type=int, default=1000000)
+	bench_cmd.add_argument('--capacity', type=int, default=65536)
+	args = arg_parser.parse_args()
+
+	if args.command == 'serve':
+		feed_ring = FeedRing(args.name, args.capacity)
+		try:
+			serve(feed_ring, args.host, args.port, args.file)
+			if args.file is not None:
+				# Keep the ring up so readers can still get at it
+				print("Loaded {} records, Ctrl-C to stop".format(feed_ring.sequence))
+				while True:
+					time.sleep(60)
+		except KeyboardInterrupt:
+			pass
+		finally:
+			feed_ring.close()
+
+	elif args.command == 'tail':
+		ring_cursor = RingCursor(args.name, start='oldest')
+		try:
+			while True:
+				ring_records, ring_lost = ring_cursor.read()
+				if ring_lost:
+					print("... missed {} records".format(ring_lost))
+				for ring_record in ring_records:
+					print(','.join(record_to_row(ring_record)))
+				if not ring_records:
+					time.sleep(0.1)
+		except KeyboardInterrupt:
+			pass
+		finally:
+			ring_cursor.close()
+
+	else:
+		fanout = bench_fanout(args.consumers, args.records, args.capacity)
+		print("writer {:>14,.0f} records/sec".format(fanout['writer_per_sec']))
+		for num, consumer in enumerate(fanout['consumers']):
+			print("reader {:<6}{:>14,.0f} records/sec  {} lost".format(
+				num, consumer['per_sec'], consumer['lost']))
+	sys.exit(0)
@@ -0,0 +1,338 @@
+################################################################################
+# Sketches.py
+# @author: Ryan Herrin
+#
+# Fixed size, approximate counters for the live feed. Exact sets of every hex
+# in every window keep growing the longer the Pi runs, these don't:
+#   - HyperLogLog      : unique aircraft in a window
+#   - CountMinSketch   : counts per callsign / airline, with the top few kept
+#   - RingBuffer       : fixed number of time buckets reused as time moves on
+#   - DecayingWindow   : ring of time buckets of the above, so windows can be
+#                        merged and older buckets can count for less
+################################################################################
+
+'''
+Memory per structure:
+------------------
+HyperLogLog(precision)     : 2^precision bytes (10 -> 1 KB, about 3% error)
+CountMinSketch(width, depth): width * depth * 4 bytes (256 x 4 -> 4 KB)
+
+Accuracy against exact counts from the processed CSVs:
+python Sketches.py <processed dir> [--precisions 6 8 10 12] [--widths 32 64 256]
+'''
+
+import os
+import csv
+import sys
+import math
+import array
+import hashlib
+import argparse
+
+
+def hash64(value):
+	'''Stable 64 bit hash of a string. Python's hash() changes per process, so
+	it can't be used for sketches that get merged or compared between runs.'''
+	return(int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'little'))
+
+
+class HyperLogLog:
+	'''Estimates how many distinct values were added using 2^precision one
+	byte registers. Standard error is about 1.04 / sqrt(2^precision).'''
+	def __init__(self, precision=10):
+		if not 4 <= precision <= 16:
+			raise ValueError("HyperLogLog precision must be between 4 and 16")
+		self.precision = precision
+		self.n_registers = 1 << precision
+		self.registers = bytearray(self.n_registers)
+		if self.n_registers >= 128:
+			self.alpha = 0.7213 / (1 + 1.079 / self.n_registers)
+		else:
+			self.alpha = {16: 0.673, 32: 0.697, 64: 0.709}[self.n_registers]
+
+	def add(self, value):
+		hashed = hash64(value)
+		register = hashed & (self.n_registers - 1)
+		rest = hashed >> self.precision
+		# Position of the first 1 bit in what is left of the hash
+		rank = (64 - self.precision) - rest.bit_length() + 1
+		if rank > self.registers[register]:
+			self.registers[register] = rank
+
+	def merge(self, other):
+		'''Fold another HyperLogLog of the same precision into this one'''
+		if other.precision != self.precision:
+			raise ValueError("Can only merge HyperLogLogs with the same precision")
+		self.registers = bytearray(max(mine, theirs) for mine, theirs in
+								   zip(self.registers, other.registers))
+
+	def estimate(self):
+		total = 0.0
+		zeros = 0
+		for register in self.registers:
+			total += 2.0 ** -register
+			if register == 0:
+				zeros += 1
+		raw = self.alpha * self.n_registers * self.n_registers / total
+		# Small counts are better estimated by linear counting
+		if raw <= 2.5 * self.n_registers and zeros:
+			return(self.n_registers * math.log(self.n_registers / zeros))
+		return(raw)
+
+	def memory_bytes(self):
+		return(len(self.registers))
+
+
+class CountMinSketch:
+	'''Counts per key in width * depth counters. Estimates are never lower than
+	the true count and are too high by at most about total / width. The top_k
+	keys with the highest estimates are tracked as they're added.'''
+	def __init__(self, width=256, depth=4, top_k=20):
+		self.width = width
+		self.depth = depth
+		self.top_k = top_k
+		self.rows = [array.array('i', [0]) * width for x in range(depth)]
+		self.total = 0
+		self.top = dict() # key -> estimate, at most top_k of them
+
+	def _columns(self, key):
+		# Two halves of one hash give every row its own column
+		# (Kirsch-Mitzenmacher)
+		hashed = hash64(key)
+		first = hashed & 0xFFFFFFFF
+		second = hashed >> 32
+		return([(first + row * second) % self.width for row in range(self.depth)])
+
+	def add(self, key, amount=1):
+		'''Add to a key's count. A negative amount takes back an earlier add.'''
+		estimate = None
+		for row, column in zip(self.rows, self._columns(key)):
+			row[column] += amount
+			if estimate is None or row[column] < estimate:
+				estimate = row[column]
+		self.total += amount
+		self._track(key, estimate)
+
+	def _track(self, key, estimate):
+		if key in self.top or len(self.top) < self.top_k:
+			self.top[key] = estimate
+			return
+		lowest = min(self.top, key=self.top.get)
+		if estimate > self.top[lowest]:
+			del self.top[lowest]
+			self.top[key] = estimate
+
+	def estimate(self, key):
+		return(min(row[column] for row, column in zip(self.rows, self._columns(key))))
+
+	def merge(self, other, weight=1.0):
+		'''Add another sketch of the same size into this one, optionally
+		scaled down (used for decaying windows)'''
+		if (other.width, other.depth) != (self.width, self.depth):
+			raise ValueError("Can only merge CountMinSketches of the same size")
+		for row, other_row in zip(self.rows, other.rows):
+			for column in range(self.width):
+				row[column] += int(round(other_row[column] * weight))
+		self.total += int(round(other.total * weight))
+		for key in other.top:
+			self._track(key, self.estimate(key))
+
+	def most_common(self, n=None):
+		'''[(key, estimate)] for the tracked top keys, highest first'''
+		found = sorted(((key, self.estimate(key)) for key in self.top),
+					   key=lambda item: (-item[1], item[0]))
+		return(found if n is None else found[:n])
+
+	def memory_bytes(self):
+		return(self.width * self.depth * self.rows[0].itemsize)
+
+
+class SketchBucket:
+	'''Everything kept for one time bucket of the live feed'''
+	def __init__(self, precision=10, width=256, depth=4, top_k=20):
+		self.aircraft = HyperLogLog(precision)
+		self.airlines = CountMinSketch(width, depth, top_k)
+		self.by_altitude = dict() # A handful of bands, so exact is fine
+
+	def summary(self, n_airlines=None):
+		return({'aircraft': int(round(self.aircraft.estimate())),
+				'by_airline': dict(self.airlines.most_common(n_airlines)),
+				'by_altitude': dict(self.by_altitude)})
+
+	def memory_bytes(self):
+		return(self.aircraft.memory_bytes() + self.airlines.memory_bytes())
+
+
+class RingBuffer:
+	'''Fixed number of time buckets that get reused as time moves on, so memory
+	doesn't grow however long the feed runs. new_bucket makes an empty bucket
+	(an exact dictionary by default, or a SketchBucket).'''
+	def __init__(self, bucket_seconds, n_buckets, new_bucket=dict):
+		self.bucket_seconds = bucket_seconds
+		self.n_buckets = n_buckets
+		self.new_bucket = new_bucket
+		self.bucket_ids = [None] * n_buckets
+		self.buckets = [new_bucket() for x in range(n_buckets)]
+		self.newest_id = None
+
+	def bucket_for(self, timestamp):
+		'''Bucket for a timestamp (seconds), cleared first if it last held an
+		older window. Returns None if the timestamp is too old to keep.'''
+		bucket_id = int(timestamp // self.bucket_seconds)
+		if self.newest_id is not None and bucket_id <= self.newest_id - self.n_buckets:
+			return(None)
+		if self.newest_id is None or bucket_id > self.newest_id:
+			self.newest_id = bucket_id
+
+		slot = bucket_id % self.n_buckets
+		if self.bucket_ids[slot] != bucket_id:
+			self.bucket_ids[slot] = bucket_id
+			self.buckets[slot] = self.new_bucket()
+		return(self.buckets[slot])
+
+	def bucket_id(self, timestamp):
+		return(int(timestamp // self.bucket_seconds))
+
+	def windows(self):
+		'''(bucket start, bucket) for every bucket still in range, oldest first'''
+		if self.newest_id is None:
+			return([])
+		found = []
+		for bucket_id in range(self.newest_id - self.n_buckets + 1, self.newest_id + 1):
+			slot = bucket_id % self.n_buckets
+			if self.bucket_ids[slot] == bucket_id:
+				found.append((bucket_id * self.bucket_seconds, self.buckets[slot]))
+		return(found)
+
+
+class DecayingWindow(RingBuffer):
+	'''RingBuffer of SketchBuckets. Windows are answered by merging the
+	buckets in them, and with a half_life (seconds) older buckets count for
+	less in the airline counts.'''
+	def __init__(self, bucket_seconds, n_buckets, half_life=None, **sketch_args):
+		self.half_life = half_life
+		self.sketch_args = sketch_args
+		RingBuffer.__init__(self, bucket_seconds, n_buckets,
+							lambda: SketchBucket(**sketch_args))
+
+	def merged(self, last_n=None):
+		'''One SketchBucket for the newest last_n buckets (all by default).
+		Airline counts are decayed by bucket age if there is a half life.'''
+		combined = SketchBucket(**self.sketch_args)
+		windows = self.windows()
+		if last_n is not None:
+			windows = windows[-last_n:]
+		for start, bucket in windows:
+			weight = 1.0
+			if self.half_life:
+				age = (self.newest_id * self.bucket_seconds) - start
+				weight = 0.5 ** (age / float(self.half_life))
+			combined.aircraft.merge(bucket.aircraft)
+			combined.airlines.merge(bucket.airlines, weight)
+			for band, count in bucket.by_altitude.items():
+				combined.by_altitude[band] = combined.by_altitude.get(band, 0) + count
+		return(combined)
+
+	def memory_bytes(self):
+		return(sum(bucket.memory_bytes() for bucket in self.buckets))
+
+
+############ Accuracy vs memory ###########
+def _read_processed(processed_dir):
+	'''{day: (set of hex, {airline: rows})} from the processed CSVs'''
+	days = dict()
+	for file_name in sorted(os.listdir(processed_dir)):
+		if not file_name.endswith('.csv'):
+			continue
+		with open(os.path.join(processed_dir, file_name), newline='') as csvfile:
+			for row in csv.reader(csvfile, delimiter=','):
+				if not row or row[0] == 'HexCode':
+					continue
+				hexes, airlines = days.setdefault(row[1], (set(), dict()))
+				hexes.add(row[0])
+				airlines[row[7]] = airlines.get(row[7], 0) + 1
+	return(days)
+
+
+def _exact_set_bytes(values):
+	'''Roughly what an exact set of these strings takes in memory'''
+	return(sys.getsizeof(set(values)) + sum(sys.getsizeof(value) for value in values))
+
+
+def accuracy_benchmark(processed_dir, precisions=(6, 8, 10, 12), widths=(32, 64, 256),
+					   depth=4, top_n=10):
+	'''Compare the sketches with exact counts for every day of processed data.
+	Returns {'hll': [...], 'cms': [...], 'exact_bytes': n}'''
+	days = _read_processed(processed_dir)
+	all_hexes = set()
+	for hexes, airlines in days.values():
+		all_hexes.update(hexes)
+
+	hll_results = []
+	for precision in precisions:
+		errors = []
+		for day, (hexes, airlines) in days.items():
+			sketch = HyperLogLog(precision)
+			for hex_code in hexes:
+				sketch.add(hex_code)
+			errors.append(abs(sketch.estimate() - len(hexes)) / float(len(hexes)))
+		hll_results.append({'precision': precision,
+							'bytes': HyperLogLog(precision).memory_bytes(),
+							'mean_error': sum(errors) / len(errors),
+							'max_error': max(errors)})
+
+	cms_results = []
+	for width in widths:
+		errors = []
+		recall = []
+		for day, (hexes, airlines) in days.items():
+			sketch = CountMinSketch(width, depth, top_k=top_n * 2)
+			for airline, count in airlines.items():
+				for x in range(count):
+					sketch.add(airline)
+			exact_top = sorted(airlines, key=lambda key: (-airlines[key], key))[:top_n]
+			for airline in exact_top:
+				errors.append((sketch.estimate(airline) - airlines[airline]) /
+							  float(airlines[airline]))
+			found_top = set(key for key, count in sketch.most_common(top_n))
+			recall.append(len(found_top & set(exact_top)) / float(len(exact_top)))
+		cms_results.append({'width': width, 'depth': depth,
+							'bytes': CountMinSketch(width, depth).memory_bytes(),
+							'mean_error': sum(errors) / len(errors),
+							'max_error': max(errors),
+							'top_recall': sum(recall) / len(recall)})
+
+	return({'days': len(days), 'hll': hll_results, 'cms': cms_results,
+			'exact_bytes': _exact_set_bytes(all_hexes),
+			'unique_aircraft': len(all_hexes)})
+
+
+def print_accuracy(results):
+	print("{} days, {} unique aircraft, exact hex set ~{:.1f} KB".format(
+		results['days'], results['unique_aircraft'], results['exact_bytes'] / 1024.0))
+	print("\nHyperLogLog (unique aircraft per day)")
+	print("{:>10}{:>10}{:>14}{:>14}".format("precision", "bytes", "mean err %", "max err %"))
+	for result in results['hll']:
+		print("{:>10}{:>10}{:>14.2f}{:>14.2f}".format(
+			result['precision'], result['bytes'], result['mean_error'] * 100,
+			result['max_error'] * 100))
+	print("\nCount-Min (top airlines per day)")
+	print("{:>10}{:>10}{:>14}{:>14}{:>12}".format("width", "bytes", "mean err %",
+												  "max err %", "top recall"))
+	for result in results['cms']:
+		print("{:>10}{:>10}{:>14.2f}{:>14.2f}{:>12.2f}".format(
+			result['width'], result['bytes'], result['mean_error'] * 100,
+			result['max_error'] * 100, result['top_recall']))
+
+
+######## Entry #########
+if __name__ == "__main__":
+	arg_parser = argparse.ArgumentParser(description="Sketch accuracy vs memory")
+	arg_parser.add_argument('processed_dir')
+	arg_parser.add_argument('--precisions', type=int, nargs='+', default=[6, 8, 10, 12])
+	arg_parser.add_argument('--widths', type=int, nargs='+', default=[32, 64, 256])
+	arg_parser.add_argument('--depth', type=int, default=4)
+	args = arg_parser.parse_args()
+
+	print_accuracy(accuracy_benchmark(args.processed_dir, args.precisions, args.widths,
+									  args.depth))
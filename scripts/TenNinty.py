@@ -23,19 +23,57 @@ import os
 import csv
 import shutil
 import datetime
+from operator import itemgetter
+import RawIndex
+import RawArchive
+import Partitions
+from FlightFrame import FlightFrame, StringColumn, PARSED_COLUMNS
+from Metrics import Metrics
+from CallsignResolver import get_resolver
+from CallsignCatalog import CallsignCatalog
+from HexRegistry import HexRegistry
 
 
 class TenNinty_Parser:
 	'''Class that takes in data generated from a dump1090 aplication and modifies
 	it and returns a custom csv file'''
-	def __init__(self, csv_dump_loc):
+	def __init__(self, csv_dump_loc, load_raw=True, raw_rows=None, metrics=None,
+				 catalog=None, registry=None):
 		self.focused_columns = [4, 6, 7, 10, 11, 12, 17]
 		self.csv_dump_loc = csv_dump_loc
-		self.TenNinty_Raw = self._read_dumpfile()
-		self.dump_data = []
+		# Stage timers and counters (read, parse, merge, callsign, write)
+		self.metrics = metrics if metrics is not None else Metrics('parser')
+		# CallsignCatalog to update when the processed CSV is written
+		self.catalog = catalog
+		# HexRegistry used to fill in missing flight numbers / squawks
+		self.registry = registry
+		if raw_rows is not None:
+			# Rows that were already decoded, e.g. from ModeS_Decoder
+			self.TenNinty_Raw = list(raw_rows)
+		elif load_raw:
+			self.TenNinty_Raw = self._read_dumpfile()
+		else:
+			# The chunked parser reads the file itself, so skip loading it here
+			self.TenNinty_Raw = None
+		# Parsed rows, one column per field (see FlightFrame)
+		self.frame = FlightFrame()
+		self.use_header = False
 		self.unique_hex = [] # Keep a track of unique hex values for appending new data
+		# Processed file each row is upserted into (the file its flight started
+		# in, see HexRegistry.session_for), None for all in this one
+		self.row_files = None
+		self._sessions = None
 		self.parsed_file_name = self._get_file_name()
 
+	@property
+	def dump_data(self):
+		''' The parsed data as a list of rows (with the header first if it was
+		added). Built from the frame each time it is asked for. '''
+		rows = self.frame.rows()
+		if self.use_header:
+			rows.insert(0, self.frame.header())
+		return(rows)
+
 	def _logger(self, x):
 		''' Logger function for custom output '''
 		out_x = str(x)
@@ -43,20 +81,28 @@ class TenNinty_Parser:
 		
 	def _get_file_name(self):
 		file_name = self.csv_dump_loc.split("/")[-1]
+		if file_name.endswith(RawArchive.ARCHIVE_EXT):
+			file_name = file_name[:-len(RawArchive.ARCHIVE_EXT)]
 		file_name = file_name.split('_')
 		# 2, 3, 4, 5
 		return(file_name[2]+'_'+file_name[3]+'_'+file_name[4]+'_'+file_name[5]) 
 
-	def get_parsed_data(self, path_to_write, use_header=False, to_csv=False):
-		''' Return parsed data. '''
-		self.parse_file()
+	def get_parsed_data(self, path_to_write, use_header=False, to_csv=False,
+						workers=None, partitioned=False):
+		''' Return parsed data. If workers is set the raw file is parsed in 
+		chunks across that many processes. With partitioned the CSV is split
+		into year=/month=/day=/hour= directories under path_to_write. '''
+		if workers:
+			self.parse_file_chunked(workers)
+		else:
+			self.parse_file()
 
 		if use_header:
 			self._add_header()
 
 		# Write to CSV is to_csv is True 
 		if to_csv:
-			self.write_to_csv(path_to_write)
+			self.write_to_csv(path_to_write, partitioned)
 
 		return(self.dump_data)
 
@@ -71,9 +117,30 @@ class TenNinty_Parser:
 
 	def _read_dumpfile(self):
 		''' Read in the 1090 dump file and return a parsed csv file with unique values '''
+		with self.metrics.stage('read'):
+			tmp_arry = self._read_dumpfile_rows()
+		if tmp_arry is not None:
+			self.metrics.count('lines', len(tmp_arry))
+		return(tmp_arry)
+
+	def _read_dumpfile_rows(self):
+		''' Does the reading for _read_dumpfile '''
 		# Array to hold the raw data 
 		tmp_arry = []
 		try:
+			# Compressed archives are read through the archive reader
+			if RawArchive.is_archive(self.csv_dump_loc):
+				arc_reader = RawArchive.RawArchiveReader(self.csv_dump_loc)
+				for row in arc_reader.iter_rows():
+					if "=~" in row[0]:
+						self.metrics.count('skipped_lines')
+					elif row[4] == '000000':
+						self.metrics.count('skipped_lines')
+					else:
+						tmp_arry.append(row)
+
+				return(tmp_arry)
+
 			with open(self.csv_dump_loc, newline='') as csvfile:
 				# CSV reader that seperated by commas
 				TenNinty_Reader = csv.reader(csvfile, delimiter=',')
@@ -81,9 +148,9 @@ class TenNinty_Parser:
 				for row in TenNinty_Reader:
 					# If the header or putty log info is included and needs to skip
 					if "=~" in row[0]:
-						pass
+						self.metrics.count('skipped_lines')
 					elif row[4] == '000000':
-						pass
+						self.metrics.count('skipped_lines')
 					else:
 						tmp_arry.append(row)
 
@@ -99,56 +166,68 @@ class TenNinty_Parser:
 		'''Add a column to the data that identifies the aircrafts callsign if it has
 		one. Some aircraft Have an 'N' number that signifies it's a private aircraft. 
 		Others start with at least two letters and then numbers. That's the callsign 
-		and the flight number'''
-		# index 3 in dump_data is where the Flight Number is 
-		for flight in range(len(self.dump_data)):
-			flight_num = str(self.dump_data[flight][3])
-			
-			# Create a way to seperate the Callsign from the number if it is not "N"
-			# or empty 
-			callsign_isalpha_len = 0
-			callsign = ''
-			if len(flight_num) > 1:
-			
-				for letter in flight_num:
-					if letter.isalpha():
-						callsign_isalpha_len +=1
-						callsign = callsign + letter
-						
-					else:
-						break
-			
-			# If it's an empty string then go ahead and say it's unknown
-			if flight_num == '' or flight_num == 'NA':
-				self.dump_data[flight].append('NA')
-			# If the first 3 are letters, it's commercial and the Callsign is added
-			elif callsign_isalpha_len > 1:
-				self.dump_data[flight].append(callsign)
-			# If the first 2 are letters, it's rare and should be addressed, but is added
-			#elif flight_num[:2].isalpha():
-				#self.dump_data[flight].append(flight_num[:2])
-			# If the first char is "N", then it's 99% a private aircraft
-			elif flight_num[0] == "N":
-				self.dump_data[flight].append("Private")
-			else:
-				# If all else incase to keep the 8 row integrity
-				self.dump_data[flight].append('NA')
+		and the flight number. The rules live in CallsignResolver, which only works 
+		out each distinct flight number once.'''
+		resolver = get_resolver()
+		# Only runs once per distinct flight number
+		self.frame['Airline'] = self.frame['FlightNumber'].map(
+			lambda flight: resolver.airline_code(str(flight)))
+
+	def _use_registry(self, hex_state):
+		'''Fill in missing flight numbers and squawks from what the registry 
+		already knows about each hex, then update it with this snapshot. Each
+		row is matched to its flight (session), which runs up to the last time
+		the hex was heard in this snapshot.'''
+		if self.registry is None:
+			return
+
+		with self.metrics.stage('registry'):
+			# The registry works on rows, so make them and turn any filled in
+			# values back into columns
+			rows = self.frame.rows()
+			file_name = self.parsed_file_name + '_log.csv'
+			last_seen = [self._format_date(state[2][0]) + ' ' + self._format_time(state[2][1])
+						 for state in hex_state.values()]
+			self._sessions = [
+				self.registry.session_for(flight[0], flight[1] + ' ' + flight[2], last, file_name)
+				for flight, last in zip(rows, last_seen)]
+			# Only fill from the same flight, then record what this one saw
+			backfilled = 0
+			for flight, (key, row_file, new_session) in zip(rows, self._sessions):
+				if self.registry.backfill(flight, key):
+					backfilled += 1
+				self.registry.record(flight, new_session, key)
+			self.registry.flush()
+			if backfilled:
+				self.frame = FlightFrame.from_rows(rows)
+		self.metrics.count('backfilled', backfilled)
+
+	def _add_flight_keys(self):
+		'''Add the FlightKey column. Without a registry a flight is only known
+		from this snapshot, so its key starts at the first message in it.'''
+		if self._sessions is None:
+			# Same as flight_key, with the date and time done once per distinct value
+			dates = self.frame['Date'].map(lambda date: '_' + date.replace('-', '')).tolist()
+			times = self.frame['Time'].map(lambda time: time.replace(':', '')).tolist()
+			keys = list(map(''.join, zip(self.frame['HexCode'].tolist(), dates, times)))
+			self.row_files = None
+		else:
+			keys = [key for key, row_file, new_session in self._sessions]
+			self.row_files = [row_file for key, row_file, new_session in self._sessions]
+		self.frame['FlightKey'] = StringColumn.from_values(keys)
 
 	def get_closest_hour(self):
 		'''Get the time and find the nearest hour. This is to provide a values to match
 		up with the weather data which only calculates weather every hour.
 		The [8] index will be the placeholder for the closest hour'''
-		for flight in range(len(self.dump_data)):
-			self.dump_data[flight].append(
- 				str(self.dump_data[flight][2].split(":")[0]) + ":00:00"
- 				)
+		self.frame['NearestHour'] = self.frame['Time'].map(
+			lambda time: str(time.split(":")[0]) + ":00:00")
 			
 		return(0)
 			
 	def _add_header(self):
 		'''Add header to beginning of array'''
-		return(self.dump_data.insert(0, ['HexCode', 'Date', 'Time', 'FlightNumber', 
-			'Alt', 'GroundSpeed', 'Squawk', 'Airline', 'NearestHour']))
+		self.use_header = True
     
 	def _format_date(self, date):
 		"""Format date to conform with MySQL standards"""
@@ -168,59 +247,139 @@ class TenNinty_Parser:
 	
 	def parse_file(self):
 		''' Parse the data that was read in. '''
-		for row in self.TenNinty_Raw:
-			# Check every row for the unique Hex
-			# If the Hex isn't in the dump_data array then add it 
-			if row[4] not in self.unique_hex:
-					self.dump_data.append([
-                        row[4],     	            # [0] HexCode
-                        self._format_date(row[6]),  # [1] Data
-                        self._format_time(row[7]),  # [2] Time
-                        self._not_null(row[10]),    # [3] Flight / #
-                        row[11],                    # [4] Altitude
-                        row[12],                    # [5] Ground Speed
-                        row[17]                     # [6] Squawk
-                        ])
-					self.unique_hex.append(row[4])
-			# Else, if it is, then check if any of the values are updated or
-			# Contain data thats missing 
+		if self.TenNinty_Raw is None:
+			self.TenNinty_Raw = self._read_dumpfile()
+
+		with self.metrics.stage('parse'):
+			# One entry per unique hex: the first row for it, with any empty
+			# field filled by the first later row that has it
+			hex_state = _partial_hex_state(self.TenNinty_Raw)
+
+		self._apply_hex_state(hex_state)
+
+	def parse_file_chunked(self, workers=None, chunks=None):
+		''' Same result as parse_file, but the raw file is split into byte ranges
+		on line boundaries and each range is parsed in a worker process. The
+		partial states are merged back in file (timestamp) order. '''
+		if workers is None:
+			workers = os.cpu_count() or 1
+		if chunks is None:
+			chunks = workers * 4
+
+		if RawArchive.is_archive(self.csv_dump_loc):
+			# Archives are already split up, so each block is a job
+			arc_reader = RawArchive.RawArchiveReader(self.csv_dump_loc)
+			jobs = [(self.csv_dump_loc, block_num, None) for block_num in
+					range(len(arc_reader.index))]
+		else:
+			jobs = [(self.csv_dump_loc, start, end) for start, end in 
+					_split_on_lines(self.csv_dump_loc, chunks)]
+
+		hex_state = {}
+		with self.metrics.stage('parse'):
+			if workers == 1 or len(jobs) < 2:
+				for job in jobs:
+					part_state = _parse_byte_range(job)
+					with self.metrics.stage('merge'):
+						hex_state = _merge_hex_states(hex_state, part_state)
 			else:
-				data_index = int()
-				# Find index of Hex value that represents each aircraft 
-				for pos in range(len(self.dump_data)):
-					if row[4] == self.dump_data[pos][0]:
-						data_index = pos
-						
-				# Update/or ignore the index entry with new information
-				for val in row:
-					if row[6] != '' and self.dump_data[data_index][1] == '':
-						self.dump_data[data_index][1] = row[6]
-					if row[7] != '' and self.dump_data[data_index][2] == '':
-						self.dump_data[data_index][2] = row[7]
-					if row[10] != '' and self.dump_data[data_index][3] == 'NA':
-						self.dump_data[data_index][3] = str(row[10]).strip()
-					if row[11] != '' and self.dump_data[data_index][4] == '':
-						self.dump_data[data_index][4] = row[11]
-					if row[12] != '' and self.dump_data[data_index][5] == '':
-						self.dump_data[data_index][5] = row[12]
-					if row[17] != '' and self.dump_data[data_index][6] == '':
-						self.dump_data[data_index][6] = row[17]
-
+				# Only the chunked path needs multiprocessing, so keep it out of
+				# the import for the cron jobs
+				import multiprocessing
+				with multiprocessing.Pool(workers) as pool:
+					# imap keeps the results in the same order as the jobs
+					for part_state in pool.imap(_parse_byte_range, jobs):
+						with self.metrics.stage('merge'):
+							hex_state = _merge_hex_states(hex_state, part_state)
+
+		self._apply_hex_state(hex_state)
+
+	def _apply_hex_state(self, hex_state):
+		''' Turn a merged per-hex state into the frame. The first row of each
+		hex is formatted (as a column, once per distinct value), then any empty
+		field is filled with the first non-empty raw value that came after it. '''
+		self.unique_hex = list(hex_state)
+		heads = [state[0] for state in hex_state.values()]
+		all_fills = [state[1] for state in hex_state.values()]
+		with self.metrics.stage('format'):
+			self.frame = FlightFrame({'HexCode': StringColumn.from_values(self.unique_hex)})
+			for pos, name in enumerate(PARSED_COLUMNS[1:]):
+				values = list(map(itemgetter(pos), heads))
+				if pos >= 3:
+					# Alt, GroundSpeed and Squawk aren't formatted, so they can be
+					# filled before they are encoded
+					values = [head or fill for head, fill in
+							  zip(values, map(itemgetter(pos), all_fills))]
+				self.frame[name] = StringColumn.from_values(values)
+			self.frame['Date'] = self.frame['Date'].map(self._format_date)
+			self.frame['Time'] = self.frame['Time'].map(self._format_time)
+			self.frame['FlightNumber'] = self.frame['FlightNumber'].map(self._not_null)
+
+			# Fill whatever is still empty after formatting
+			for pos, name in enumerate(PARSED_COLUMNS[1:4]):
+				empty = 'NA' if name == 'FlightNumber' else ''
+				if empty not in self.frame[name]:
+					continue
+				fills = list(map(itemgetter(pos), all_fills))
+				if name == 'FlightNumber':
+					fills = StringColumn.from_values(fills).map(
+						lambda fill: str(fill).strip()).tolist()
+				self.frame[name] = self.frame[name].fill(empty, fills)
+
+		self.metrics.count('aircraft', len(self.frame))
+		self._use_registry(hex_state)
 		# Add the callsign row 
-		self._add_callsign()
+		with self.metrics.stage('callsign'):
+			self._add_callsign()
 		# Append the closest hour for easier joining with the weather data 
 		self.get_closest_hour()
-
-	def write_to_csv(self, write_path):
-		''' Writes self.dump to a CSV file that can be used to upload to a DB '''
-		# Define location to write CSV to
-		csv_write_loc = write_path + "{}_log.csv".format(self.parsed_file_name)
-		#print(csv_write_loc)
-
-		with open(csv_write_loc, 'w', newline='') as csv_out:
-			data_writer = csv.writer(csv_out, delimiter=',')
-			for row in self.dump_data:
-				data_writer.writerow(row)
+		self._add_flight_keys()
+
+	def write_to_csv(self, write_path, partitioned=False):
+		''' Upserts the rows into the processed CSV by FlightKey, so processing
+		a snapshot again only changes the rows that came out different. A
+		flight that started in an earlier snapshot is merged into that
+		snapshot's file instead. With partitioned the rows are split by hour
+		into the Partitions layout under write_path, one file per hour with
+		the same name. '''
+		file_name = "{}_log.csv".format(self.parsed_file_name)
+		header = self.frame.header()
+		key_col = header.index('FlightKey')
+
+		by_file = {file_name: []}
+		row_files = self.row_files or [file_name] * len(self.frame)
+		for row, row_file in zip(self.frame.iter_rows(), row_files):
+			by_file.setdefault(row_file, []).append(list(row))
+
+		# This snapshot's own file is made again from scratch, so anything in it
+		# that isn't a flight it holds (now in an earlier file, or written
+		# before there were sessions) is taken out. Other files only get rows
+		# merged in.
+		own_keep = None
+		if self.registry is not None:
+			own_keep = lambda key: self.registry.session_file(key) == file_name
+
+		changed = 0
+		with self.metrics.stage('write'):
+			for out_name, out_rows in by_file.items():
+				if partitioned:
+					file_rows, file_changed = Partitions.upsert_partitioned(
+						write_path, out_name, out_rows, header if self.use_header else None,
+						key_col, own_keep if out_name == file_name else None)
+				else:
+					file_rows, file_changed = Partitions.upsert_csv(
+						write_path + out_name, out_rows, header if self.use_header else None,
+						key_col, own_keep if out_name == file_name else None)
+				changed += file_changed
+
+				# Keep the callsign catalog in step with the processed files
+				if self.catalog is not None:
+					self.catalog.update_from_rows(out_name, file_rows)
+		self.metrics.count('rows', len(self.frame) + (1 if self.use_header else 0))
+		self.metrics.count('rows_changed', changed)
+
+		if self.catalog is not None:
+			self.catalog.save()
 				
 		
 class SnapShot:
@@ -228,28 +387,37 @@ class SnapShot:
 	file and write the data to a seperate file. Then clears the live feed file so 
 	it doesn't become overwhelmingly large. Seriously. Dis boy gets big real quick.
 	The plan is to have this run once an hour to keep the data size down. ''' 
-	def __init__(self, live_feed_loc, copyto_loc=''):
+	def __init__(self, live_feed_loc, copyto_loc='', archive=False):
 		# Location of the live feed file 
 		self.live_feed_loc = live_feed_loc
 		self.copyto_loc = copyto_loc
+		# Write the snapshot as a compressed RawArchive instead of a text copy
+		self.archive = archive
 		self.new_raw_path = ''
 		self.curr_time = datetime.datetime.now().strftime("%Y_%m_%d_%H%M%S")
 
 	def snap_dat_feed(self):
 		''' Capture the data currently in the file. Basically Copies it'''
 		try:
-			# Perform the copy
-			shutil.copyfile(self.live_feed_loc, self.copyto_loc)
-			
 			# Parse and get root dir of where to store the copied file. AKA: remove the last 
 			# part of the file path
 			raw_data_dir = ''
 			for path in self.copyto_loc.split('/')[:-1]:
 				raw_data_dir = raw_data_dir + path + '/'
 			
-			# Rename file to avoid name conflicts in the same dir 
+			# Name the file with the time to avoid name conflicts in the same dir 
 			self.new_raw_path = str(raw_data_dir + "live_raw_{}".format(self.curr_time))
-			os.rename(self.copyto_loc, self.new_raw_path)
+
+			if self.archive:
+				# Compress straight from the live feed into the archive
+				self.new_raw_path = RawArchive.archive_raw_file(
+					self.live_feed_loc, self.new_raw_path + RawArchive.ARCHIVE_EXT)
+			else:
+				# Perform the copy and rename it
+				shutil.copyfile(self.live_feed_loc, self.copyto_loc)
+				os.rename(self.copyto_loc, self.new_raw_path)
+				# Sidecar index for hex / time range queries
+				RawIndex.build_raw_index(self.new_raw_path)
 		
 			# If the write was complete then we can erase the contents of the live stream
 			try:
@@ -269,12 +437,19 @@ class SnapShot:
 	
 class Callsigns:
 	"""Class that reads in parsed data and returns a list of callsigns"""
+	# Callsign lists already read in, keyed by path and modified time
+	_callsign_cache = dict()
+
 	def __init__(self):
-		pass
+		self.resolver = get_resolver()
 	
 	def get_callsigns(self, csv_path):
-		call_signs = set()
 		try:
+			cache_key = (csv_path, os.path.getmtime(csv_path))
+			if cache_key in Callsigns._callsign_cache:
+				return(list(Callsigns._callsign_cache[cache_key]))
+
+			call_signs = set()
 			with open(csv_path, newline='') as csvfile:
 				callsign_reader = csv.reader(csvfile, delimiter=',')
 				for row in callsign_reader:
@@ -284,32 +459,157 @@ class Callsigns:
 
 				csvfile.close()
 			
+			Callsigns._callsign_cache[cache_key] = call_signs
 			return(list(call_signs))
 
 		except Exception as err:
 			print("Could not open CSV file: ")
 			print(str(err))
+
+	def get_catalog_callsigns(self, catalog_path):
+		"""Distinct callsigns from the callsign catalog, without reading any
+		of the processed data"""
+		return(CallsignCatalog(catalog_path).get_callsigns())
+
+	def get_top_callsigns(self, catalog_path, n):
+		"""The n most seen callsigns as (callsign, count)"""
+		return(CallsignCatalog(catalog_path).top(n))
+
+	def get_airline_names(self, callsigns):
+		"""Map airline codes to airline names. Codes that aren't a known airline
+		map to ''."""
+		return({cs: self.resolver.airline_name(cs) for cs in callsigns})
+
+	def get_category(self, flight_num):
+		"""Category of a flight number (airline, private, military...)"""
+		return(self.resolver.resolve(flight_num)[2])
 		
 	
+# Raw columns that parse_file fills in when they are empty: Date, Time, 
+# Flight / #, Altitude, Ground Speed, Squawk
+_FILL_COLUMNS = [6, 7, 10, 11, 12, 17]
+
+
+def _split_on_lines(file_path, chunks):
+	'''Split a file into (start, end) byte ranges that begin on a line start'''
+	file_size = os.path.getsize(file_path)
+	step = max(1, file_size // max(1, chunks))
+	offsets = [0]
+
+	with open(file_path, 'rb') as raw_file:
+		pos = step
+		while pos < file_size:
+			# Move to the start of the next line
+			raw_file.seek(pos - 1)
+			raw_file.readline()
+			pos = raw_file.tell()
+			if pos >= file_size:
+				break
+			if pos > offsets[-1]:
+				offsets.append(pos)
+			pos = pos + step
+
+	offsets.append(file_size)
+	return(list(zip(offsets[:-1], offsets[1:])))
+
+
+def _parse_byte_range(job):
+	'''Worker for parse_file_chunked. Reads one byte range of the raw file and
+	returns its partial per-hex state. For an archive start is the block 
+	number and end is None.'''
+	file_path, start, end = job
+	if end is None:
+		raw_bytes = RawArchive.RawArchiveReader(file_path).read_block(start)
+	else:
+		with open(file_path, 'rb') as raw_file:
+			raw_file.seek(start)
+			raw_bytes = raw_file.read(end - start)
+
+	rows = csv.reader(raw_bytes.decode('utf-8').splitlines(), delimiter=',')
+	return(_partial_hex_state(rows))
+
+
+def _partial_hex_state(rows):
+	'''Build the partial state for a run of raw rows. Each hex maps to 
+	[head, fills, last] where head holds the fill columns of the first row for
+	that hex, fills holds the first non-empty value of each column after it
+	and last is the [date, time] of its last row.'''
+	hex_state = {}
+	for row in rows:
+		# Same rows that _read_dumpfile skips
+		if "=~" in row[0] or row[4] == '000000':
+			continue
+
+		curr_state = hex_state.get(row[4])
+		if curr_state is None:
+			hex_state[row[4]] = [[row[col] for col in _FILL_COLUMNS], [''] * 6, row]
+		else:
+			fills = curr_state[1]
+			for pos, col in enumerate(_FILL_COLUMNS):
+				if fills[pos] == '' and row[col] != '':
+					fills[pos] = row[col]
+			curr_state[2] = row
+
+	# Only the time of the last row is kept
+	for curr_state in hex_state.values():
+		curr_state[2] = [curr_state[2][6], curr_state[2][7]]
+
+	return(hex_state)
+
+
+def _merge_hex_states(early, late):
+	'''Merge two partial states where early covers the rows before late. A hex
+	keeps its head from the earliest range and each empty fill takes the first
+	non-empty value from the later range (its head first, then its fills). 
+	This is associative, so ranges can be merged in any grouping as long as 
+	the order is kept.'''
+	for hex_code, (head, fills, last) in late.items():
+		curr_state = early.get(hex_code)
+		if curr_state is None:
+			early[hex_code] = [head, fills, last]
+			continue
+		curr_state[2] = last
+
+		early_fills = curr_state[1]
+		for pos in range(len(_FILL_COLUMNS)):
+			if early_fills[pos] == '':
+				early_fills[pos] = head[pos] if head[pos] != '' else fills[pos]
+
+	return(early)
+
+
 # Function to re-run all raw data in the adsb_raw_data dir and create new 
 # processed data. 
-def _bulk_update(target_dir):
+def _bulk_update(target_dir, metrics_dir=None):
 	'''This function is only meant to be run from command line. It will
 	reproccess the raw data and generate new CSV files. Used mainly when
 	the code to create the parsed CSV files is made. force_bulk_update 
-	must be set to TRUE.'''
-	# Get list of all files in the raw data directory 
-	raw_data_list = os.listdir(target_dir)
+	must be set to TRUE. If metrics_dir is set the timings for the whole
+	run are written there as JSON.'''
+	bulk_metrics = Metrics('bulk_update')
+	locations = global_locations()
+	bulk_catalog = CallsignCatalog(locations['catalog'])
+	# Flight keys come from the registry, and the files are gone through in
+	# time order so each flight's row goes in the snapshot it started in
+	bulk_registry = HexRegistry(locations['registry'])
 	
-	# Go through all the files in the directory 
-	for raw_file in raw_data_list:
-		if raw_file != ".init":
-			raw_file_path = target_dir + raw_file
-			
-			# Run the process on each file not names .init
-			TenNinty_Parser(raw_file_path).get_parsed_data(
-				global_csv_write_loc, use_header=True, to_csv=True
-				)
+	# Go through the snapshots in the directory, each one once even when it
+	# is there as text and as an archive
+	for raw_file_path in RawIndex.iter_raw_files(target_dir):
+		# Make sure older text snapshots get their query index too
+		if not RawArchive.is_archive(raw_file_path):
+			RawIndex.load_raw_index(raw_file_path)
+		
+		# Run the process on each snapshot
+		TenNinty_Parser(raw_file_path, metrics=bulk_metrics,
+						catalog=bulk_catalog, registry=bulk_registry).get_parsed_data(
+			locations['csv_write'], use_header=True, to_csv=True
+			)
+
+	bulk_registry.close()
+
+	if metrics_dir is not None:
+		bulk_metrics.write_json(metrics_dir)
 			
 	return(True)
 
@@ -324,81 +624,29 @@ production_mode = False
 force_bulk_update = True # To trigger the bulk update function. Can only be ran
 						 # if production mode is set to False.  
 
-# Define Global locations 
-global_csv_write_loc = '/projects/ADSB-Flight-Freq-Tracker/data/adsb_processed_data/'
-global_live_feed_loc = '/projects/ADSB-Flight-Freq-Tracker/data/30003_LiveFeed.csv'
-global_raw_copyto_loc = '/projects/ADSB-Flight-Freq-Tracker/data/adsb_raw_data/30003_LiveFeed.csv'
-
-# Determine full path based on if the system is Windows or running on the Linux(pi)
-if os.name == "nt":
-	# If Windows
-	win_prefix = "Z:"
-	global_csv_write_loc = win_prefix + global_csv_write_loc
-	global_live_feed_loc = win_prefix + global_live_feed_loc
-	global_raw_copyto_loc = win_prefix + global_raw_copyto_loc 
-	
-else:
-	# If Linux(Pi)
-	pi_prefix = "/home/pi/Documents"
-	global_csv_write_loc = pi_prefix + global_csv_write_loc
-	global_live_feed_loc = pi_prefix + global_live_feed_loc
-	global_raw_copyto_loc = pi_prefix + global_raw_copyto_loc 
-
-
-# if __name__ =="__main__":	
-# # 	if production_mode:
-# # 		# Create copy of the live feed data 
-# # 		snapshot = SnapShot(global_live_feed_loc, global_raw_copyto_loc)
-# # 		snapshot.snap_dat_feed()
-# # 	
-# # 		# Process the captured CSV data using the TenNinty_parser 
-# # 		process_data = TenNinty_Parser(snapshot.get_raw_path())
-# # 	
-# # 		# Write it out to a csv 
-# # 		process_data.get_parsed_data(global_csv_write_loc, use_header=True, to_csv=True)
-# # 	
-# 	if production_mode == False:
-# 		"""Only for debugging and developement"""
-# 	
-# # 		# Process the captured CSV data using the TenNinty_parser 
-# 		raw_data_path = 'Z:/projects/ADSB-Flight-Freq-Tracker/data/adsb_raw_data/'
-# # 		
-# # 		# Path for a single file 
-# # 		csv_path = ('Z:/Projects/ADSB-Flight-Freq-Tracker/data/adsb_raw_data' +
-# # 					'/live_raw_2022_06_21_000002')
-# # 		
-# # 		TenNinty_Parser(csv_path).get_parsed_data(global_csv_write_loc, 
-# # 													   use_header=True, to_csv=True)
-# 	    
-# 		# Manually reproduce the parsed data files from the raw data
-# 		if force_bulk_update:
-# 			_bulk_update(raw_data_path)
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+def global_locations():
+	'''Global locations for this machine (Windows share or the Pi). Worked out
+	when asked for instead of when the module is imported.'''
+	locations = {
+		'csv_write': '/projects/ADSB-Flight-Freq-Tracker/data/adsb_processed_data/',
+		'live_feed': '/projects/ADSB-Flight-Freq-Tracker/data/30003_LiveFeed.csv',
+		'raw_copyto': '/projects/ADSB-Flight-Freq-Tracker/data/adsb_raw_data/30003_LiveFeed.csv',
+		'metrics': '/projects/ADSB-Flight-Freq-Tracker/data/metrics/',
+		'catalog': '/projects/ADSB-Flight-Freq-Tracker/data/callsign_catalog.csv',
+		'registry': '/projects/ADSB-Flight-Freq-Tracker/data/hex_registry.db',
+		}
+
+	# Determine full path based on if the system is Windows or running on the Linux(pi)
+	if os.name == "nt":
+		# If Windows
+		prefix = "Z:"
+	else:
+		# If Linux(Pi)
+		prefix = "/home/pi/Documents"
+
+	return({name: prefix + loc for name, loc in locations.items()})
+
+
+# The snapshot -> process flow and the bulk update are run from Tracker.py:
+#   python Tracker.py run
+#   python Tracker.py process
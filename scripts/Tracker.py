@@ -0,0 +1,605 @@
+################################################################################
+# Tracker.py
+# @author: Ryan Herrin
+#
+# One entry point for the whole pipeline. Each step (ingest, snapshot,
+# process, weather, combine, load, bench) is a subcommand, and "run" runs the
+# production flow through a small scheduler that skips stages whose inputs
+# haven't changed and runs independent stages at the same time.
+################################################################################
+
+'''
+Usage:
+------------------
+python Tracker.py run                   # snapshot -> process + weather -> combine
+python Tracker.py run --load            # ... -> load into Astra too
+python Tracker.py snapshot [--archive]
+python Tracker.py process [--workers 4]
+python Tracker.py weather --station KFTW [--wunder-dir DIR]
+python Tracker.py combine [--start 2022-06-20 --end 2022-06-30]
+python Tracker.py combine --join nearest --tolerance 30
+python Tracker.py load --creds FILE --zip FILE --keyspace flights --table f_data
+python Tracker.py export --creds FILE --zip FILE [--splits 256 --workers 8]
+python Tracker.py ingest [--format beast --port 30005]
+python Tracker.py ingest --sources pi_n=tcp://10.0.0.21:30003 pi_s=tcp://10.0.0.22:30003
+python Tracker.py live [--replay FILE --speed 60]   # counters on :8090
+python Tracker.py bench [benchmark args...]
+python Tracker.py --partitioned run     # year=/month=/day=/hour= layout
+python Tracker.py --profile --trace-memory process   # .prof + peak memory in metrics
+
+The data directory defaults to $ADSB_DATA_DIR, or the same place the scripts
+have always used (Z: on Windows, /home/pi/Documents on the Pi). Stage state
+is kept in <data dir>/.pipeline_state.json.
+'''
+
+import os
+import sys
+import json
+import argparse
+import threading
+
+
+def default_data_dir():
+	"""Where the data lives unless told otherwise"""
+	if os.environ.get('ADSB_DATA_DIR'):
+		return(os.environ['ADSB_DATA_DIR'])
+	root = '/projects/ADSB-Flight-Freq-Tracker/data'
+	if os.name == "nt":
+		return("Z:" + root)
+	return("/home/pi/Documents" + root)
+
+
+class DataPaths:
+	"""All of the locations inside the data directory. With partitioned the
+	processed and combined data use the year=/month=/day=/hour= layout.
+	profile / trace_memory turn on cProfile / tracemalloc for every stage."""
+	def __init__(self, data_dir, partitioned=False, profile=False, trace_memory=False):
+		self.data_dir = data_dir
+		self.partitioned = partitioned
+		self.profile = profile
+		self.trace_memory = trace_memory
+		self.live_feed = os.path.join(data_dir, '30003_LiveFeed.csv')
+		self.raw_dir = os.path.join(data_dir, 'adsb_raw_data')
+		self.processed_dir = os.path.join(data_dir, 'adsb_processed_data')
+		self.weather_dir = os.path.join(data_dir, 'weather_data')
+		self.combined_dir = os.path.join(data_dir, 'combined_data')
+		self.metrics_dir = os.path.join(data_dir, 'metrics')
+		self.catalog = os.path.join(data_dir, 'callsign_catalog.csv')
+		self.registry = os.path.join(data_dir, 'hex_registry.db')
+		self.state_file = os.path.join(data_dir, '.pipeline_state.json')
+		self.query_cache = os.path.join(data_dir, 'query_cache.json')
+		self.load_ledger = os.path.join(data_dir, 'loaded_flights.db')
+
+	def new_metrics(self, run_name):
+		"""Metrics for one stage, capturing from here on if it was asked for"""
+		from Metrics import Metrics
+		metrics = Metrics(run_name, profile=self.profile, trace_memory=self.trace_memory)
+		metrics.start_capture()
+		return(metrics)
+
+	def raw_files(self):
+		"""Raw snapshots (text or archive, once each), without the index files"""
+		if not os.path.isdir(self.raw_dir):
+			return([])
+		from RawIndex import iter_raw_files
+		return([raw_path for raw_path in iter_raw_files(self.raw_dir)
+				if os.path.basename(raw_path).startswith('live_raw_')])
+
+	def files_in(self, dir_path, suffix=''):
+		if not os.path.isdir(dir_path):
+			return([])
+		import Partitions
+		if Partitions.is_partitioned(dir_path):
+			return(Partitions.list_files(dir_path, suffix=suffix))
+		return([os.path.join(dir_path, name) for name in sorted(os.listdir(dir_path))
+				if name.endswith(suffix)])
+
+
+############ Scheduler ###########
+class Stage:
+	"""One step of the pipeline. inputs is a function returning the files the
+	stage reads, so the scheduler can tell if anything changed since the last
+	successful run."""
+	def __init__(self, name, run, inputs=None, deps=()):
+		self.name = name
+		self.run = run
+		self.inputs = inputs if inputs is not None else (lambda: [])
+		self.deps = list(deps)
+
+
+def _signature(paths):
+	"""Name, size and modified time of every input file"""
+	sig = []
+	for path in paths:
+		try:
+			stat = os.stat(path)
+			sig.append([path, stat.st_size, stat.st_mtime_ns])
+		except OSError:
+			continue
+	return(sig)
+
+
+class Scheduler:
+	"""Runs a DAG of stages. A stage starts as soon as all of its deps are done,
+	so stages that don't depend on each other run at the same time. A stage is
+	skipped if its inputs match the last successful run, unless forced."""
+	def __init__(self, state_file, max_workers=4, force=False):
+		self.state_file = state_file
+		self.max_workers = max_workers
+		self.force = force
+		self.stages = dict()
+		self.state = dict()
+		self._state_lock = threading.Lock()
+		if os.path.exists(state_file):
+			with open(state_file, 'r') as json_in:
+				self.state = json.load(json_in)
+
+	def add(self, stage):
+		self.stages[stage.name] = stage
+
+	def _save_state(self):
+		with open(self.state_file, 'w') as json_out:
+			json.dump(self.state, json_out, indent=1)
+
+	def _run_stage(self, stage):
+		"""Run one stage if its inputs changed. Returns 'ran' or 'skipped'."""
+		# Inputs are checked when the stage starts, after its deps wrote them
+		sig = _signature(stage.inputs())
+		if not self.force and sig and self.state.get(stage.name) == sig:
+			print("[{}] inputs unchanged, skipping".format(stage.name))
+			return('skipped')
+
+		print("[{}] running".format(stage.name))
+		stage.run()
+		with self._state_lock:
+			# Keep the signature from before the run. Files written while it
+			# ran (by a stage running alongside, like process next to weather)
+			# weren't seen by it, so they have to count as changed next time.
+			# A stage's own writes only cost it one more run that finds
+			# nothing to do.
+			self.state[stage.name] = sig
+			self._save_state()
+		return('ran')
+
+	def run(self):
+		"""Run every stage. Returns {stage name: 'ran' | 'skipped' | 'failed'}"""
+		from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+		results = dict()
+		waiting = dict(self.stages)
+		running = dict()
+
+		with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+			while waiting or running:
+				# Start everything whose deps are done
+				for name in list(waiting):
+					stage = waiting[name]
+					if any(results.get(dep) == 'failed' for dep in stage.deps):
+						results[name] = 'failed'
+						print("[{}] not run, a stage it needs failed".format(name))
+						del waiting[name]
+					elif all(dep in results for dep in stage.deps):
+						running[pool.submit(self._run_stage, stage)] = name
+						del waiting[name]
+
+				if not running:
+					break
+
+				done, not_done = wait(list(running), return_when=FIRST_COMPLETED)
+				for future in done:
+					name = running.pop(future)
+					try:
+						results[name] = future.result()
+					except Exception as err:
+						print("[{}] failed: {}".format(name, err))
+						results[name] = 'failed'
+
+		return(results)
+
+
+############ Stages ###########
+def run_ingest(paths, fmt='sbs', host='localhost', port=None, sources=None):
+	"""Append the dump1090 network feed to the live feed file. With sources,
+	several receivers are merged into it with duplicates removed."""
+	import socket
+	if sources:
+		import MultiFeed
+		metrics = paths.new_metrics('ingest')
+		merger = MultiFeed.merge_feeds(
+			[MultiFeed.parse_source(spec, "rx{}".format(num)) for num, spec in
+			 enumerate(sources)], paths.live_feed, metrics=metrics)
+		metrics.write_json(paths.metrics_dir)
+		os.makedirs(paths.metrics_dir, exist_ok=True)
+		with open(os.path.join(paths.metrics_dir, 'multifeed_stats.json'), 'w') as json_out:
+			json.dump(merger.stats(), json_out, indent=2)
+		return
+
+	# Reading, parsing and writing each get a thread so a slow write to the
+	# SD card never holds up reading the socket
+	from IngestPipeline import IngestPipeline, sbs_line_parser, beast_parser
+	if fmt == 'beast':
+		from ModeS import ModeS_Decoder
+		parse_chunk = beast_parser(ModeS_Decoder())
+		port = port or 30005
+	else:
+		parse_chunk = sbs_line_parser()
+		port = port or 30003
+
+	with socket.create_connection((host, port)) as feed_sock:
+		metrics = IngestPipeline(lambda: feed_sock.recv(65536), parse_chunk,
+								 paths.live_feed, metrics=paths.new_metrics('ingest')).run()
+	metrics.write_json(paths.metrics_dir)
+
+
+def run_live(paths, host='localhost', port=30003, replay=None, speed=0.0,
+			 http_port=8090, approximate=False):
+	"""Capture the SBS feed to the live file while serving the live counters,
+	or replay a recorded file through the counters"""
+	import asyncio
+	import LiveFeed
+
+	counters = LiveFeed.LiveCounters(approximate=approximate)
+	if replay is not None:
+		asyncio.run(LiveFeed.run_live(counters, LiveFeed.replay_file(counters, replay, speed),
+									  http_port=http_port))
+		return
+
+	metrics = paths.new_metrics('live')
+	feed = LiveFeed.follow_sbs_socket(counters, host, port, paths.live_feed, metrics)
+	try:
+		asyncio.run(LiveFeed.run_live(counters, feed, http_port=http_port))
+	finally:
+		metrics.write_json(paths.metrics_dir)
+
+
+def run_snapshot(paths, archive=False):
+	"""Copy the live feed into the raw data directory and clear it"""
+	from TenNinty import SnapShot
+	if not os.path.exists(paths.live_feed) or os.path.getsize(paths.live_feed) == 0:
+		print("Live feed is empty, nothing to snapshot")
+		return(None)
+	os.makedirs(paths.raw_dir, exist_ok=True)
+	snapshot = SnapShot(paths.live_feed, os.path.join(paths.raw_dir, '30003_LiveFeed.csv'),
+						archive=archive)
+	snapshot.snap_dat_feed()
+	print("Snapshot written to {}".format(snapshot.get_raw_path()))
+	return(snapshot.get_raw_path())
+
+
+def run_process(paths, workers=None, use_registry=True):
+	"""Parse every raw file that doesn't have an up to date processed file"""
+	from TenNinty import TenNinty_Parser
+	from CallsignCatalog import CallsignCatalog
+
+	os.makedirs(paths.processed_dir, exist_ok=True)
+	metrics = paths.new_metrics('process')
+	catalog = CallsignCatalog(paths.catalog)
+	registry = None
+	if use_registry:
+		from HexRegistry import HexRegistry
+		registry = HexRegistry(paths.registry)
+
+	# Processing only rewrites the rows that changed, so a processed file can
+	# stay older than its raw file. What was processed is kept here instead.
+	processed_file = os.path.join(paths.data_dir, '.processed_files.json')
+	done = dict()
+	if os.path.exists(processed_file):
+		with open(processed_file, 'r') as json_in:
+			done = json.load(json_in)
+
+	processed = 0
+	try:
+		for raw_path in paths.raw_files():
+			parser = TenNinty_Parser(raw_path, load_raw=False, metrics=metrics,
+									 catalog=catalog, registry=registry)
+			out_name = parser.parsed_file_name + '_log.csv'
+			out_paths = [path for path in paths.files_in(paths.processed_dir, out_name)
+						 if os.path.basename(path) == out_name]
+			mtime = os.path.getmtime(raw_path)
+			if done.get(raw_path) == mtime or (out_paths and min(
+					os.path.getmtime(path) for path in out_paths) >= mtime):
+				continue
+			parser.get_parsed_data(paths.processed_dir + '/', use_header=True, to_csv=True,
+								   workers=workers, partitioned=paths.partitioned)
+			processed += 1
+			done[raw_path] = mtime
+			with open(processed_file, 'w') as json_out:
+				json.dump(done, json_out, indent=1)
+	finally:
+		if registry is not None:
+			registry.close()
+
+	metrics.write_json(paths.metrics_dir)
+	print("Processed {} raw file(s)".format(processed))
+
+
+def _flight_days(paths):
+	"""Days (YYYY-MM-DD) that have processed flight data"""
+	import Partitions
+	if Partitions.is_partitioned(paths.processed_dir):
+		return([day.replace('_', '-') for day in Partitions.active_days(paths.processed_dir)])
+	return(sorted(set(os.path.basename(path)[:10].replace('_', '-') for path in
+					  paths.files_in(paths.processed_dir, '.csv'))))
+
+
+def run_weather(paths, station='KFTW', wunder_dir=None, days=None):
+	"""Get the weather for every day with flights that doesn't have it yet"""
+	from Weather import Weather
+
+	os.makedirs(paths.weather_dir, exist_ok=True)
+	weather = Weather(metrics=paths.new_metrics('weather'))
+	weather_dir = paths.weather_dir + '/'
+
+	if wunder_dir is not None:
+		# Convert the wunderground CSVs (named YYYY-MM-DD.csv) instead
+		from Weather import wunderground_convert_dir
+		written = wunderground_convert_dir(wunder_dir, weather_dir, metrics=weather.metrics,
+										   skip_existing=True)
+		print("Converted {} wunderground file(s)".format(written))
+		weather.metrics.write_json(paths.metrics_dir)
+		return
+
+	for day in (days if days is not None else _flight_days(paths)):
+		if os.path.exists(os.path.join(weather_dir, day + '_Weather_log.csv')):
+			continue
+		daily_weather, raw_dict = weather.get_daily_weather(station, day)
+		if daily_weather:
+			weather.write_daily_to_csv(weather.convert_to_merica(daily_weather),
+									   weather_dir)
+
+	weather.metrics.write_json(paths.metrics_dir)
+
+
+def run_combine(paths, start=None, end=None, output_file=None, mode='hour',
+				tolerance_minutes=60):
+	"""Combine flights and weather for every day whose inputs are newer than
+	its combined file. mode / tolerance_minutes pick the weather join (see
+	CombineFltWthr.JOIN_MODES)."""
+	import CombineFltWthr
+
+	CombineFltWthr.combine_metrics = paths.new_metrics('combine')
+	os.makedirs(paths.combined_dir, exist_ok=True)
+	if output_file is not None:
+		CombineFltWthr.stream_combine(paths.processed_dir, paths.weather_dir,
+									  paths.combined_dir, CombineFltWthr.FULL_HEADER,
+									  start, end, output_file, mode=mode,
+									  tolerance_minutes=tolerance_minutes)
+		CombineFltWthr.combine_metrics.write_json(paths.metrics_dir)
+		return
+
+	import Partitions
+	flights_partitioned = Partitions.is_partitioned(paths.processed_dir)
+
+	for day in _flight_days(paths):
+		if start is not None and day < start.replace('_', '-'):
+			continue
+		if end is not None and day > end.replace('_', '-'):
+			continue
+		file_day = day.replace('-', '_')
+		out_name = file_day + '_full.csv'
+		out_paths = [path for path in paths.files_in(paths.combined_dir, out_name)
+					 if os.path.basename(path) == out_name]
+		if flights_partitioned:
+			inputs = Partitions.list_files(paths.processed_dir, day, day)
+		else:
+			inputs = [path for path in paths.files_in(paths.processed_dir, '.csv')
+					  if os.path.basename(path).startswith(file_day)]
+		inputs += [path for path in paths.files_in(paths.weather_dir, '.csv')
+				   if os.path.basename(path).startswith(day)]
+		if out_paths and all(min(os.path.getmtime(out) for out in out_paths) >=
+							 os.path.getmtime(path) for path in inputs):
+			continue
+		CombineFltWthr.stream_combine(paths.processed_dir, paths.weather_dir,
+									  paths.combined_dir, CombineFltWthr.FULL_HEADER,
+									  day, day, partitioned=paths.partitioned, mode=mode,
+									  tolerance_minutes=tolerance_minutes)
+
+	CombineFltWthr.combine_metrics.write_json(paths.metrics_dir)
+
+
+def run_load(paths, creds, zip_location, keyspace, table):
+	"""Load combined files that changed since the last load into Astra. Only
+	the flights in them that are new or changed are sent."""
+	from DStaxAstraControl import DataStaxAstra
+	from QueryCache import QueryCache
+	from FlightKeys import LoadLedger
+
+	loaded_file = os.path.join(paths.data_dir, '.loaded_files.json')
+	loaded = dict()
+	if os.path.exists(loaded_file):
+		with open(loaded_file, 'r') as json_in:
+			loaded = json.load(json_in)
+
+	# Loading bumps the table's version in the query cache Demo reads
+	db_conn = DataStaxAstra(metrics=paths.new_metrics('load'),
+							cache=QueryCache(paths.query_cache))
+	db_conn.set_secure_zip_location(zip_location)
+	db_conn.set_json_credintials(creds)
+	db_conn.set_keyspace(keyspace)
+	db_session = db_conn.create_session()
+	ledger = LoadLedger(paths.load_ledger)
+	try:
+		for csv_path in paths.files_in(paths.combined_dir, '.csv'):
+			mtime = os.path.getmtime(csv_path)
+			# Kept per table, so loading a new (migrated) table sends everything
+			loaded_key = db_conn._table_name(table) + ':' + csv_path
+			if loaded.get(loaded_key) == mtime:
+				continue
+			rows = db_conn.bulk_load_csv(db_session, table, csv_path, ledger=ledger)
+			print("Loaded {} rows from {}".format(rows, csv_path))
+			loaded[loaded_key] = mtime
+			with open(loaded_file, 'w') as json_out:
+				json.dump(loaded, json_out, indent=1)
+	finally:
+		ledger.close()
+		db_session.shutdown()
+	db_conn.metrics.write_json(paths.metrics_dir)
+
+
+def run_export(paths, creds, zip_location, keyspace, table, output_dir=None, splits=256,
+			   workers=8):
+	"""Export a table from Astra to CSVs by token range. Running it again
+	picks up the ranges that failed."""
+	from DStaxAstraControl import DataStaxAstra
+
+	output_dir = output_dir or os.path.join(paths.data_dir, 'export', table)
+	db_conn = DataStaxAstra(metrics=paths.new_metrics('export'))
+	db_conn.set_secure_zip_location(zip_location)
+	db_conn.set_json_credintials(creds)
+	db_conn.set_keyspace(keyspace)
+	db_session = db_conn.create_session()
+	try:
+		exported, failed = db_conn.export_table(db_session, table, output_dir, splits,
+												workers, partitioned=paths.partitioned)
+	finally:
+		db_session.shutdown()
+	db_conn.metrics.write_json(paths.metrics_dir)
+	return(1 if failed else 0)
+
+
+def run_pipeline(paths, args):
+	"""The production flow as a DAG: snapshot -> process, weather alongside
+	process, then combine, then (optionally) load"""
+	scheduler = Scheduler(paths.state_file, force=args.force)
+	scheduler.add(Stage('snapshot', lambda: run_snapshot(paths, args.archive),
+						inputs=lambda: [paths.live_feed]))
+	scheduler.add(Stage('process', lambda: run_process(paths, args.workers),
+						inputs=paths.raw_files, deps=['snapshot']))
+	# Weather only needs to know which days have flights, which it gets from
+	# the file names, so it runs alongside parsing
+	scheduler.add(Stage('weather', lambda: run_weather(paths, args.station, args.wunder_dir,
+													   days=args.days),
+						inputs=lambda: paths.files_in(paths.weather_dir, '.csv') +
+						paths.files_in(paths.processed_dir, '.csv'),
+						deps=[]))
+	scheduler.add(Stage('combine', lambda: run_combine(paths),
+						inputs=lambda: paths.files_in(paths.processed_dir, '.csv') +
+						paths.files_in(paths.weather_dir, '.csv'),
+						deps=['process', 'weather']))
+	if args.load:
+		scheduler.add(Stage('load', lambda: run_load(paths, args.creds, args.zip,
+													 args.keyspace, args.table),
+							inputs=lambda: paths.files_in(paths.combined_dir, '.csv'),
+							deps=['combine']))
+
+	results = scheduler.run()
+	print(", ".join("{}: {}".format(name, result) for name, result in results.items()))
+	return(0 if 'failed' not in results.values() else 1)
+
+
+def build_arg_parser():
+	arg_parser = argparse.ArgumentParser(description="ADSB Flight Frequency Tracker")
+	arg_parser.add_argument('--partitioned', action='store_true',
+							help="Write processed and combined data as year=/month=/day=/hour= partitions")
+	arg_parser.add_argument('--data-dir', default=None,
+							help="Data directory (default: $ADSB_DATA_DIR or the Pi path)")
+	arg_parser.add_argument('--profile', action='store_true',
+							help="cProfile each stage, saved as a .prof next to its metrics")
+	arg_parser.add_argument('--trace-memory', action='store_true',
+							help="Record each stage's peak memory with tracemalloc")
+	sub = arg_parser.add_subparsers(dest='command', required=True)
+
+	ingest = sub.add_parser('ingest', help="Capture the dump1090 feed to the live file")
+	ingest.add_argument('--format', choices=['sbs', 'beast'], default='sbs')
+	ingest.add_argument('--host', default='localhost')
+	ingest.add_argument('--port', type=int, default=None)
+	ingest.add_argument('--sources', nargs='+', default=None,
+						help="Merge several receivers (files or tcp://host:port)")
+
+	live = sub.add_parser('live', help="Capture the SBS feed and serve live counters")
+	live.add_argument('--host', default='localhost')
+	live.add_argument('--port', type=int, default=30003)
+	live.add_argument('--replay', default=None, help="Replay a raw file instead")
+	live.add_argument('--speed', type=float, default=0.0)
+	live.add_argument('--http-port', type=int, default=8090)
+	live.add_argument('--approximate', action='store_true',
+					  help="Fixed memory sketches instead of exact counts")
+
+	snapshot = sub.add_parser('snapshot', help="Snapshot and clear the live feed")
+	snapshot.add_argument('--archive', action='store_true')
+
+	process = sub.add_parser('process', help="Parse new raw snapshots")
+	process.add_argument('--workers', type=int, default=None)
+	process.add_argument('--no-registry', action='store_true')
+
+	weather = sub.add_parser('weather', help="Get weather for days with flights")
+	weather.add_argument('--station', default='KFTW')
+	weather.add_argument('--wunder-dir', default=None)
+	weather.add_argument('--days', nargs='*', default=None)
+
+	combine = sub.add_parser('combine', help="Combine flights and weather")
+	combine.add_argument('--start', default=None)
+	combine.add_argument('--end', default=None)
+	combine.add_argument('--output-file', default=None)
+	combine.add_argument('--join', choices=['hour', 'nearest', 'backward'], default='hour',
+						 help="Match weather on NearestHour or by timestamp")
+	combine.add_argument('--tolerance', type=int, default=60,
+						 help="Minutes a nearest / backward match can be off by")
+
+	for name, help_text in [('load', "Load combined data into Astra"),
+							('export', "Export a table from Astra by token range"),
+							('run', "Run the whole pipeline")]:
+		sub_parser = sub.add_parser(name, help=help_text)
+		sub_parser.add_argument('--creds', default=None)
+		sub_parser.add_argument('--zip', default=None)
+		sub_parser.add_argument('--keyspace', default='flights')
+		sub_parser.add_argument('--table', default='f_data')
+
+	export = sub.choices['export']
+	export.add_argument('--output', default=None,
+						help="Output directory (default: <data dir>/export/<table>)")
+	export.add_argument('--splits', type=int, default=256, help="Token ranges")
+	export.add_argument('--workers', type=int, default=8, help="Ranges read at once")
+
+	run = sub.choices['run']
+	run.add_argument('--archive', action='store_true')
+	run.add_argument('--workers', type=int, default=None)
+	run.add_argument('--station', default='KFTW')
+	run.add_argument('--wunder-dir', default=None)
+	run.add_argument('--days', nargs='*', default=None)
+	run.add_argument('--load', action='store_true')
+	run.add_argument('--force', action='store_true', help="Run stages even if unchanged")
+
+	sub.add_parser('bench', help="Run the benchmarks (extra args go to Benchmark.py)",
+				   add_help=False)
+	return(arg_parser)
+
+
+def main(argv=None):
+	argv = sys.argv[1:] if argv is None else argv
+	arg_parser = build_arg_parser()
+	args, extra = arg_parser.parse_known_args(argv)
+	if extra and args.command != 'bench':
+		arg_parser.error("unrecognized arguments: {}".format(' '.join(extra)))
+	paths = DataPaths(args.data_dir or default_data_dir(), args.partitioned, args.profile,
+					  args.trace_memory)
+
+	if args.command == 'ingest':
+		run_ingest(paths, args.format, args.host, args.port, args.sources)
+	elif args.command == 'live':
+		run_live(paths, args.host, args.port, args.replay, args.speed, args.http_port,
+				 args.approximate)
+	elif args.command == 'snapshot':
+		run_snapshot(paths, args.archive)
+	elif args.command == 'process':
+		run_process(paths, args.workers, not args.no_registry)
+	elif args.command == 'weather':
+		run_weather(paths, args.station, args.wunder_dir, args.days)
+	elif args.command == 'combine':
+		run_combine(paths, args.start, args.end, args.output_file, args.join, args.tolerance)
+	elif args.command == 'load':
+		run_load(paths, args.creds, args.zip, args.keyspace, args.table)
+	elif args.command == 'export':
+		return(run_export(paths, args.creds, args.zip, args.keyspace, args.table, args.output,
+						  args.splits, args.workers))
+	elif args.command == 'run':
+		return(run_pipeline(paths, args))
+	elif args.command == 'bench':
+		import subprocess
+		bench_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Benchmark.py')
+		return(subprocess.call([sys.executable, bench_script] + extra))
+	return(0)
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -14,28 +14,212 @@ can download weather data in a JSON format.
 '''
 
 import os
+import re
 import csv
 import json
 import calendar
-import requests
 import datetime
 from datetime import date
+from Metrics import Metrics
 
 
 # Use logging function
 enable_screen_log = True
-# Define Global locations
-global_weather_write_loc = '/projects/ADSB-Flight-Freq-Tracker/data/weather_data/'
-
-# Determine full path based on if the system is Windows or running on the Linux(pi)
-if os.name == "nt":
-	# If Windows
-	win_prefix = "Z:"
-	global_weather_write_loc = win_prefix + global_weather_write_loc
-else:
+
+def global_weather_write_loc():
+	"""Where the weather CSVs go on this machine, worked out when asked for
+	instead of at import"""
+	weather_loc = '/projects/ADSB-Flight-Freq-Tracker/data/weather_data/'
+
+	# Determine full path based on if the system is Windows or running on the Linux(pi)
+	if os.name == "nt":
+		# If Windows
+		return("Z:" + weather_loc)
 	# If Linux(Pi)
-	pi_prefix = "/home/pi/Documents"
-	global_weather_write_loc = pi_prefix + global_weather_write_loc
+	return("/home/pi/Documents" + weather_loc)
+
+
+# Time is the hour the observation falls in, which the hourly join matches on.
+# ObsTime is when it was actually taken, for the timestamp joins.
+WEATHER_HEADER = ["Date", "Time", "Weekday", "BarometricPressure", "Temp",
+				  "WindSpeed", "WindDirection", "Raining", "ObsTime"]
+
+
+############ Wunderground format engine ###########
+# Shared by Weather's _format_wunder_* methods and the batch converter. The
+# regexes are compiled and the lookup tables built once at import.
+_WUNDER_TIME = re.compile(r'(\d{1,2}):(\d{2}) ([AP]M)')
+_NOT_DIGIT = re.compile(r'\D')
+
+# (hour, AM/PM) -> "HH:00:00"
+_WUNDER_HOURS = dict()
+for _hour in range(1, 13):
+	_WUNDER_HOURS[(str(_hour), "AM")] = "{:02d}:00:00".format(0 if _hour == 12 else _hour)
+	_WUNDER_HOURS[(str(_hour), "PM")] = "{:02d}:00:00".format(12 if _hour == 12 else _hour + 12)
+
+# Wunder uses a 16 point compass where we only use 8
+_WUNDER_WIND = {"NNW": "N", "NNE": "N", "ENE": "E", "ESE": "E", "SSE": "S", "SSW": "S",
+				"WSW": "W", "WNW": "W", "NA": "NA", "None": "NA"}
+
+
+def wunder_time(w_time):
+	"""'1:53 PM' -> '13:00:00'"""
+	found = _WUNDER_TIME.match(w_time)
+	if found is not None:
+		# "01" and "1" are the same hour
+		hour, minute, meridiem = found.groups()
+		converted = _WUNDER_HOURS.get((str(int(hour)), meridiem))
+		if converted is not None:
+			return(converted)
+	# Hours outside 1-12 fall back to the long way round
+	split_time = w_time.split(' ')
+	curr_hour = int(split_time[0].split(":")[0])
+	if split_time[1] == "PM" and curr_hour != 12:
+		curr_hour += 12
+	elif split_time[1] == "AM" and curr_hour == 12:
+		curr_hour = 0
+	return("{:02d}:00:00".format(curr_hour))
+
+
+def wunder_obs_time(w_time):
+	"""'1:53 PM' -> '13:53:00', when the observation was actually taken"""
+	found = _WUNDER_TIME.match(w_time)
+	if found is None:
+		return(wunder_time(w_time))
+	return(wunder_time(w_time)[:3] + "{:02d}:00".format(int(found.group(2))))
+
+
+def wunder_baro(baro_p):
+	"""'29.921 in' -> '29.92'"""
+	return(baro_p.split(' ')[0][:5])
+
+
+def wunder_number(w_value):
+	"""Only the digits, '-5 F' -> '5'"""
+	return(_NOT_DIGIT.sub('', w_value))
+
+
+def wunder_wind_direction(w_direction):
+	return(_WUNDER_WIND.get(w_direction, w_direction))
+
+
+def wunder_rain(w_rain):
+	"""Yes unless the rain column is empty or starts with 0.0"""
+	w_rain = str(w_rain)
+	if w_rain == "NA" or w_rain == "None" or w_rain[:3] == "0.0":
+		return("No")
+	return("Yes")
+
+
+# Converted values seen so far, per column. Wunderground repeats the same few
+# hundred strings ("1:53 PM", "87 F", "29.92 in") all year, so after the first
+# few files almost every value is a dictionary hit.
+_TABLE_LIMIT = 10000
+_TIME_TABLE = dict()
+_OBS_TIME_TABLE = dict()
+_NUMBER_TABLE = dict()
+_BARO_TABLE = dict()
+_RAIN_TABLE = dict()
+
+
+def _fill(table, value, convert):
+	converted = convert(value)
+	if len(table) < _TABLE_LIMIT:
+		table[value] = converted
+	return(converted)
+
+
+def convert_wunder_rows(rows, file_date, day_of_week):
+	"""Wunderground rows -> rows laid out like the weather gov output"""
+	times = _TIME_TABLE
+	obs_times = _OBS_TIME_TABLE
+	numbers = _NUMBER_TABLE
+	baros = _BARO_TABLE
+	rains = _RAIN_TABLE
+	converted = []
+	for row in rows:
+		w_time = times.get(row[0])
+		if w_time is None:
+			w_time = _fill(times, row[0], wunder_time)
+		obs_time = obs_times.get(row[0])
+		if obs_time is None:
+			obs_time = _fill(obs_times, row[0], wunder_obs_time)
+		baro = baros.get(row[7])
+		if baro is None:
+			baro = _fill(baros, row[7], wunder_baro)
+		temp = numbers.get(row[1])
+		if temp is None:
+			temp = _fill(numbers, row[1], wunder_number)
+		speed = numbers.get(row[5])
+		if speed is None:
+			speed = _fill(numbers, row[5], wunder_number)
+		rain = rains.get(row[8])
+		if rain is None:
+			rain = _fill(rains, row[8], wunder_rain)
+		converted.append([file_date, w_time, day_of_week, baro, temp, speed,
+						  _WUNDER_WIND.get(row[4], row[4]), rain, obs_time])
+	return(converted)
+
+
+def _convert_wunder_file(csv_location):
+	"""Worker for the batch converter. Returns (date, rows) or (date, error)"""
+	file_date = os.path.basename(csv_location)[:-4]
+	try:
+		day_of_week = calendar.day_name[datetime.date(
+			*[int(part) for part in file_date.split('-')]).weekday()]
+		with open(csv_location, newline='') as csvfile:
+			return((file_date, convert_wunder_rows(csv.reader(csvfile, delimiter=','),
+												   file_date, day_of_week)))
+	except Exception as err:
+		return((file_date, err))
+
+
+def wunderground_convert_dir(wunder_dir, output_location, workers=None, header=True,
+							 metrics=None, skip_existing=False):
+	"""Convert every YYYY-MM-DD.csv in a wunderground directory and write the
+	daily weather CSVs. Files are converted across a pool of worker processes
+	(workers=1 converts in this process) and written out together at the end.
+	Returns the number of files written."""
+	metrics = metrics if metrics is not None else Metrics('weather')
+	wunder_files = []
+	for file_name in sorted(os.listdir(wunder_dir)):
+		if not file_name.endswith('.csv'):
+			continue
+		if skip_existing and os.path.exists(os.path.join(
+				output_location, file_name[:-4] + "_Weather_log.csv")):
+			continue
+		wunder_files.append(os.path.join(wunder_dir, file_name))
+
+	if workers is None:
+		workers = os.cpu_count() or 1
+	with metrics.stage('convert'):
+		if workers == 1 or len(wunder_files) < 2:
+			converted = [_convert_wunder_file(path) for path in wunder_files]
+		else:
+			import multiprocessing
+			with multiprocessing.Pool(workers) as pool:
+				# Files are small, so hand them out in batches
+				converted = pool.map(_convert_wunder_file, wunder_files,
+									 chunksize=max(1, len(wunder_files) // (workers * 4)))
+
+	written = 0
+	with metrics.stage('write'):
+		for file_date, rows in converted:
+			if isinstance(rows, Exception):
+				print("Could not convert wunder data for {}.\n{}".format(file_date, rows))
+				continue
+			if not rows:
+				continue
+			with open(os.path.join(output_location, "{}_Weather_log.csv".format(file_date)),
+					  'w', newline='') as csv_out:
+				data_writer = csv.writer(csv_out, delimiter=',')
+				if header:
+					data_writer.writerow(WEATHER_HEADER)
+				data_writer.writerows(rows)
+			written += 1
+
+	metrics.count('files', written)
+	return(written)
 
 
 class Weather:
@@ -49,10 +233,12 @@ class Weather:
 		- Outputs Zulu time
 		- Military time
 	"""
-	def __init__(self):
+	def __init__(self, metrics=None):
 		#self.weather_url = weather_url
-		self.csv_write_loc = global_weather_write_loc
+		self.csv_write_loc = global_weather_write_loc()
 		self.api_root_url = "https://api.weather.gov/"
+		# Stage timers and counters (fetch, parse, convert, write)
+		self.metrics = metrics if metrics is not None else Metrics('weather')
 
 	def _weather_log(self, print_data):
 		""" Custom logger """
@@ -94,7 +280,10 @@ class Weather:
 
 		# Attempt to get the data
 		try:
-			call_data = requests.get(api_url)
+			# Only the API needs requests, the wunderground convert doesn't
+			import requests
+			with self.metrics.stage('fetch'):
+				call_data = requests.get(api_url)
 
 			# Check to see if the data transfer was successfull. This doesn't mean
 			# the data received doesn't have an error, but getting a response was good.
@@ -122,14 +311,23 @@ class Weather:
 			# [5] Wind speed, in kph
 			# [6] Wind Direction, using the headings
 			# [7] Was it raining. Yes or No
+			# [8] Time the observation was taken, Chicago -05:00
 		"""
+		with self.metrics.stage('parse'):
+			master_lst, lst_of_dict = self._tranform_json(json_wthr_data, req_date)
+		self.metrics.count('rows', len(master_lst))
+		return(master_lst, lst_of_dict)
+
+	def _tranform_json(self, json_wthr_data, req_date=None):
+		"""Does the work for tranform_json_to_list"""
 		# Transform the JSON in a workable list of dictionaries
 		lst_of_dict = json.loads(json_wthr_data)["features"]
 
 		master_lst = []
 
 		def format_timestamp(timestamp, req_date=None):
-			"""In-function process to parse the time stamp"""
+			"""In-function process to parse the time stamp. Returns the date,
+			the hour and the time it was taken."""
 			# Split the timestamp
 			tmp_ts = timestamp.split("T")
 			tmp_date = tmp_ts[0]
@@ -146,7 +344,8 @@ class Weather:
 			cnt_tz[1] = int(cnt_tz[1])
 			cnt_tz[2] = int(cnt_tz[2])
 
-			# Round to the past hour
+			# Keep the real minutes and seconds, then round to the past hour
+			obs_min_sec = ":{:02d}:{:02d}".format(cnt_tz[1], cnt_tz[2])
 			cnt_tz[1] = '00'; cnt_tz[2] = '00'
 
 			# Subtract the 5 hours to account for time offset
@@ -164,9 +363,9 @@ class Weather:
 			fnl_cnt_tz = cnt_tz[0] + ":" + cnt_tz[1] + ":" + cnt_tz[2]
 
 			if req_date == None:
-				return(tmp_date, fnl_cnt_tz)
+				return(tmp_date, fnl_cnt_tz, cnt_tz[0] + obs_min_sec)
 			else:
-				return(req_date, fnl_cnt_tz)
+				return(req_date, fnl_cnt_tz, cnt_tz[0] + obs_min_sec)
 
 		def check_for_NoneType(lst):
 			"""Checks for NoneTypes and replaces with NA's if found"""
@@ -201,10 +400,10 @@ class Weather:
 
 			# Time stamp
 			if req_date != None:
-				indx_day, indx_time = format_timestamp(indx_prp["timestamp"],
-										   req_date=req_date)
+				indx_day, indx_time, obs_time = format_timestamp(indx_prp["timestamp"],
+													 req_date=req_date)
 			else:
-				indx_day, indx_time = format_timestamp(indx_prp["timestamp"])
+				indx_day, indx_time, obs_time = format_timestamp(indx_prp["timestamp"])
 
 			# Append all the hourly values of the day to the tmp_lst
 			tmp_lst.append(indx_day) # [0] Date YYYY-MM-DD
@@ -215,6 +414,7 @@ class Weather:
 			tmp_lst.append(indx_prp["windSpeed"]["value"]) # [5] Wind speed
 			tmp_lst.append(indx_prp["windDirection"]["value"]) # [6] Wind Direction
 			tmp_lst.append(was_it_raining(indx_prp)) # [7] Was it raining
+			tmp_lst.append(obs_time) # [8] Time it was taken
 
 			# Replace Nonetypes with NA's
 			tmp_lst = check_for_NoneType(tmp_lst)
@@ -299,6 +499,11 @@ class Weather:
 		merica units. C -> F, Kph -> Mph. And change the wind direction from compass
 		rose messurements to base NEWS directions.
 		"""
+		with self.metrics.stage('convert'):
+			return(self._convert_rows(lst_of_wthr))
+
+	def _convert_rows(self, lst_of_wthr):
+		"""Does the work for convert_to_merica"""
 		# Create copy of the list
 		modded_list = lst_of_wthr
 
@@ -366,17 +571,13 @@ class Weather:
 		# Define location to write CSV to
 		csv_write_loc = output_location + "{}_Weather_log.csv".format(file_date)
 
-		# Header for CSV if True
-		weather_header = ["Date", "Time", "Weekday", "BarometricPressure", "Temp",
-					      "WindSpeed", "WindDirection", "Raining"]
-
 		self._weather_log("Writing out weather data to CSV...")
 
 		try:
-			with open(csv_write_loc, 'w', newline='') as csv_out:
+			with self.metrics.stage('write'), open(csv_write_loc, 'w', newline='') as csv_out:
 				data_writer = csv.writer(csv_out, delimiter=',')
 				if header:
-					data_writer.writerow(weather_header)
+					data_writer.writerow(WEATHER_HEADER)
 				for row in wthr_data:
 					data_writer.writerow(row)
 
@@ -386,87 +587,28 @@ class Weather:
 
 		self._weather_log("CSV successfully created...")
 
-	def _format_wunder_time(self, wunder_time):
+	def _format_wunder_time(self, w_time):
 		"""Format the time for wunderground into 24hr time
 		Already accounts for Chicago time zone.
 		"""
-		# Split the time from AM/PM
-		split_time = wunder_time.split(' ')
-		curr_hour = int(split_time[0].split(":")[0])
-		meridiem = split_time[1] # AM or PM
-
-		# Adding or subtracting 12 depending on AM or PM
-		meridiem_coef = 0
-		if meridiem == "PM":
-			meridiem_coef = 12
-
-		# If it is 12AM then set the hour to 0
-		if curr_hour == 12 and meridiem == "AM":
-			curr_hour = 0
-		# Otherwise set the hour normally
-		else:
-			if curr_hour == 12 and meridiem == "PM":
-				curr_hour = 12
-			else:
-				curr_hour = curr_hour + meridiem_coef
-
-		# Add leading zero if it's a single digit
-		if len(str(curr_hour)) == 1:
-			curr_hour = "0" + str(curr_hour)
-
-		return(str(curr_hour) + ":00:00")
+		return(wunder_time(w_time))
 
 	def _format_wunder_baro(self, baro_p):
 		"""Strip the string so only the pressure value is left"""
-		if baro_p != "NA" or baro_p != "None":
-			new_bar = baro_p.split(' ')[0][:5]
-			return(new_bar)
-		else:
-			return("NA")
+		return(wunder_baro(baro_p))
 
 	def _format_wunder_number(self, w_value):
 		"""Format numbers from wunder. Strips all but the number"""
-		if w_value != "NA" or w_value != "None":
-			temp_numeric = ""
-			for num in w_value:
-				if num.isdigit():
-					temp_numeric = temp_numeric + num
-			return(temp_numeric)
-		else:
-			return("NA")
+		return(wunder_number(w_value))
 
 	def _format_wunder_wind_direction(self, w_direction):
 		"""Wunder uses a 16 point system where we only use an 8. Convert over to
 		our way of directions"""
-		# Makes sure it's not Null first
-		if w_direction == "NA" or w_direction == "None":
-			return("NA")
-
-		direction = w_direction
-
-		# Go through and make case like statements for the wind direction
-		if direction == "NNW" or direction == "NNE":
-			direction = "N"
-		if direction == "ENE" or direction == "ESE":
-			direction = "E"
-		if direction == "SSE" or direction == "SSW":
-			direction = "S"
-		if direction == "WSW" or direction == "WNW":
-			direction = "W"
-
-		return(direction)
+		return(wunder_wind_direction(w_direction))
 
 	def _format_wunder_rain(self, w_rain):
 		"""Detects if it was raining that hour or not"""
-		# In short if it's not equal to Null or the 0.0 in value then there is a good
-		# chance it was raining
-		w_rain=str(w_rain)
-		if w_rain == "NA" or w_rain == "None":
-			return("No")
-		if w_rain[:3] == "0.0":
-			return("No")
-		else:
-			return("Yes")
+		return(wunder_rain(w_rain))
 
 	def wunderground_convert(self, csv_location):
 		"""Sometimes the weather gov api does not have past data to retrieve. I found
@@ -488,33 +630,12 @@ class Weather:
 
 		# Read in the CSV data
 		try:
-			with open(csv_location, newline='') as csvfile:
+			with self.metrics.stage('convert'), open(csv_location, newline='') as csvfile:
 				# CSV reader that seperated by commas
 				wunder_reader = csv.reader(csvfile, delimiter=',')
-				# Add Rows to raw data variable
-				for row in wunder_reader:
-					# Okay, let's do some organizing to match the imported data
-					# to our expected output list from the weather gov api
-					tmp_row = []
-
-					# [0] Date
-					tmp_row.append(file_date)
-					# [1] Time
-					tmp_row.append(self._format_wunder_time(row[0]))
-					# [2] Weekday
-					tmp_row.append(day_of_week)
-					# [3] BarometricPressure
-					tmp_row.append(self._format_wunder_baro(row[7]))
-					# [4] Temp
-					tmp_row.append(self._format_wunder_number(row[1]))
-					# [5] Wind Speed
-					tmp_row.append(self._format_wunder_number(row[5]))
-					# [6] Wind Direction
-					tmp_row.append(self._format_wunder_wind_direction(row[4]))
-					# [7] Was it raining
-					tmp_row.append(self._format_wunder_rain(row[8]))
-
-					wunder_data.append(tmp_row)
+				# Organize each row to match the expected output list from the
+				# weather gov api (see convert_wunder_rows)
+				wunder_data = convert_wunder_rows(wunder_reader, file_date, day_of_week)
 
 				csvfile.close()
 
@@ -524,50 +645,6 @@ class Weather:
 		return(wunder_data)
 
 
-# if __name__ == "__main__":
- 	
-#  	daily_weather, data_dict = Weather().get_daily_weather("KFTW", "2022-07-26")
-#  	daily_weather = Weather().convert_to_merica(daily_weather)
-#  	# Write out to weather location
-#  	Weather().write_daily_to_csv(daily_weather, global_weather_write_loc)
- 	
- 	
- 	# # Bulk update
- 	# wunder_dir = "Z:/Projects/ADSB-Flight-Freq-Tracker/data/.wunderground_wthr/"
- 	# list_of_files = os.listdir(wunder_dir)
-
-# 	for file in list_of_files:
-# 		w_path = wunder_dir + file
-# 		wunder_data = Weather().wunderground_convert(w_path)
-# 		Weather().write_daily_to_csv(wunder_data, global_weather_write_loc)
-# 	
-# 	'''
-# 	wunder_path = "Z:/Projects/ADSB-Flight-Freq-Tracker/data/.wunderground_wthr/2022-06-20.csv"
-# 	wunder_data = Weather().wunderground_convert(wunder_path)
-# 	Weather().write_daily_to_csv(wunder_data, global_weather_write_loc)
-# 	'''
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+# Daily weather and the wunderground bulk convert are run from Tracker.py:
+#   python Tracker.py weather --station KFTW
+#   python Tracker.py weather --wunder-dir <wunderground csv dir>